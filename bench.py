@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# monocle-bridge - Bridge for Brilliant Monocle (proot CLI → Web Bluetooth)
+# Copyright (C) 2025 actuallyrizzn
+"""
+End-to-end benchmark: CLI clients -> server.relay -> simulated bridge -> simulated Monocle.
+
+Runs the real relay on an ephemeral port with a SimulatedBridge attached and
+reports round-trip latency (p50/p99), frames per second and bytes per second.
+No phone or device needed.
+
+    python3 bench.py                      # all scenarios, realistic BLE timing
+    python3 bench.py latency stream --latency 0 --notify-interval 0 --json
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+try:
+    import websockets
+except ImportError:
+    print("Install: pip install websockets")
+    sys.exit(1)
+
+import server
+from monocle_client import MonocleClient
+from monocle_display import Display
+from simulator import SimulatedBridge, SimulatedMonocle
+
+BENCH_DIR = Path(__file__).resolve().parent
+FINAL_TYPES = {"connected", "repl_response", "repl_batch_done", "repl_done", "file_done", "file_list",
+               "file_manifest", "data_done", "interrupted"}
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of samples."""
+    ordered = sorted(samples)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+def latency_stats(samples_s, frames, elapsed):
+    ms = [s * 1000 for s in samples_s]
+    return {
+        "requests": len(ms),
+        "p50_ms": round(percentile(ms, 50), 2),
+        "p99_ms": round(percentile(ms, 99), 2),
+        "mean_ms": round(statistics.fmean(ms), 2),
+        "frames_per_s": round(frames / elapsed, 1),
+    }
+
+
+class BenchClient:
+    """Minimal CLI-side client: one request in flight, counts frames and bytes."""
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.frames = 0
+        self.bytes = 0
+        self._ids = iter(range(1, 1 << 31))
+
+    @classmethod
+    async def open(cls, url):
+        ws = await websockets.connect(url, max_size=None)
+        await ws.send(json.dumps({"role": "cli"}))
+        await ws.recv()
+        return cls(ws)
+
+    async def call(self, frame):
+        """Send frame and collect replies up to the final one; return (replies, payload bytes)."""
+        # ID and send time first, as monocle-cli.py writes them, so the relay times the request
+        await self.ws.send(json.dumps({"id": next(self._ids), "sent_at": round(time.time() * 1000, 1), **frame}))
+        replies = []
+        payload = 0
+        while True:
+            message = await self.ws.recv()
+            self.frames += 1
+            self.bytes += len(message)
+            if isinstance(message, bytes):
+                payload += len(message) - server.FRAME_HEADER.size
+                continue
+            reply = json.loads(message)
+            replies.append(reply)
+            if reply.get("type") == "repl_chunk":
+                payload += len(reply.get("data", ""))
+            if reply.get("type") in FINAL_TYPES:
+                return replies, payload
+
+    async def close(self):
+        await self.ws.close()
+
+
+async def bench_latency(url, args):
+    """Sequential non-streaming repl round trips from one client."""
+    client = await BenchClient.open(url)
+    samples = []
+    start = time.perf_counter()
+    for i in range(args.requests):
+        t0 = time.perf_counter()
+        await client.call({"type": "repl", "code": f"{i}+1"})
+        samples.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - start
+    await client.close()
+    return latency_stats(samples, client.frames, elapsed)
+
+
+async def bench_concurrent(url, args):
+    """Several clients issuing repl requests at once; the bridge round-robins them."""
+    clients = [await BenchClient.open(url) for _ in range(args.clients)]
+    per_client = max(1, args.requests // args.clients)
+    samples = []
+
+    async def run(client):
+        for i in range(per_client):
+            t0 = time.perf_counter()
+            await client.call({"type": "repl", "code": f"{i}*2"})
+            samples.append(time.perf_counter() - t0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run(c) for c in clients))
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        await client.close()
+    return {"clients": args.clients, **latency_stats(samples, sum(c.frames for c in clients), elapsed)}
+
+
+async def bench_stream(url, args):
+    """Streamed output of a large print, as binary frames; measures output throughput."""
+    client = await BenchClient.open(url)
+    code = f"print('x' * {args.stream_bytes})"
+    start = time.perf_counter()
+    _, payload = await client.call({"type": "repl", "code": code, "stream": True, "binary": True})
+    elapsed = time.perf_counter() - start
+    await client.close()
+    return {
+        "bytes": payload,
+        "bytes_per_s": round(payload / elapsed),
+        "frames": client.frames,
+        "frames_per_s": round(client.frames / elapsed, 1),
+        "elapsed_ms": round(elapsed * 1000, 2),
+    }
+
+
+async def bench_batch(url, args):
+    """The same snippets as one repl_batch and as sequential repl requests."""
+    client = await BenchClient.open(url)
+    snippets = [f"{i}+1" for i in range(args.batch)]
+    t0 = time.perf_counter()
+    await client.call({"type": "repl_batch", "snippets": snippets})
+    batch = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for code in snippets:
+        await client.call({"type": "repl", "code": code})
+    sequential = time.perf_counter() - t0
+    await client.close()
+    return {
+        "snippets": len(snippets),
+        "batch_ms": round(batch * 1000, 2),
+        "sequential_ms": round(sequential * 1000, 2),
+        "speedup": round(sequential / batch, 2),
+    }
+
+
+async def bench_file(url, args):
+    """Push a file to the simulated device and pull it back; the bridge reports throughput."""
+    client = await BenchClient.open(url)
+    # Python source, like most files pushed to a Monocle (and compressible)
+    source = (BENCH_DIR / "simulator.py").read_bytes()
+    data = (source * (args.file_bytes // len(source) + 1))[:args.file_bytes]
+    t0 = time.perf_counter()
+    push, _ = await client.call({"type": "file_push", "path": "bench.bin", "data": base64.b64encode(data).decode()})
+    push_ms = (time.perf_counter() - t0) * 1000
+    t0 = time.perf_counter()
+    pull, payload = await client.call({"type": "file_pull", "path": "bench.bin", "binary": True})
+    pull_ms = (time.perf_counter() - t0) * 1000
+    await client.close()
+    if not (push[-1].get("ok") and pull[-1].get("ok")) or payload != len(data):
+        raise RuntimeError(f"file transfer failed: {push[-1]} {pull[-1]}")
+    return {
+        "bytes": len(data),
+        "push_ms": round(push_ms, 2),
+        "push_bytes_per_s": push[-1]["bytes_per_s"],
+        "pull_ms": round(pull_ms, 2),
+        "pull_bytes_per_s": pull[-1]["bytes_per_s"],
+        "push_ble_bytes": push[-1].get("ble_bytes", len(data)),
+        "pull_ble_bytes": pull[-1].get("ble_bytes", len(data)),
+    }
+
+
+async def bench_capture(url, args):
+    """A camera still over the raw data channel, against pulling the same bytes as a file over the REPL."""
+    client = await BenchClient.open(url)
+    capture, payload = await client.call({"type": "data_capture", "source": "camera", "binary": True})
+    if not capture[-1].get("ok") or payload != capture[-1]["size"]:
+        raise RuntimeError(f"capture failed: {capture[-1]}")
+    image = base64.b64encode(os.urandom(payload)).decode()  # incompressible, like a JPEG
+    await client.call({"type": "file_push", "path": "capture.jpg", "data": image})
+    pull, _ = await client.call({"type": "file_pull", "path": "capture.jpg", "binary": True})
+    await client.close()
+    return {
+        "bytes": payload,
+        "capture_bytes_per_s": capture[-1]["bytes_per_s"],
+        "pull_bytes_per_s": pull[-1]["bytes_per_s"],
+    }
+
+
+async def bench_display(url, args):
+    """HUD frames with one changing field: deltas against redrawing the whole scene every frame."""
+    scene = {f"line{i}": ("Text", f"status line {i}", 0, 40 * i, 0xFFFFFF) for i in range(8)}
+    results = {"frames": args.frames}
+    async with MonocleClient(url) as client:
+        for mode in ("delta", "whole"):
+            display = Display(client)
+            await display.show(scene)
+            await display.flush()
+            sent = display.bytes
+            start = time.perf_counter()
+            for i in range(args.frames):
+                await display.show({**scene, "clock": ("Text", f"{i:05d}", 500, 0, 0x00FF00)}, whole=mode == "whole")
+            await display.flush()
+            elapsed = time.perf_counter() - start
+            results[f"{mode}_fps"] = round(args.frames / elapsed, 1)
+            results[f"{mode}_bytes_per_frame"] = round((display.bytes - sent) / args.frames)
+    return results
+
+
+async def bench_cli(url, args):
+    """Wall time of whole monocle-cli.py processes running one repl each, with each WebSocket client."""
+    results = {"runs": args.cli_runs}
+    for ws_client, prefix in (("auto", ""), ("websockets", "websockets_")):
+        env = dict(os.environ, MONOCLE_WS_URL=url, MONOCLE_WS_CLIENT=ws_client,
+                   MONOCLE_CLI_SOCKET=os.path.join(tempfile.gettempdir(), f"monocle-bench-{os.getpid()}.sock"))
+        samples = []
+        for _ in range(args.cli_runs):
+            t0 = time.perf_counter()
+            proc = await asyncio.create_subprocess_exec(
+                sys.executable, str(BENCH_DIR / "monocle-cli.py"), "repl", "1+1",
+                env=env, stdout=asyncio.subprocess.DEVNULL,
+            )
+            if await proc.wait() != 0:
+                raise RuntimeError(f"monocle-cli.py exited with {proc.returncode}")
+            samples.append(time.perf_counter() - t0)
+        ms = [s * 1000 for s in samples]
+        results[f"{prefix}p50_ms"] = round(percentile(ms, 50), 2)
+        results[f"{prefix}p99_ms"] = round(percentile(ms, 99), 2)
+    return results
+
+
+async def python_startup(code, importtime=False):
+    """Run ``code`` in a fresh interpreter: (wall seconds, {top-level import: cumulative ms} with -X importtime)."""
+    flags = ["-X", "importtime"] if importtime else []
+    t0 = time.perf_counter()
+    proc = await asyncio.create_subprocess_exec(sys.executable, *flags, "-c", code,
+                                                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+    _, err = await proc.communicate()
+    elapsed = time.perf_counter() - t0
+    if proc.returncode:
+        raise RuntimeError(f"python -c {code!r} exited with {proc.returncode}: {err.decode(errors='replace')}")
+    imports = {}
+    for line in err.decode().splitlines():
+        # "import time: self [us] | cumulative | imported package", nested imports indented
+        fields = line.split("|")
+        if line.startswith("import time:") and len(fields) == 3 and fields[1].strip().isdigit():
+            name = fields[2][1:]
+            if not name.startswith(" "):
+                imports[name] = int(fields[1]) / 1000
+    return elapsed, imports
+
+
+async def bench_startup(args):
+    """Cold start of monocle-cli.py up to its first request: interpreter, imports, compiling the script."""
+    script = BENCH_DIR / "monocle-cli.py"
+    # What running the script does before main(): compile it (scripts get no .pyc) and run its top level
+    load = f"p = {str(script)!r}; exec(compile(open(p).read(), p, 'exec'), {{'__name__': 'monocle_cli', '__file__': p}})"
+    wall, bare, import_ms = [], [], []
+    imports = {}
+    for _ in range(args.cli_runs):
+        bare.append((await python_startup("pass"))[0] * 1000)
+        wall.append((await python_startup(load))[0] * 1000)
+        # -X importtime slows the run down, so it is timed separately
+        imports = (await python_startup(load, importtime=True))[1]
+        import_ms.append(sum(imports.values()))
+    results = {
+        "runs": args.cli_runs,
+        "p50_ms": round(percentile(wall, 50), 2),
+        "interpreter_p50_ms": round(percentile(bare, 50), 2),
+        "imports_p50_ms": round(percentile(import_ms, 50), 2),
+        "loads_websockets": "websockets" in imports,
+    }
+    try:
+        _, ws_imports = await python_startup("import websockets.asyncio.client", importtime=True)
+        results["websockets_import_ms"] = round(
+            sum(ms for name, ms in ws_imports.items() if name.split(".")[0] == "websockets"), 2)
+    except RuntimeError:
+        pass  # not installed
+    heaviest = sorted(imports.items(), key=lambda item: -item[1])[:5]
+    results["heaviest_imports_ms"] = {name: round(ms, 2) for name, ms in heaviest}
+    return results
+
+
+SCENARIOS = {
+    "latency": bench_latency,
+    "concurrent": bench_concurrent,
+    "stream": bench_stream,
+    "batch": bench_batch,
+    "file": bench_file,
+    "capture": bench_capture,
+    "display": bench_display,
+    "cli": bench_cli,
+    "startup": bench_startup,
+}
+# Scenarios that need no relay or simulated device
+LOCAL_SCENARIOS = {"startup"}
+
+
+@contextlib.asynccontextmanager
+async def simulated_setup(args):
+    """Relay on an ephemeral port with a connected SimulatedBridge; yields (url, bridge)."""
+    ws_server = await websockets.serve(server.relay, "127.0.0.1", 0, max_size=None)
+    url = f"ws://127.0.0.1:{ws_server.sockets[0].getsockname()[1]}"
+    device = SimulatedMonocle(mtu=args.mtu, latency=args.latency / 1000, notify_interval=args.notify_interval / 1000,
+                              zlib=None if args.device_zlib == "none" else args.device_zlib)
+    try:
+        async with SimulatedBridge(url, device) as bridge:
+            bridge.connected = True
+            yield url, bridge
+    finally:
+        ws_server.close()
+        await ws_server.wait_closed()
+
+
+async def run_bench(args):
+    """Run the selected scenarios; returns {scenario: results}."""
+    results = {}
+    server.metrics = server.RelayMetrics()
+    selected = args.scenarios or list(SCENARIOS)
+    for name in selected:
+        if name in LOCAL_SCENARIOS:
+            results[name] = await SCENARIOS[name](args)
+    async with simulated_setup(args) as (url, bridge):
+        for name in selected:
+            if name not in LOCAL_SCENARIOS:
+                results[name] = await SCENARIOS[name](url, args)
+        # Where the time went, from the relay's per-hop histograms (see /metrics)
+        results["hops_mean_ms"] = {
+            hop: round(series["sum"] / series["count"] * 1000, 2)
+            for hop, series in sorted(server.metrics.hops.series.items())
+        }
+        results["device"] = {
+            "writes": bridge.device.writes,
+            "notifications": bridge.device.notifications,
+            "bytes_in": bridge.device.bytes_in,
+            "bytes_out": bridge.device.bytes_out,
+        }
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help=f"scenarios to run (default: all of {', '.join(SCENARIOS)})")
+    parser.add_argument("--requests", type=int, default=50, help="repl requests per latency run")
+    parser.add_argument("--clients", type=int, default=4, help="clients in the concurrent run")
+    parser.add_argument("--stream-bytes", type=int, default=20000, help="output size of the stream run")
+    parser.add_argument("--batch", type=int, default=20, help="snippets in the batch run")
+    parser.add_argument("--file-bytes", type=int, default=20000, help="file size of the file run")
+    parser.add_argument("--frames", type=int, default=30, help="display frames per mode in the display run")
+    parser.add_argument("--cli-runs", type=int, default=5, help="monocle-cli.py processes to time (cli, startup)")
+    parser.add_argument("--mtu", type=int, default=128, help="simulated BLE ATT MTU")
+    parser.add_argument("--latency", type=float, default=7.5, help="one-way BLE latency, ms")
+    parser.add_argument("--notify-interval", type=float, default=7.5, help="minimum gap between notifications, ms")
+    parser.add_argument("--device-zlib", choices=("none", "inflate", "deflate"), default="none",
+                        help="zlib support of the simulated firmware (what BLE compression can use)")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(unknown)}")
+    return args
+
+
+def main():
+    args = parse_args()
+    results = asyncio.run(run_bench(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for name, values in results.items():
+        print(f"{name}:")
+        for key, value in values.items():
+            print(f"  {key:<16} {value}")
+
+
+if __name__ == "__main__":
+    main()
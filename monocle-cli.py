@@ -5,72 +5,969 @@
 """
 Monocle CLI - connect to Monocle via the bridge (Chrome + Web Bluetooth).
 Requires: bridge server running, bridge.html open in Chrome on same device.
+A command-line wrapper over monocle_client.MonocleClient.
+
+Start-up is most of a short command's time, so modules only some commands
+need (websockets, pathlib, hashlib, wave) are imported where they are used.
 """
 import asyncio
+import base64
+import contextlib
+import itertools
 import json
+import os
+import re
+import signal
+import subprocess
 import sys
+import threading
+import time
+import zlib
 
-try:
-    import websockets
-except ImportError:
-    print("Install: pip install websockets")
-    sys.exit(1)
+from monocle_client import (FINAL_TYPES, WS_CLIENT, WS_CLIENTS, MonocleClient, MonocleError, RelayLink, decode_frame,
+                            ws_exceptions)
+from monocle_display import RASTER_CELL, Display, parse_frame, rasterize, read_image
 
-WS_URL = "ws://127.0.0.1:8766"
-pending = asyncio.Queue()
+# In the directory tempfile.gettempdir() would pick, without importing it
+SOCKET_PATH = os.environ.get("MONOCLE_CLI_SOCKET") or os.path.join(
+    next((d for d in map(os.environ.get, ("TMPDIR", "TEMP", "TMP")) if d and os.path.isdir(d)), "/tmp"),
+    f"monocle-cli-{os.getuid()}.sock",
+)
+# With several bridge pages (one per Monocle) registered, the Monocle to
+# address: a bridge's device id or the Monocle's name (see server._route).
+# Set with --device NAME; --all runs a command on every Monocle.
+DEVICE = os.environ.get("MONOCLE_DEVICE") or None
+# Requests with a higher priority run before queued ones from any client.
+PRIORITY = int(os.environ["MONOCLE_PRIORITY"]) if os.environ.get("MONOCLE_PRIORITY") else None
+# Short request/response commands: with MONOCLE_WS_CLIENT=auto they connect
+# with the built-in WebSocket client (monocle_ws), skipping the websockets
+# import; the others keep websockets for its compression
+QUICK_COMMANDS = {"connect", "status", "devices", "repl", "batch", "ls", "rm", "watch"}
+# Exit status after Ctrl-C, as for a shell command killed by SIGINT
+INTERRUPTED_STATUS = 130
+# A transfer that fails on one of these link errors is retried, resuming
+# where it stopped (the bridge keeps pushes in <path>.part on the device)
+FILE_ATTEMPTS = 3
+FILE_RETRY_DELAY = 2.0
+LINK_ERRORS = {"disconnected", "no response from device", "Not connected to Monocle", "timeout",
+               "bridge disconnected"}
+# Per-project cache of the device's manifest after the last sync (never synced itself)
+SYNC_MANIFEST = ".monocle-sync.json"
+# Ahead-of-time compilation: with mpy-cross installed, uploaded modules go to
+# the device as .mpy bytecode when its .mpy version matches, else as source.
+MPY_CROSS = os.environ.get("MONOCLE_MPY_CROSS", "mpy-cross")  # empty disables
+MPY_CACHE_DIR = os.environ.get("MONOCLE_MPY_CACHE") or os.path.join(os.path.expanduser("~"), ".cache", "monocle-cli", "mpy")
+MPY_SOURCE_ONLY = {"main.py", "boot.py"}  # the device runs these from source at boot
+# Raw data channel recordings: the microphone's defaults, and its signed
+# 8-bit samples mapped to the unsigned ones WAV files hold
+DEFAULT_SAMPLE_RATE = 8000
+DEFAULT_BIT_DEPTH = 16
+_PCM8_TO_WAV = bytes((i + 128) & 0xFF for i in range(256))
+_mpy_cross_versions = {}  # executable -> (executable, mpy major version, version text) or None
+# Top-level lines that continue the compound statement above them
+CLAUSE = re.compile(r"(?:else|elif|except|finally)\b")
+interrupt_sent = False  # Ctrl-C asked the bridge to stop this client's requests
 
 
-async def cli():
-    async with websockets.connect(WS_URL, ping_interval=20, ping_timeout=10) as ws:
-        await ws.send(json.dumps({"role": "cli"}))
-        reg = json.loads(await ws.recv())
+def handle_sigint(client, task):
+    """Ctrl-C: first ask the bridge to interrupt this client's requests, then quit.
+
+    The interrupt goes ahead of everything queued on the bridge: queued
+    requests are cancelled and running code gets a Ctrl-C on the device, so
+    the command still finishes with the device's KeyboardInterrupt. A second
+    Ctrl-C stops waiting for that.
+    """
+    global interrupt_sent
+    if interrupt_sent:
+        task.cancel()
+        return
+    interrupt_sent = True
+    sys.stderr.write("\n(interrupting; Ctrl-C again to quit)\n")
+    asyncio.ensure_future(client.interrupt())
+
+
+def split_snippets(text):
+    """Split a script into top-level statements for a batch.
+
+    A snippet starts at a non-blank line without leading whitespace, unless
+    it continues the statement above: an else/elif/except/finally clause,
+    or any line while that statement is still incomplete (after a
+    decorator, an open bracket or a try block without its except).
+    """
+    snippets = []
+    for line in text.splitlines():
+        if not snippets:
+            if line.strip():
+                snippets.append(line)
+            continue
+        if line[:1] in ("", " ", "\t") or CLAUSE.match(line) or _incomplete(snippets[-1]):
+            snippets[-1] += "\n" + line
+        elif line.strip():
+            snippets.append(line)
+    return [snippet.rstrip() for snippet in snippets]
+
+
+def _incomplete(source):
+    """True if ``source`` needs more lines to be a whole statement (codeop, as the REPL decides)."""
+    import codeop
+    import warnings
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        try:
+            return codeop.compile_command(source, "<batch>", "exec") is None
+        except (SyntaxError, ValueError, OverflowError):
+            return False
+
+
+async def run_batch(client, snippets):
+    """Send all snippets in one repl_batch frame and print results as they stream in.
+
+    Returns the exit status: 0 if every snippet ran, 1 if the batch failed,
+    the bridge went away or the device stopped answering.
+    """
+    status = 0
+    call = await client.call({"type": "repl_batch", "snippets": snippets})
+    try:
+        async for resp in call:
+            kind = resp.get("type")
+            if kind == "bridge_gone":
+                print(f"({resp.get('error', 'bridge disconnected')})")
+                status = 1
+            elif kind == "repl_batch_result" and resp.get("data"):
+                print(resp["data"].replace("\r", ""), flush=True)
+            elif kind == "repl_batch_done" and resp.get("error"):
+                print(f"({resp['error']} after {resp.get('count', 0)} of {len(snippets)})")
+                status = 1
+    except asyncio.TimeoutError:
+        print("(timeout)")
+        return 1
+    return status
+
+
+async def run_repl(client, code):
+    """Run code in streaming mode, writing output as it arrives.
+
+    Returns the exit status: 0 if the code ran cleanly, 1 if it raised or
+    the request failed.
+    """
+    try:
+        async for text in client.stream(code):
+            sys.stdout.write(text.replace("\r", ""))
+            sys.stdout.flush()
+    except MonocleError as e:
+        if e.reply.get("type") != "repl_done" or e.reply.get("error"):
+            print(f"({e})")
+        return 1
+    except asyncio.TimeoutError:
+        print("(timeout)")
+        return 1
+    return 0
+
+
+def link_summary(resp):
+    """One line describing a status reply."""
+    if not resp.get("bridge"):
+        return "Bridge page not connected to the server"
+    if not resp.get("connected"):
+        return "Bridge ready; Monocle not connected"
+    return f"Monocle connected ({resp.get('device') or 'unnamed'})"
+
+
+def device_summary(device):
+    """One line describing a bridge in a devices reply."""
+    if device.get("away"):
+        state = "bridge page reconnecting"
+    elif not device.get("connected"):
+        state = "Monocle not connected"
+    else:
+        state = f"Monocle connected ({device.get('device') or 'unnamed'})"
+    busy = f", {device['busy']} request(s) in flight" if device.get("busy") else ""
+    return f"{device.get('id') or '(unnamed)'}: {state}{busy}"
+
+
+def show_progress(resp):
+    if sys.stderr.isatty() and resp.get("total"):
+        sys.stderr.write(f"\r{100 * resp['done'] // resp['total']:3d}% {resp['done']}/{resp['total']} bytes")
+        sys.stderr.flush()
+
+
+def transfer_summary(resp):
+    text = (f"{resp.get('size', 0)} bytes in {resp.get('elapsed_ms', 0) / 1000:.2f} s "
+            f"({resp.get('bytes_per_s', 0) / 1000:.1f} kB/s)")
+    if resp.get("resumed_from"):
+        text += f", resumed at byte {resp['resumed_from']}"
+    if resp.get("ble_bytes"):
+        text += f", {resp['ble_bytes']} bytes deflated over BLE"
+    return text
+
+
+async def file_result(pending):
+    """Await file request ``pending``; a failure or timeout comes back as a failed reply."""
+    try:
+        return await pending
+    except MonocleError as e:
+        return {**e.reply, "ok": False, "error": str(e)}
+    except asyncio.TimeoutError:
+        return {"ok": False, "error": "timeout"}
+    finally:
+        if sys.stderr.isatty():
+            sys.stderr.write("\r\033[K")  # the progress line
+
+
+async def retry_transfer(name, attempt, resp):
+    """After a failed attempt: return True to try again, else report the failure."""
+    if resp.get("error") in LINK_ERRORS and attempt < FILE_ATTEMPTS:
+        print(f"({name} interrupted: {resp['error']}; resuming)", file=sys.stderr)
+        await asyncio.sleep(FILE_RETRY_DELAY)
+        return True
+    print(f"({name} failed: {resp.get('error')})")
+    return False
+
+
+def mpy_cross_version():
+    """(executable, mpy major version, version text) of mpy-cross, or None if there is none."""
+    import shutil
+
+    exe = shutil.which(MPY_CROSS) if MPY_CROSS else None
+    if exe not in _mpy_cross_versions:
+        info = None
+        if exe:
+            try:
+                text = subprocess.run([exe, "--version"], capture_output=True, text=True, timeout=10).stdout
+            except (OSError, subprocess.SubprocessError):
+                text = ""
+            match = re.search(r"mpy v(\d+)", text)
+            if match:
+                info = (exe, int(match.group(1)), text.strip())
+        _mpy_cross_versions[exe] = info
+    return _mpy_cross_versions[exe]
+
+
+def compile_mpy(path, name, device_mpy):
+    """Bytecode file for source ``path`` (imported on the device as ``name``), or None for source.
+
+    None when there is no mpy-cross, the device's sys.implementation._mpy
+    does not match its .mpy version (bytecode only needs the major version),
+    or compilation fails. Results are cached by source hash, name and
+    compiler version, so unchanged modules are not recompiled.
+    """
+    cross = mpy_cross_version()
+    if cross is None or not device_mpy or device_mpy & 0xFF != cross[1]:
+        return None
+    import hashlib
+    from pathlib import Path
+
+    source = Path(path).read_bytes()
+    key = hashlib.sha256(b"\0".join([source, name.encode(), cross[2].encode()])).hexdigest()
+    cache = Path(MPY_CACHE_DIR)
+    out = cache / f"{key}.mpy"
+    if out.exists():
+        return out
+    cache.mkdir(parents=True, exist_ok=True)
+    tmp = out.with_suffix(f".{os.getpid()}.tmp")
+    result = subprocess.run([cross[0], "-s", name, "-o", str(tmp), str(path)],
+                            capture_output=True, text=True)
+    if result.returncode:
+        print(f"(mpy-cross failed for {path}, sending source: {result.stderr.strip()})", file=sys.stderr)
+        tmp.unlink(missing_ok=True)
+        return None
+    tmp.replace(out)
+    return out
+
+
+def upload_artifact(path, remote, device_mpy):
+    """(file to send, remote path) for uploading ``path`` as ``remote``: bytecode when possible."""
+    from pathlib import Path
+
+    name = remote.rsplit("/", 1)[-1]
+    if not name.endswith(".py") or name in MPY_SOURCE_ONLY:
+        return Path(path), remote
+    compiled = compile_mpy(path, name, device_mpy)
+    if compiled is None:
+        return Path(path), remote
+    return compiled, remote[:-3] + ".mpy"
+
+
+async def query_device_mpy(client):
+    """The device's sys.implementation._mpy (0 if it has none or does not answer)."""
+    try:
+        data = (await client.repl("import sys;print(getattr(sys.implementation,'_mpy',0))")).strip()
+    except (MonocleError, asyncio.TimeoutError):
+        return 0
+    return int(data) if data.isdigit() else 0
+
+
+async def upload_file(client, local, remote):
+    """push: send ``local`` as ``remote``, precompiled to .mpy when possible; returns the exit status."""
+    device_mpy = 0
+    if remote.endswith(".py") and mpy_cross_version():
+        device_mpy = await query_device_mpy(client)
+    path, target = upload_artifact(local, remote, device_mpy)
+    status = await push_file(client, str(path), target, source=local)
+    if status == 0 and target != remote:
+        # The device imports x.py ahead of x.mpy: drop a stale source copy
+        await file_result(client.rm(remote))
+    return status
+
+
+async def push_file(client, local, remote, source=None):
+    """Copy a local file to the device; returns the exit status.
+
+    ``source`` is the name to report when ``local`` was built from it.
+    """
+    with open(local, "rb") as f:
+        data = f.read()
+    for attempt in range(1, FILE_ATTEMPTS + 1):
+        resp = await file_result(client.push(remote, data, show_progress))
+        if resp.get("ok"):
+            print(f"{source or local} -> {remote}: {transfer_summary(resp)}")
+            return 0
+        if not await retry_transfer("push", attempt, resp):
+            return 1
+    return 1
+
+
+async def pull_file(client, remote, local):
+    """Copy a file from the device, resuming from LOCAL.part; returns the exit status."""
+    from pathlib import Path
+
+    part = Path(local + ".part")
+    for attempt in range(1, FILE_ATTEMPTS + 1):
+        offset = part.stat().st_size if part.exists() else 0
+        with open(part, "ab") as f:
+            resp = await file_result(client.pull(remote, f, offset, show_progress))
+        if resp.get("ok"):
+            contents = part.read_bytes()
+            if len(contents) != resp.get("size") or zlib.crc32(contents) != resp.get("crc"):
+                part.unlink()
+                print("(pull failed: size or CRC of the copy does not match; partial copy removed)")
+                return 1
+            part.replace(local)
+            print(f"{remote} -> {local}: {transfer_summary(resp)}")
+            return 0
+        if not await retry_transfer("pull", attempt, resp):
+            return 1
+    return 1
+
+
+async def list_files(client, path):
+    try:
+        entries = await client.ls(path)
+    except (MonocleError, asyncio.TimeoutError) as e:
+        print(f"({e or 'timeout'})")
+        return 1
+    for entry in entries:
+        if entry.get("dir"):
+            print(f"{'-':>8}  {entry['name']}/")
+        else:
+            print(f"{entry['size']:>8}  {entry['name']}")
+    return 0
+
+
+async def remove_file(client, path):
+    resp = await file_result(client.rm(path))
+    if not resp.get("ok"):
+        print(f"({resp.get('error')})")
+        return 1
+    return 0
+
+
+def remote_path(remote_dir, name):
+    """Device path of ``name`` (relative, with / separators) under remote_dir."""
+    return name if remote_dir in ("", ".") else remote_dir.rstrip("/") + "/" + name
+
+
+def local_manifest(root):
+    """{relative path: [size, crc32]} of the files under root, skipping dotfiles and __pycache__."""
+    from pathlib import Path
+
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".") and d != "__pycache__"]
+        for name in filenames:
+            if name.startswith("."):
+                continue
+            path = Path(dirpath, name)
+            data = path.read_bytes()
+            files[path.relative_to(root).as_posix()] = [len(data), zlib.crc32(data)]
+    return files
+
+
+def manifest_digest(files):
+    """CRC-32 over "size crc path" lines in the device's walk order, as the manifest helper computes it."""
+    digest = 0
+    for name in sorted(files, key=lambda n: n.split("/")):
+        size, crc = files[name]
+        digest = zlib.crc32(f"{size} {crc} {name}\n".encode(), digest)
+    return digest
+
+
+async def sync_dir(client, local_dir, remote_dir):
+    """Make remote_dir match local_dir, sending only files whose size or CRC differ.
+
+    Files deleted locally since the last sync are removed from the device;
+    other files already on the device are left alone. Returns the exit status.
+    """
+    from pathlib import Path
+
+    root = Path(local_dir)
+    cache_path = root / SYNC_MANIFEST
+    try:
+        cache = json.loads(cache_path.read_text())
+    except (OSError, ValueError):
+        cache = {}
+    if cache.get("remote") != remote_dir:
+        cache = {}
+    resp = await file_result(client.manifest(remote_dir, cache.get("digest")))
+    if not resp.get("ok"):
+        print(f"({resp.get('error')})")
+        return 1
+    if resp.get("unchanged"):
+        device = cache["files"]
+    else:
+        device = {e["name"]: [e["size"], e["crc"]] for e in resp.get("entries", [])}
+    # What each local file becomes on the device: itself, or name.mpy bytecode
+    uploads = {}  # device name -> (file to send, local source, [size, crc])
+    shadowed = set()  # x.py sent as x.mpy: the device imports x.py first, so any copy must go
+    for name, stat in local_manifest(root).items():
+        path, target = upload_artifact(root / name, name, resp.get("mpy"))
+        if path != root / name:
+            data = path.read_bytes()
+            stat = [len(data), zlib.crc32(data)]
+        if target != name:
+            shadowed.add(name)
+        uploads[target] = (path, root / name, stat)
+    changed = [name for name in sorted(uploads) if device.get(name) != uploads[name][2]]
+    # Includes x.py replaced by x.mpy (or the reverse) after a compiler change
+    removed = sorted(name for name in shadowed | set(cache.get("deployed", []))
+                     if name not in uploads and name in device)
+    status = 0
+    try:
+        for name in changed:
+            path, source, stat = uploads[name]
+            status = await push_file(client, str(path), remote_path(remote_dir, name), source=str(source))
+            if status:
+                return status
+            device[name] = stat
+        for name in removed:
+            status = await remove_file(client, remote_path(remote_dir, name))
+            if status:
+                return status
+            del device[name]
+    finally:
+        # Record what is on the device now, even after a failure part way
+        deployed = (set(cache.get("deployed", [])) | set(uploads)) & set(device)
+        cache_path.write_text(json.dumps({"remote": remote_dir, "digest": manifest_digest(device),
+                                          "files": device, "deployed": sorted(deployed)}, indent=1))
+    print(f"sync: {len(changed)} sent, {len(removed)} removed, {len(uploads) - len(changed)} unchanged")
+    return status
+
+
+async def run_file_command(client, command, args):
+    """push LOCAL [REMOTE], pull REMOTE [LOCAL], ls [PATH], rm PATH, sync DIR [REMOTE]."""
+    if command == "push" and args:
+        return await upload_file(client, args[0], args[1] if len(args) > 1 else os.path.basename(args[0]))
+    if command == "pull" and args:
+        return await pull_file(client, args[0], args[1] if len(args) > 1 else os.path.basename(args[0]))
+    if command == "ls":
+        return await list_files(client, args[0] if args else "/")
+    if command == "rm" and args:
+        return await remove_file(client, args[0])
+    if command == "sync" and args and os.path.isdir(args[0]):
+        return await sync_dir(client, args[0], args[1] if len(args) > 1 else "/")
+    print("Usage: monocle-cli push LOCAL [REMOTE] | pull REMOTE [LOCAL] | ls [PATH] | rm PATH | sync DIR [REMOTE]")
+    return 2
+
+
+class WavWriter:
+    """``write`` signed PCM from the microphone into a mono WAV file."""
+
+    def __init__(self, path, sample_rate, bit_depth):
+        import wave
+
+        self.wav = wave.open(path, "wb")
+        self.wav.setnchannels(1)
+        self.wav.setsampwidth(bit_depth // 8)
+        self.wav.setframerate(sample_rate)
+        self.bit_depth = bit_depth
+
+    def write(self, data):
+        self.wav.writeframesraw(data.translate(_PCM8_TO_WAV) if self.bit_depth == 8 else data)
+
+    def close(self):
+        self.wav.close()  # fills in the header's sizes
+
+
+async def capture_data(client, command, args):
+    """capture [FILE], record SECONDS [FILE] [--rate HZ] [--bits 8|16]; no FILE (or -) is stdout.
+
+    Bytes are written as they arrive over the raw data channel. A recording
+    to a .wav file gets a WAV header; otherwise it is raw signed PCM.
+    """
+    args = list(args)
+    options = {"--rate": DEFAULT_SAMPLE_RATE, "--bits": DEFAULT_BIT_DEPTH}
+    try:
+        for name in options:
+            if name in args:
+                at = args.index(name)
+                options[name] = int(args[at + 1])
+                del args[at:at + 2]
+        seconds = float(args.pop(0)) if command == "record" else None
+    except (ValueError, IndexError):
+        args = None
+    if args is None or len(args) > 1 or options["--bits"] not in (8, 16):
+        print("Usage: monocle-cli capture [FILE] | record SECONDS [FILE] [--rate HZ] [--bits 8|16]")
+        return 2
+    target = args[0] if args else "-"
+    to_stdout = target == "-"
+    if command == "record" and target.endswith(".wav"):
+        out = WavWriter(target, options["--rate"], options["--bits"])
+    else:
+        out = sys.stdout.buffer if to_stdout else open(target, "wb")
+    try:
+        if command == "capture":
+            resp = await file_result(client.capture(out))
+        else:
+            resp = await file_result(client.record(seconds, out, options["--rate"], options["--bits"]))
+    finally:
+        if to_stdout:
+            out.flush()
+        else:
+            out.close()
+    # Messages stay out of the data when it goes to stdout
+    report = sys.stderr if to_stdout else sys.stdout
+    if not resp.get("ok"):
+        print(f"({command} failed: {resp.get('error')})", file=report)
+        return 1
+    print(f"{resp.get('source')} -> {'stdout' if to_stdout else target}: {transfer_summary(resp)}", file=report)
+    return 0
+
+
+def load_frame(path, cell):
+    """A display frame from a .json file (see monocle_display.parse_frame) or an image."""
+    if path.endswith(".json"):
+        with open(path) as f:
+            return parse_frame(json.load(f))
+    return rasterize(*read_image(path), cell=cell)
+
+
+def stdin_frames(loop):
+    """An asyncio.Queue of the frames on stdin, one JSON line each, then None.
+
+    Read on a daemon thread, so a failed show does not wait for more input.
+    """
+    frames = asyncio.Queue()
+
+    def read():
+        for line in sys.stdin:
+            if line.strip():
+                loop.call_soon_threadsafe(frames.put_nowait, line)
+        loop.call_soon_threadsafe(frames.put_nowait, None)
+
+    threading.Thread(target=read, name="stdin-frames", daemon=True).start()
+    return frames
+
+
+async def show_frames(client, args):
+    """show FILE... [--cell PX]; show - reads frames from stdin, one JSON object per line.
+
+    Each file is one frame: an image, or a .json frame. Only what changed
+    since the last frame goes to the device. From stdin, frames that arrive
+    while the link is busy are skipped in favour of the latest one.
+    """
+    args = list(args)
+    cell = RASTER_CELL
+    try:
+        if "--cell" in args:
+            at = args.index("--cell")
+            cell = int(args[at + 1])
+            del args[at:at + 2]
+    except (ValueError, IndexError):
+        args = []
+    if not args or cell < 1:
+        print("Usage: monocle-cli show FILE... [--cell PX] | show -  (JSON frames on stdin)")
+        return 2
+    display = Display(client)
+    skipped = 0
+    start = time.perf_counter()
+    try:
+        for source in args:
+            if source != "-":
+                try:
+                    frame = load_frame(source, cell)
+                except (OSError, ValueError) as e:
+                    print(f"(show failed: {e})")
+                    return 1
+                if not await display.show(frame):
+                    skipped += 1
+                continue
+            frames = stdin_frames(asyncio.get_running_loop())
+            ended = False
+            while not ended:
+                lines = [await frames.get()]
+                while not frames.empty():
+                    lines.append(frames.get_nowait())
+                ended = lines[-1] is None
+                lines = [line for line in lines if line is not None]
+                if not lines:
+                    break
+                # If the link fell behind, only the latest frame matters
+                skipped += len(lines) - 1
+                try:
+                    frame = parse_frame(json.loads(lines[-1]))
+                except ValueError as e:
+                    print(f"(skipping a frame: {e})", file=sys.stderr)
+                    skipped += 1
+                    continue
+                if not await display.show(frame):
+                    skipped += 1
+        await display.flush()
+    except (MonocleError, asyncio.TimeoutError) as e:
+        print(f"(show failed: {str(e) or 'timeout'})")
+        return 1
+    elapsed = time.perf_counter() - start
+    print(f"show: {display.frames} frames in {elapsed:.2f} s ({display.frames / elapsed:.1f} fps), "
+          f"{display.bytes} bytes of code, {skipped} skipped", file=sys.stderr)
+    return 0
+
+
+async def watch_expr(client, args):
+    """watch EXPR [--interval S] [--count N]: print EXPR's value each time it changes.
+
+    Runs until Ctrl-C, or until N values have been printed. The relay polls
+    EXPR once for every client watching it at the same interval.
+    """
+    args = list(args)
+    options = {"--interval": 1.0, "--count": None}
+    try:
+        for name in options:
+            if name in args:
+                at = args.index(name)
+                options[name] = float(args[at + 1]) if name == "--interval" else int(args[at + 1])
+                del args[at:at + 2]
+    except (ValueError, IndexError):
+        args = []
+    if not args:
+        print("Usage: monocle-cli watch EXPR [--interval SECONDS] [--count N]")
+        return 2
+    count = 0
+    try:
+        # aclosing: leaving the loop early unwatches before the client closes
+        async with contextlib.aclosing(client.watch(" ".join(args), options["--interval"])) as values:
+            async for reply in values:
+                stamp = time.strftime("%H:%M:%S", time.localtime(reply["at"] / 1000))
+                print(f"{stamp} {reply.get('data', '')}", flush=True)
+                count += 1
+                if count == options["--count"]:
+                    break
+    except MonocleError as e:
+        print(f"(watch failed: {e})")
+        return 1
+    except asyncio.TimeoutError:
+        print("(timeout)")
+        return 1
+    return 0
+
+
+class DaemonLink:
+    """Line-delimited JSON link to a running ``monocle-cli daemon``.
+
+    Quacks like a RelayLink (``send``, ``recv`` and async iteration over
+    text frames), so a MonocleClient runs the commands unchanged over it.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    async def send(self, message):
+        self.writer.write(message.encode() + b"\n")
+        await self.writer.drain()
+
+    async def recv(self):
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionResetError("daemon closed the connection")
+        return line.decode()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        line = await self.reader.readline()
+        if not line:
+            raise StopAsyncIteration
+        return line.decode()
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+async def open_daemon_link():
+    """Connect to the daemon's Unix socket, or return None if no daemon is running."""
+    if not os.path.exists(SOCKET_PATH):
+        return None
+    try:
+        reader, writer = await asyncio.open_unix_connection(SOCKET_PATH)
+    except OSError:
+        return None  # stale socket file left by a daemon that died
+    return DaemonLink(reader, writer)
+
+
+async def run_command(client):
+    """Run the command named in ``sys.argv``; Ctrl-C interrupts it on the bridge."""
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGINT, handle_sigint, client, asyncio.current_task())
+    try:
+        status = await dispatch_command(client)
+    except asyncio.CancelledError:
+        if not interrupt_sent:
+            raise
+        return INTERRUPTED_STATUS
+    finally:
+        loop.remove_signal_handler(signal.SIGINT)
+    return INTERRUPTED_STATUS if interrupt_sent else status
+
+
+async def dispatch_command(client):
+    """Run the command named in ``sys.argv`` with ``client``."""
+    if len(sys.argv) < 2 or sys.argv[1] == "connect":
+        try:
+            # --fresh reconnects even if the link is up
+            resp = await asyncio.wait_for(client.connect_device(fresh="--fresh" in sys.argv[2:]), timeout=15)
+        except MonocleError as e:
+            resp = e.reply
+        except asyncio.TimeoutError:
+            resp = {"error": "timeout"}
+        if resp.get("ok"):
+            reused = resp.get("cached") or resp.get("reused")
+            print("Connected to Monocle" + (" (already connected)" if reused else ""))
+            return 0
+        if resp.get("error"):
+            print(f"({resp['error']})")
+        print("Connection failed. Ensure bridge page is open and you selected the Monocle.")
+        return 1
+
+    if sys.argv[1] == "status":
+        resp = await asyncio.wait_for(client.status(), timeout=5)
+        print(link_summary(resp))
+        return 0 if resp.get("connected") else 1
+
+    if sys.argv[1] == "devices":
+        devices = await asyncio.wait_for(client.devices(), timeout=5)
+        for device in devices:
+            print(device_summary(device))
+        if not devices:
+            print("No bridge page connected to the server")
+        return 0 if devices else 1
+
+    if sys.argv[1] == "batch":
+        snippets = sys.argv[2:] or split_snippets(sys.stdin.read())
+        return await run_batch(client, snippets)
+
+    if sys.argv[1] in ("push", "pull", "ls", "rm", "sync"):
+        return await run_file_command(client, sys.argv[1], sys.argv[2:])
+
+    if sys.argv[1] in ("capture", "record"):
+        return await capture_data(client, sys.argv[1], sys.argv[2:])
+
+    if sys.argv[1] == "watch":
+        return await watch_expr(client, sys.argv[2:])
+
+    if sys.argv[1] == "show":
+        return await show_frames(client, sys.argv[2:])
+
+    if sys.argv[1] == "repl" and len(sys.argv) > 2:
+        code = " ".join(sys.argv[2:])
+    elif sys.argv[1] == "repl":
+        code = sys.stdin.read()
+    else:
+        code = " ".join(sys.argv[1:])
+    return await run_repl(client, code)
+
+
+async def daemon():
+    """Hold one registered websocket open and serve CLI commands on SOCKET_PATH.
+
+    Each local connection speaks the same JSON frames as the websocket, one
+    per line. Request IDs are rewritten to daemon-wide IDs on the way out and
+    restored on the way back, so local clients can number requests freely.
+    """
+    routes = {}  # daemon request id -> (local writer or None once it left, client's request id)
+    locals_ = set()
+    request_ids = itertools.count(1)
+
+    async def handle_local(reader, writer):
+        locals_.add(writer)
+        try:
+            async for line in reader:
+                frame = json.loads(line)
+                if frame.get("type") in ("interrupt", "unwatch"):
+                    # All local clients share this link's client ID: name the
+                    # requests to stop by their daemon-wide IDs
+                    ids = frame.get("ids")
+                    frame["ids"] = [r for r, (w, client_rid) in routes.items()
+                                    if w is writer and (ids is None or client_rid in ids)]
+                rid = next(request_ids)
+                routes[rid] = (writer, frame.get("id"))
+                frame["id"] = rid
+                await ws.send(json.dumps(frame))
+        except (ConnectionError, json.JSONDecodeError):
+            pass
+        finally:
+            locals_.discard(writer)
+            left = [r for r, (w, _) in routes.items() if w is writer]
+            for rid in left:
+                # Kept until the final reply, so the id is not taken for someone else's request
+                routes[rid] = (None, routes[rid][1])
+            if left:
+                # The relay would go on polling for watches this client left behind
+                rid = next(request_ids)
+                routes[rid] = (None, None)
+                with contextlib.suppress(ConnectionError):
+                    await ws.send(json.dumps({"id": rid, "type": "unwatch", "ids": left}))
+            writer.close()
+
+    ws = RelayLink()
+    try:
+        reg = await ws.open()
         if reg.get("type") != "registered":
             print("Unexpected:", reg)
             return
 
-        async def recv_loop():
+        if os.path.exists(SOCKET_PATH):
+            os.unlink(SOCKET_PATH)
+        server = await asyncio.start_unix_server(handle_local, SOCKET_PATH)
+        print(f"monocle-cli daemon listening on {SOCKET_PATH}", flush=True)
+        try:
             async for msg in ws:
-                data = json.loads(msg)
-                await pending.put(data)
-
-        recv_task = asyncio.create_task(recv_loop())
-
-        if len(sys.argv) < 2 or sys.argv[1] == "connect":
-            await ws.send(json.dumps({"type": "connect"}))
-            resp = await asyncio.wait_for(pending.get(), timeout=15)
-            if resp.get("ok"):
-                print("Connected to Monocle")
-            else:
-                print("Connection failed. Ensure bridge page is open and you selected the Monocle.")
-            recv_task.cancel()
-            return
+                data = decode_frame(msg)
+                if data.get("id") is None:
+                    # About a bridge page: every local client may be waiting on it
+                    targets = list(locals_)
+                    if data.get("type") == "bridge_gone":
+                        for rid in [r for r, (w, _) in routes.items() if w is None]:
+                            del routes[rid]  # no final reply will come for these
+                elif data["id"] in routes:
+                    writer, client_rid = routes[data["id"]]
+                    if data.get("type") in FINAL_TYPES or data.get("type") == "bridge_gone":
+                        del routes[data["id"]]
+                    data["id"] = client_rid
+                    targets = [writer] if writer is not None else []
+                else:
+                    continue  # a reply to a request already finished
+                if isinstance(data.get("data"), bytes):
+                    data["data"] = base64.b64encode(data["data"]).decode()  # file_data frames
+                line = json.dumps(data).encode() + b"\n"
+                for writer in targets:
+                    writer.write(line)
+        finally:
+            server.close()
+            if os.path.exists(SOCKET_PATH):
+                os.unlink(SOCKET_PATH)
+    finally:
+        await ws.close()
+
+
+def ws_client_for(command):
+    """The WebSocket client ``command`` connects with (see QUICK_COMMANDS); None for the default."""
+    return "builtin" if WS_CLIENT == "auto" and command in QUICK_COMMANDS else None
+
+
+async def cli():
+    if len(sys.argv) > 1 and sys.argv[1] == "daemon":
+        await daemon()
+        return
+
+    # A running daemon holds the registered connection; else open our own
+    client = MonocleClient(device=DEVICE, priority=PRIORITY, link=await open_daemon_link(),
+                           ws_client=ws_client_for(sys.argv[1] if len(sys.argv) > 1 else "connect"))
+    try:
+        await client.connect()
+        return await run_command(client)
+    finally:
+        await client.close()
+
 
-        if sys.argv[1] == "repl" and len(sys.argv) > 2:
-            code = " ".join(sys.argv[2:])
-        elif sys.argv[1] == "repl":
-            code = sys.stdin.read()
+def take_target_options(argv):
+    """Strip ``--device NAME`` and ``--all`` from the front of ``argv``; return (device, all)."""
+    device, every = None, False
+    while len(argv) > 1 and argv[1] in ("--device", "--all"):
+        if argv[1] == "--all":
+            every = True
+            del argv[1]
+        elif len(argv) > 2:
+            device = argv[2]
+            del argv[1:3]
         else:
-            code = " ".join(sys.argv[1:])
+            break
+    return device, every
 
-        await ws.send(json.dumps({"type": "repl", "code": code}))
-        try:
-            resp = await asyncio.wait_for(pending.get(), timeout=10)
-            if resp.get("type") == "repl_response":
-                print(resp.get("data", ""))
-        except asyncio.TimeoutError:
-            print("(timeout)")
-        recv_task.cancel()
+
+async def run_on_all(argv):
+    """Run the command in ``argv`` on every Monocle at once, one CLI process per device.
+
+    Each line of output is prefixed with ``[device]``; stdin (for ``repl``
+    or ``batch`` without arguments) is read once and given to each. Returns
+    the highest exit status.
+    """
+    async with MonocleClient(ws_client=ws_client_for("devices")) as client:
+        devices = await asyncio.wait_for(client.devices(), timeout=5)
+    targets = [d.get("id") or d.get("device") for d in devices]
+    if not targets:
+        print("No bridge page connected to the server")
+        return 1
+    if None in targets:
+        print("(skipping a bridge page with no device id; open it with ?device=NAME)", file=sys.stderr)
+        targets = [t for t in targets if t is not None]
+    reads_stdin = len(argv) == 1 and argv[0] in ("repl", "batch")
+    stdin = sys.stdin.buffer.read() if reads_stdin else None
+
+    async def run(target):
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), "--device", target, *argv,
+            stdin=asyncio.subprocess.PIPE if reads_stdin else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+        )
+        if reads_stdin:
+            proc.stdin.write(stdin)
+            proc.stdin.close()
+        async for line in proc.stdout:
+            text = line.decode(errors="replace")
+            sys.stdout.write(f"[{target}] {text}" + ("" if text.endswith("\n") else "\n"))
+            sys.stdout.flush()
+        return await proc.wait()
+
+    statuses = await asyncio.gather(*(run(t) for t in targets))
+    return max(statuses)
 
 
 def main():
+    global DEVICE
+    device, every = take_target_options(sys.argv)
+    DEVICE = device or DEVICE
+    if WS_CLIENT not in WS_CLIENTS:
+        print(f"MONOCLE_WS_CLIENT must be one of: {', '.join(WS_CLIENTS)}")
+        sys.exit(1)
     try:
-        asyncio.run(cli())
-    except websockets.exceptions.InvalidStatusCode as e:
+        status = asyncio.run(run_on_all(sys.argv[1:] or ["connect"]) if every else cli())
+    except ws_exceptions("InvalidStatus", "InvalidStatusCode"):
         print("Cannot connect to bridge. Is the server running? Open http://127.0.0.1:8765 in Chrome.")
         sys.exit(1)
+    except ModuleNotFoundError as e:
+        if e.name != "websockets":
+            raise
+        print("Install: pip install websockets (or set MONOCLE_WS_CLIENT=builtin)")
+        sys.exit(1)
     except ConnectionRefusedError:
         print("Bridge not running. Start with: python3 server.py")
         sys.exit(1)
+    except ConnectionError as e:
+        print(f"({e})")
+        sys.exit(1)
+    sys.exit(status or 0)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,574 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# monocle-bridge - Bridge for Brilliant Monocle (proot CLI → Web Bluetooth)
+# Copyright (C) 2025 actuallyrizzn
+"""
+Async Python client for the Monocle bridge relay.
+
+    from monocle_client import MonocleClient
+
+    async with MonocleClient() as client:
+        print(await client.repl("1+1"))
+        async for text in client.stream("for i in range(3): print(i)"):
+            print(text, end="")
+        print(await client.batch(["a = 3", "a * 2"]))
+
+One registered connection carries any number of concurrent requests, up
+to ``max_in_flight``; it is resumed if it drops (see RelayLink). Each
+request is a Call: iterate it for its replies, or await it for the final
+one. monocle-cli.py is a command-line wrapper over this module.
+"""
+import asyncio
+import base64
+import collections
+import contextlib
+import itertools
+import json
+import os
+import struct
+import sys
+import time
+
+import monocle_ws
+
+WS_URL = os.environ.get("MONOCLE_WS_URL") or "ws://127.0.0.1:8766"
+# "none" turns off permessage-deflate to the relay (see server.py WS_COMPRESSION)
+WS_COMPRESSION = None if os.environ.get("MONOCLE_WS_COMPRESSION") == "none" else "deflate"
+# WebSocket client for the relay link: "websockets", or "builtin" (monocle_ws:
+# no websockets import, which is most of a short command's start-up, but no
+# compression either). "auto" uses websockets when it is installed;
+# monocle-cli uses the built-in one for its quick commands.
+WS_CLIENTS = ("auto", "builtin", "websockets")
+WS_CLIENT = os.environ.get("MONOCLE_WS_CLIENT", "auto")
+# Reply types that end a request.
+# "status" and "devices" come from the relay itself (see server._answer_locally).
+FINAL_TYPES = {"connected", "repl_response", "repl_batch_done", "repl_done", "file_done", "file_list",
+               "file_manifest", "data_done", "interrupted", "watch_done", "unwatched", "status", "devices"}
+# Requests sent but not finally answered, per client; more wait for a slot
+MAX_IN_FLIGHT = 64
+# How long to wait for the device to start answering before the bridge has
+# reported a link RTO; afterwards derived from it (see MonocleClient.start_timeout)
+DEFAULT_START_TIMEOUT = 10
+
+# Binary frames (negotiated: the bridge lists "binary" in its features):
+# a fixed header, then the raw payload, so bulk data skips JSON escaping.
+FRAME_HEADER = struct.Struct("!BBHIII")  # kind, flags, reserved, client, request id, seq
+FRAME_REPL_CHUNK = 1  # bridge -> CLI: streamed output
+FRAME_REPL_CODE = 2  # CLI -> bridge: code to run
+FRAME_FILE_PUSH = 3  # CLI -> bridge: path, NUL, file contents
+FRAME_FILE_DATA = 4  # bridge -> CLI: the next chunk of a pulled file
+FRAME_DATA = 5  # bridge -> CLI: the next bytes from the raw data channel (data_capture)
+FLAG_STREAM = 1
+# Code at least this long is uploaded as a binary frame when the bridge allows it
+BINARY_CODE_THRESHOLD = 512
+
+# A dropped relay connection is resumed (see RelayLink): the first retry
+# after RECONNECT_DELAY, doubling up to RECONNECT_MAX_DELAY, for as long as
+# the relay keeps the session (server.py SESSION_TTL)
+RECONNECT_DELAY = 0.05
+RECONNECT_MAX_DELAY = 2.0
+RESUME_WINDOW = float(os.environ.get("MONOCLE_SESSION_TTL", 30))
+REPLAY_FRAMES = 1024  # sent frames kept to replay after a resume
+
+
+class MonocleError(Exception):
+    """A request failed; ``reply`` is the final frame that said so."""
+
+    def __init__(self, message, reply=None):
+        super().__init__(message)
+        self.reply = reply or {}
+
+
+def ws_exceptions(*names):
+    """The exception classes called ``names`` in monocle_ws and, once it is loaded, websockets.
+
+    websockets is imported only when a link uses it, so except clauses
+    look its classes up with this when an error reaches them.
+    """
+    modules = [monocle_ws, sys.modules.get("websockets.exceptions")]
+    return tuple(getattr(module, name) for module in modules if module for name in names if hasattr(module, name))
+
+
+def decode_frame(message):
+    """Turn a websocket message (JSON text or binary frame) into a frame dict."""
+    if isinstance(message, str):
+        return json.loads(message)
+    kind, flags, _, client, rid, seq = FRAME_HEADER.unpack_from(message)
+    payload = bytes(message[FRAME_HEADER.size:])
+    if kind == FRAME_REPL_CHUNK:
+        return {"type": "repl_chunk", "client": client, "id": rid, "seq": seq,
+                "data": payload.decode("utf-8", "replace")}
+    if kind == FRAME_FILE_DATA:
+        return {"type": "file_data", "client": client, "id": rid, "seq": seq, "data": payload}
+    if kind == FRAME_DATA:
+        return {"type": "data_chunk", "client": client, "id": rid, "seq": seq, "data": payload}
+    return {"type": "binary", "kind": kind, "flags": flags, "client": client, "id": rid,
+            "seq": seq, "payload": payload}
+
+
+class RelayLink:
+    """Websocket to the relay that survives drops by resuming its session.
+
+    Sends, receives and iterates like the websocket. If the connection
+    fails, it reconnects with backoff and resumes (see server.Session): the
+    relay replays the frames this side missed and this side replays its
+    own, so a command in progress carries on. ConnectionError if the
+    session cannot be resumed.
+    """
+
+    def __init__(self, url=None, ws_client=None):
+        self.url = url or WS_URL
+        self.ws_client = ws_client or WS_CLIENT
+        self.ws = None
+        self.session = None
+        self.sent = 0
+        self.received = 0
+        self.log = collections.deque(maxlen=REPLAY_FRAMES)  # (ordinal, frame) of the last frames sent
+        self.closed = False
+        self._lock = asyncio.Lock()
+
+    def _connect(self):
+        if self.ws_client != "builtin":
+            try:
+                import websockets
+            except ImportError:
+                if self.ws_client == "websockets":
+                    raise
+                self.ws_client = "builtin"
+            else:
+                return websockets.connect(self.url, ping_interval=20, ping_timeout=10, compression=WS_COMPRESSION)
+        return monocle_ws.connect(self.url)
+
+    async def open(self):
+        """Connect and register; returns the registration reply."""
+        self.ws = await self._connect()
+        await self.ws.send(json.dumps({"role": "cli", "resume": True}))
+        reg = json.loads(await self.ws.recv())
+        self.received = 1
+        self.session = reg.get("session")
+        return reg
+
+    async def _resume(self, failed):
+        async with self._lock:
+            if self.ws is not failed:
+                return  # resumed already by a concurrent send or recv
+            if self.session is None or self.closed:
+                raise ConnectionError("connection to the relay lost")
+            delay = RECONNECT_DELAY
+            deadline = time.monotonic() + RESUME_WINDOW
+            while True:
+                try:
+                    ws = await self._connect()
+                    await ws.send(json.dumps({"role": "cli", "session": self.session, "received": self.received}))
+                    reg = json.loads(await ws.recv())
+                    break
+                except (OSError, asyncio.TimeoutError, *ws_exceptions("WebSocketError", "WebSocketException")):
+                    if time.monotonic() + delay > deadline:
+                        raise ConnectionError("connection to the relay lost") from None
+                    await asyncio.sleep(delay)
+                    delay = min(2 * delay, RECONNECT_MAX_DELAY)
+            self.received += 1
+            missed = [frame for ordinal, frame in self.log if ordinal > reg.get("received", 0)]
+            if not reg.get("resumed") or len(missed) != self.sent - reg["received"]:
+                self.session = None
+                await ws.close()
+                raise ConnectionError("relay session lost")
+            self.ws = ws
+            for frame in missed:
+                await ws.send(frame)
+
+    async def send(self, message):
+        self.sent += 1
+        self.log.append((self.sent, message))
+        ws = self.ws
+        try:
+            await ws.send(message)
+        except ws_exceptions("ConnectionClosed"):
+            await self._resume(ws)  # replays this frame too
+
+    async def recv(self):
+        while True:
+            ws = self.ws
+            try:
+                message = await ws.recv()
+            except ws_exceptions("ConnectionClosed"):
+                if self.closed:
+                    raise
+                await self._resume(ws)
+                continue
+            self.received += 1
+            return message
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.recv()
+        except ws_exceptions("ConnectionClosed"):
+            raise StopAsyncIteration from None
+
+    async def close(self):
+        self.closed = True
+        if self.ws is not None:
+            await self.ws.close()
+
+
+class Call:
+    """One request in flight: its replies in order, the last one final.
+
+    ``async for reply in call`` yields every reply (progress, output, the
+    final frame); ``await call`` returns just the final one. The first
+    reply must come within ``timeout`` seconds (asyncio.TimeoutError).
+    After that there is no cap, because the bridge fails the request itself
+    if the device goes quiet; likewise while the bridge page is away.
+    """
+
+    def __init__(self, client, rid, device, timeout, slot):
+        self.client = client
+        self.id = rid
+        self.device = device
+        self.timeout = timeout
+        self.slot = slot  # holds one of the client's in-flight slots
+        self.final = None  # the final reply, once it has been read
+        self._replies = asyncio.Queue()
+        self._answered = False
+
+    def _deliver(self, reply):
+        self._replies.put_nowait(reply)
+
+    async def next(self):
+        """The next reply; None after the final one."""
+        if self.final is not None:
+            return None
+        try:
+            reply = await asyncio.wait_for(self._replies.get(), None if self._answered else self.timeout)
+        except BaseException:
+            self.client._finish(self)
+            raise
+        self._answered = True
+        if reply.get("type") in FINAL_TYPES or reply.get("type") == "bridge_gone":
+            self.final = reply
+        return reply
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        reply = await self.next()
+        if reply is None:
+            raise StopAsyncIteration
+        return reply
+
+    async def result(self):
+        """Skip to the final reply and return it."""
+        async for _ in self:
+            pass
+        return self.final
+
+    def __await__(self):
+        return self.result().__await__()
+
+
+class MonocleClient:
+    """Requests to the Monocle through the relay, over one shared connection.
+
+    ``device`` addresses one Monocle when several bridge pages are open;
+    ``priority`` is sent with every request (see the bridge's queues).
+    ``timeout`` fixes the wait for each request's first reply; by default
+    it follows the BLE link's RTO as the bridge reports it. ``link`` is an
+    already registered link to use instead of opening a RelayLink, and
+    ``ws_client`` picks the WebSocket client a RelayLink uses (WS_CLIENTS).
+    """
+
+    def __init__(self, url=None, *, device=None, priority=None, timeout=None,
+                 max_in_flight=MAX_IN_FLIGHT, link=None, ws_client=None):
+        self.url = url or WS_URL
+        self.ws_client = ws_client
+        self.device = device
+        self.priority = priority
+        self.timeout = timeout
+        self.link = link
+        self.features = set()  # of the bridge, from the registration reply
+        self.client_id = None
+        self.link_rto_ms = None  # latest RTO estimate of the BLE link, reported by the bridge
+        self._calls = {}  # request id -> Call
+        self._ids = itertools.count(1)
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._opening = asyncio.Lock()
+        self._reader = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def connect(self):
+        """Open and register the connection; requests do this themselves if needed."""
+        async with self._opening:
+            if self._reader is not None:
+                return
+            if self.link is None:
+                link = RelayLink(self.url, self.ws_client)
+                reg = await link.open()
+                if reg.get("type") != "registered":
+                    await link.close()
+                    raise ConnectionError(f"unexpected registration reply: {reg}")
+                self.link = link
+                self.features = set(reg.get("features", []))
+                self.client_id = reg.get("client")
+            self._reader = asyncio.create_task(self._read())
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        if self.link is not None:
+            await self.link.close()
+
+    def start_timeout(self):
+        """Seconds to wait for the first reply to a request.
+
+        The bridge fails a request itself once the device has been silent for
+        4 x RTO, so the client only needs that plus slack for the websocket hops.
+        """
+        if self.timeout is not None:
+            return self.timeout
+        if self.link_rto_ms is None:
+            return DEFAULT_START_TIMEOUT
+        return max(1.0, 4 * self.link_rto_ms / 1000) + 1.0
+
+    def binary_uploads(self):
+        """Whether code and pushed files may go to the bridge as binary frames.
+
+        Binary frames carry no priority or device, so with either set
+        everything goes as JSON.
+        """
+        return "binary" in self.features and self.priority is None and self.device is None
+
+    async def _read(self):
+        try:
+            async for message in self.link:
+                self._dispatch(decode_frame(message))
+            error = "connection to the relay closed"
+        except Exception as e:  # a lost link, or a frame that cannot be read: no reply may follow
+            error = str(e) or type(e).__name__
+        for call in list(self._calls.values()):
+            self._finish(call)
+            call._deliver({"type": "bridge_gone", "id": call.id, "error": error})
+
+    def _dispatch(self, reply):
+        if "rto_ms" in reply:
+            self.link_rto_ms = reply["rto_ms"]
+        call = self._calls.get(reply.get("id"))
+        if call is not None:
+            if reply.get("type") in FINAL_TYPES or reply.get("type") == "bridge_gone":
+                self._finish(call)
+            call._deliver(reply)
+        elif reply.get("type") in ("bridge_gone", "bridge_away") and reply.get("id") is None:
+            # About a bridge page: tell the calls that may be waiting on it
+            for call in list(self._calls.values()):
+                if reply.get("device") in (None, call.device) or call.device is None:
+                    if reply["type"] == "bridge_gone":
+                        self._finish(call)
+                    call._deliver(reply)
+
+    def _finish(self, call):
+        if self._calls.pop(call.id, None) is call and call.slot:
+            self._slots.release()
+
+    async def _start(self, device, slot):
+        await self.connect()
+        if slot:
+            await self._slots.acquire()
+        call = Call(self, next(self._ids), device, self.start_timeout(), slot)
+        self._calls[call.id] = call
+        return call
+
+    async def _send(self, call, message):
+        try:
+            await self.link.send(message)
+        except BaseException:
+            self._finish(call)
+            raise
+        return call
+
+    async def call(self, frame, device=None):
+        """Send request ``frame`` and return its Call; waits for a free slot first.
+
+        The ID, send time and device come first so the relay can time and
+        route the request from the frame head (see server.RelayMetrics).
+        """
+        device = device or self.device
+        interrupt = frame.get("type") == "interrupt"
+        call = await self._start(device, slot=not interrupt)
+        head = {"id": call.id, "sent_at": round(time.time() * 1000, 1)}
+        if device is not None:
+            head["device"] = device
+        if self.priority is not None and not interrupt:
+            frame = {**frame, "priority": self.priority}
+        return await self._send(call, json.dumps({**head, **frame}))
+
+    async def call_binary(self, kind, payload, flags=0):
+        """Send a binary request frame of ``kind`` and return its Call."""
+        call = await self._start(None, slot=True)
+        return await self._send(call, FRAME_HEADER.pack(kind, flags, 0, 0, call.id, 0) + payload)
+
+    async def _ok(self, call, progress=None, out=None):
+        """The call's final reply; MonocleError unless it says ok.
+
+        file_progress replies go to ``progress``, file_data and data_chunk to ``out.write``.
+        """
+        async for reply in call:
+            kind = reply.get("type")
+            if kind == "file_progress" and progress:
+                progress(reply)
+            elif kind in ("file_data", "data_chunk") and out is not None:
+                data = reply.get("data", b"")
+                out.write(base64.b64decode(data) if isinstance(data, str) else data)
+        reply = call.final
+        if not reply.get("ok"):
+            raise MonocleError(reply.get("error") or ("bridge disconnected" if reply.get("type") == "bridge_gone"
+                                                      else "request failed"), reply)
+        return reply
+
+    # Device requests
+
+    async def connect_device(self, fresh=False):
+        """Have the bridge connect to its Monocle (``fresh`` drops a live link first)."""
+        frame = {"type": "connect", "fresh": True} if fresh else {"type": "connect"}
+        reply = await (await self.call(frame))
+        if not reply.get("ok"):
+            raise MonocleError(reply.get("error") or "connection failed", reply)
+        return reply
+
+    async def status(self):
+        """The link state of the bridge requests go to, as the relay knows it."""
+        return await (await self.call({"type": "status"}))
+
+    async def devices(self):
+        """Every registered bridge page (see server.Bridge.summary)."""
+        return (await (await self.call({"type": "devices"}))).get("devices", [])
+
+    async def interrupt(self, ids=None):
+        """Stop this client's requests (only ``ids`` if given); returns the interrupted reply.
+
+        Sent ahead of everything queued, without waiting for a slot.
+        """
+        frame = {"type": "interrupt"} if ids is None else {"type": "interrupt", "ids": list(ids)}
+        return await (await self.call(frame))
+
+    async def repl(self, code):
+        """Run ``code`` and return its output once it finishes."""
+        reply = await (await self.call({"type": "repl", "code": code}))
+        if reply.get("type") == "bridge_gone":
+            raise MonocleError(reply.get("error") or "bridge disconnected", reply)
+        return reply.get("data", "")
+
+    async def run(self, code):
+        """Start ``code`` in streaming mode; returns its Call (repl_started, repl_chunk..., repl_done)."""
+        if self.binary_uploads() and len(code) >= BINARY_CODE_THRESHOLD:
+            return await self.call_binary(FRAME_REPL_CODE, code.encode(), FLAG_STREAM)
+        # Output comes back as binary frames when the bridge supports them
+        return await self.call({"type": "repl", "code": code, "stream": True, "binary": True})
+
+    async def stream(self, code):
+        """Run ``code``, yielding its output as the device produces it.
+
+        MonocleError at the end if the code raised (its traceback is in the
+        output) or the request failed.
+        """
+        async for reply in await self.run(code):
+            kind = reply.get("type")
+            if kind == "repl_chunk" or kind == "repl_response":
+                yield reply.get("data", "")
+            elif kind == "bridge_gone":
+                raise MonocleError(reply.get("error") or "bridge disconnected", reply)
+            elif kind == "repl_done" and not reply.get("ok"):
+                raise MonocleError(reply.get("error") or "code raised an exception", reply)
+
+    async def batch(self, snippets):
+        """Run ``snippets`` in one round trip; returns their outputs in order."""
+        results = []
+        async for reply in await self.call({"type": "repl_batch", "snippets": list(snippets)}):
+            if reply.get("type") == "repl_batch_result":
+                results.append(reply.get("data", ""))
+            elif reply.get("type") == "bridge_gone" or reply.get("error"):
+                error = MonocleError(reply.get("error") or "bridge disconnected", reply)
+                error.results = results
+                raise error
+        return results
+
+    # Files
+
+    async def push(self, remote, data, progress=None):
+        """Write bytes ``data`` to device path ``remote``; returns the file_done reply.
+
+        An interrupted push resumes from where it stopped when repeated.
+        ``progress`` is called with each file_progress reply.
+        """
+        if self.binary_uploads():
+            call = await self.call_binary(FRAME_FILE_PUSH, remote.encode() + b"\0" + data)
+        else:
+            call = await self.call({"type": "file_push", "path": remote, "data": base64.b64encode(data).decode()})
+        return await self._ok(call, progress)
+
+    async def pull(self, remote, out, offset=0, progress=None):
+        """Copy device file ``remote`` from byte ``offset`` into ``out`` (anything with write).
+
+        Returns the file_done reply; its ``size`` and ``crc`` are of the whole file.
+        """
+        call = await self.call({"type": "file_pull", "path": remote, "offset": offset, "binary": True})
+        return await self._ok(call, progress, out)
+
+    async def ls(self, path="/"):
+        """Entries of a device directory: dicts with name, size and dir."""
+        return (await self._ok(await self.call({"type": "file_ls", "path": path}))).get("entries", [])
+
+    async def rm(self, path):
+        """Delete a device file; returns the file_done reply."""
+        return await self._ok(await self.call({"type": "file_rm", "path": path}))
+
+    async def manifest(self, path="/", expect=None):
+        """The device's file_manifest reply for ``path`` (see sync in monocle-cli.py)."""
+        return await self._ok(await self.call({"type": "file_manifest", "path": path, "expect": expect}))
+
+    # Watches: the relay polls an expression once for all its watchers
+
+    async def watch(self, expr, interval=1.0):
+        """Yield the watch_value reply for ``expr`` each time its value changes.
+
+        The relay runs ``expr`` every ``interval`` seconds, once for every
+        client watching it on the same Monocle. Leaving the loop unwatches;
+        MonocleError if the watch ends with an error (the bridge left).
+        """
+        call = await self.call({"type": "watch", "expr": expr, "interval": interval})
+        try:
+            async for reply in call:
+                kind = reply.get("type")
+                if kind == "watch_value":
+                    yield reply
+                elif kind in ("watch_done", "bridge_gone") and not reply.get("ok"):
+                    raise MonocleError(reply.get("error") or "bridge disconnected", reply)
+        finally:
+            if call.final is None:
+                with contextlib.suppress(ConnectionError, MonocleError):
+                    await self.unwatch([call.id])
+
+    async def unwatch(self, ids=None):
+        """End this client's watches (only the requests ``ids`` if given); returns how many ended."""
+        frame = {"type": "unwatch"} if ids is None else {"type": "unwatch", "ids": list(ids)}
+        return (await (await self.call(frame))).get("count", 0)
+
+    # Raw data channel: bulk bytes on the Monocle's raw data BLE service, not the REPL
+
+    async def capture(self, out):
+        """Take a camera still and write the JPEG to ``out`` as it arrives; returns the data_done reply."""
+        call = await self.call({"type": "data_capture", "source": "camera", "binary": True})
+        return await self._ok(call, out=out)
+
+    async def record(self, seconds, out, sample_rate=8000, bit_depth=16):
+        """Record ``seconds`` of microphone audio into ``out`` as signed PCM; returns the data_done reply."""
+        call = await self.call({"type": "data_capture", "source": "microphone", "seconds": seconds,
+                                "sample_rate": sample_rate, "bit_depth": bit_depth, "binary": True})
+        return await self._ok(call, out=out)
@@ -0,0 +1,290 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# monocle-bridge - Bridge for Brilliant Monocle (proot CLI → Web Bluetooth)
+# Copyright (C) 2025 actuallyrizzn
+"""
+Host-driven frames for the Monocle's display, sent as deltas.
+
+    from monocle_client import MonocleClient
+    from monocle_display import Display
+
+    async with MonocleClient() as client:
+        display = Display(client)
+        for n in range(100):
+            await display.show({"title": ("Text", "HUD", 0, 0, 0xFFFFFF),
+                                "count": ("Text", str(n), 0, 50, 0x00FF00)})
+        await display.flush()
+
+A frame maps ids to primitives: the name of a constructor in the device's
+``display`` module, then its arguments (a trailing dict holds keyword
+arguments). Display remembers what the device holds and sends only the
+primitives that were added, changed or removed, as one line of code per
+frame, with a few frames in flight. Images become frames of filled
+rectangles (see rasterize and read_image).
+"""
+import collections
+import itertools
+import re
+
+from monocle_client import MonocleError
+
+WIDTH = 640
+HEIGHT = 400
+# Frames sent and not yet answered; the next show() waits for the oldest
+DISPLAY_IN_FLIGHT = 3
+# Images are drawn as rectangles of RASTER_CELL pixels, each color channel
+# reduced to RASTER_LEVELS values so that neighbouring cells merge
+RASTER_CELL = 8
+RASTER_LEVELS = 4
+# Short names the device runtime gives common constructors, to keep frames small
+ALIASES = {"Text": "_T", "Rectangle": "_R", "Line": "_L", "HLine": "_H", "VLine": "_V",
+           "Fill": "_P", "Polygon": "_G", "Polyline": "_Y"}
+# Keyword values like "MIDDLE_CENTER" name constants of the display module
+_CONSTANT = re.compile(r"^[A-Z][A-Z0-9_]*$")
+
+# Installed with the first frame, and again after a failed one: _F(removed,
+# added) updates the primitives the device holds, keyed by small integers,
+# and shows them in key order (removed None: start from a blank display).
+RUNTIME = """import display
+_D = {}
+""" + "".join(f"{alias} = getattr(display, '{name}', None)\n" for name, alias in ALIASES.items()) + """
+def _F(r, a):
+    if r is None:
+        _D.clear()
+    else:
+        for k in r:
+            _D.pop(k, None)
+    _D.update(a)
+    if _D:
+        display.show(*[_D[k] for k in sorted(_D)])
+    else:
+        display.clear()
+"""
+
+
+def parse_frame(obj):
+    """A frame from decoded JSON: an object of id -> [name, args...], or a list of primitives."""
+    items = obj.items() if isinstance(obj, dict) else enumerate(obj)
+    frame = {}
+    for key, primitive in items:
+        if not isinstance(primitive, (list, tuple)) or not primitive or not isinstance(primitive[0], str):
+            raise ValueError(f"primitive {key!r}: expected [name, args...], got {primitive!r}")
+        frame[str(key)] = tuple(primitive)
+    return frame
+
+
+def primitive_code(primitive):
+    """Python source constructing ``primitive`` on the device."""
+    name, *args = primitive
+    kwargs = args.pop() if args and isinstance(args[-1], dict) else {}
+    if not name.isidentifier():
+        raise ValueError(f"not a display constructor: {name!r}")
+    parts = [repr(arg) for arg in args]
+    for key, value in kwargs.items():
+        if not isinstance(key, str) or not key.isidentifier():
+            raise ValueError(f"not a keyword argument: {key!r}")
+        parts.append(f"{key}=display.{value}" if isinstance(value, str) and _CONSTANT.match(value)
+                     else f"{key}={value!r}")
+    return f"{ALIASES.get(name) or 'display.' + name}({','.join(parts)})"
+
+
+def rasterize(width, height, pixels, cell=RASTER_CELL, levels=RASTER_LEVELS):
+    """A frame of filled rectangles approximating an RGB image.
+
+    ``pixels`` holds 3 bytes per pixel, row by row. The image is scaled to
+    fit the display and sampled once per ``cell`` pixels. Runs of one color
+    merge into one rectangle, across a row and then down identical rows;
+    black is left to the background.
+    """
+    scale = min(WIDTH / width, HEIGHT / height)
+    left = int((WIDTH - width * scale) / 2)
+    top = int((HEIGHT - height * scale) / 2)
+    cols = max(1, round(width * scale / cell))
+    rows = max(1, round(height * scale / cell))
+    step = 255 / (levels - 1)
+
+    def color(col, row):
+        x = min(width - 1, int((col + 0.5) * width / cols))
+        y = min(height - 1, int((row + 0.5) * height / rows))
+        i = 3 * (y * width + x)
+        r, g, b = (round(round(c / step) * step) for c in pixels[i:i + 3])
+        return r << 16 | g << 8 | b
+
+    def edge(index, count, origin, extent):
+        return origin + round(index * extent * scale / count)
+
+    frame = {}
+    open_runs = {}  # (first col, last col, color) -> first row, for runs still growing downwards
+
+    def close(run, first_row, end_row):
+        c0, c1, rgb = run
+        x1, y1 = edge(c0, cols, left, width), edge(first_row, rows, top, height)
+        frame[f"r{x1},{y1}"] = ("Rectangle", x1, y1, edge(c1 + 1, cols, left, width) - 1,
+                                edge(end_row, rows, top, height) - 1, rgb)
+
+    for row in range(rows):
+        runs = []
+        start = 0
+        colors = [color(col, row) for col in range(cols)]
+        for col in range(1, cols + 1):
+            if col == cols or colors[col] != colors[start]:
+                if colors[start]:
+                    runs.append((start, col - 1, colors[start]))
+                start = col
+        growing = {}
+        for run in runs:
+            growing[run] = open_runs.pop(run, row)
+        for run, first_row in open_runs.items():
+            close(run, first_row, row)
+        open_runs = growing
+    for run, first_row in open_runs.items():
+        close(run, first_row, rows)
+    return frame
+
+
+def _pnm_tokens(data):
+    """Header tokens of a PNM file and the offset of its binary data."""
+    tokens = []
+    i = 0
+    while len(tokens) < (3 if data[:2] in (b"P1", b"P4") else 4):
+        while data[i:i + 1].isspace() or data[i:i + 1] == b"#":
+            if data[i:i + 1] == b"#":
+                i = data.index(b"\n", i)
+            i += 1
+        start = i
+        while i < len(data) and not data[i:i + 1].isspace():
+            i += 1
+        tokens.append(data[start:i])
+    return tokens, i + 1
+
+
+def read_image(path):
+    """(width, height, RGB bytes) of an image file.
+
+    PBM, PGM and PPM files are read here; other formats need Pillow.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:1] != b"P" or data[1:2] not in b"123456":
+        try:
+            from PIL import Image
+        except ImportError:
+            raise ValueError(f"{path}: not a PBM/PGM/PPM file (install Pillow for other formats)") from None
+        with Image.open(path) as image:
+            rgb = image.convert("RGB")
+            return rgb.width, rgb.height, rgb.tobytes()
+    tokens, offset = _pnm_tokens(data)
+    kind = tokens[0]
+    width, height = int(tokens[1]), int(tokens[2])
+    maxval = int(tokens[3]) if len(tokens) > 3 else 1
+    count = width * height * (3 if kind in (b"P3", b"P6") else 1)
+    if kind == b"P4":
+        stride = (width + 7) // 8
+        bits = data[offset:offset + stride * height]
+        samples = [0 if bits[y * stride + x // 8] >> (7 - x % 8) & 1 else 1
+                   for y in range(len(bits) // stride) for x in range(width)]
+    elif kind in (b"P5", b"P6"):
+        size = 2 if maxval > 255 else 1
+        samples = data[offset:offset + count * size]
+        if size == 2:
+            samples, maxval = samples[::2], maxval >> 8  # the high bytes
+    else:
+        samples = [int(t) for t in data[offset:].split()[:count]]
+        if kind == b"P1":
+            samples = [1 - s for s in samples]  # 1 is black
+    if len(samples) < count:
+        raise ValueError(f"{path}: image data is truncated")
+    levels = bytes(round(s * 255 / maxval) for s in samples)
+    if kind in (b"P3", b"P6"):
+        return width, height, levels
+    return width, height, bytes(v for v in levels for _ in range(3))
+
+
+class Display:
+    """Sends frames to the display of ``client``'s Monocle, each as a delta.
+
+    ``frames`` and ``bytes`` count the frames sent and the code they took.
+    A frame the device failed to run makes the next one go whole.
+    """
+
+    def __init__(self, client, max_in_flight=DISPLAY_IN_FLIGHT):
+        self.client = client
+        self.max_in_flight = max_in_flight
+        self.frames = 0
+        self.bytes = 0
+        self._pending = collections.deque()  # Calls of the frames in flight
+        self.reset()
+
+    def reset(self):
+        """Forget what the device shows: the next frame reinstalls the runtime and is sent whole."""
+        self._installed = False
+        self._sent = None  # id -> primitive, as the device will hold it once the frames in flight have run
+        self._keys = {}  # id -> the device's key for it
+        self._next_key = itertools.count()
+
+    def delta_code(self, frame, whole=False):
+        """The code that turns the last frame into ``frame``, or None if nothing changed.
+
+        With ``whole``, the code redraws all of ``frame``. Updates what this
+        Display takes the device to hold.
+        """
+        frame = {str(key): tuple(primitive) for key, primitive in frame.items()}
+        if whole:
+            self._sent = None
+        added = {key: p for key, p in frame.items() if self._sent is None or self._sent.get(key) != p}
+        removed = None if self._sent is None else [key for key in self._sent if key not in frame]
+        if not added and not removed and self._sent is not None:
+            return None
+        if removed is None:
+            self._keys.clear()
+        removed_keys = [self._keys.pop(key) for key in removed or ()]
+        for key in added:
+            if key not in self._keys:
+                self._keys[key] = next(self._next_key)
+        entries = ",".join(f"{self._keys[key]}:{primitive_code(p)}" for key, p in added.items())
+        code = f"_F({'None' if removed is None else removed_keys},{{{entries}}})"
+        if not self._installed:
+            code = RUNTIME + code
+            self._installed = True
+        self._sent = frame
+        return code
+
+    async def show(self, frame, whole=False):
+        """Send the changes from the last frame to ``frame``; False if there were none.
+
+        ``whole`` sends all of it, as after something else drew on the
+        display. Returns once the frame is sent, waiting first if
+        ``max_in_flight`` frames are still running. MonocleError if an
+        earlier frame failed.
+        """
+        code = self.delta_code(frame, whole)
+        if code is None:
+            return False
+        while len(self._pending) >= self.max_in_flight:
+            await self._settle(self._pending.popleft())
+        try:
+            call = await self.client.call({"type": "repl", "code": code})
+        except BaseException:
+            self.reset()
+            raise
+        self._pending.append(call)
+        self.frames += 1
+        self.bytes += len(code)
+        return True
+
+    async def flush(self):
+        """Wait until every frame sent has run; MonocleError if one failed."""
+        while self._pending:
+            await self._settle(self._pending.popleft())
+
+    async def _settle(self, call):
+        try:
+            reply = await call
+        except BaseException:
+            self.reset()
+            raise
+        data = reply.get("data", "")
+        if reply.get("type") != "repl_response" or data.startswith("ERROR:") or "Traceback" in data:
+            self.reset()
+            # The last line of a traceback, or the bridge's error
+            lines = data.strip().splitlines()
+            raise MonocleError(reply.get("error") or (lines[-1] if lines else "bridge disconnected"), reply)
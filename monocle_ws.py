@@ -0,0 +1,216 @@
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# monocle-bridge - Bridge for Brilliant Monocle (proot CLI → Web Bluetooth)
+# Copyright (C) 2025 actuallyrizzn
+"""
+Minimal asyncio WebSocket client (RFC 6455), for a fast CLI start.
+
+Importing ``websockets`` costs more than the rest of a short monocle-cli
+command. This client covers what RelayLink needs of it against server.py
+and nothing else: ws:// URLs, text and binary messages, answering pings,
+the closing handshake. No extensions (so no permessage-deflate), no TLS,
+no keepalive pings of its own.
+
+    ws = await monocle_ws.connect("ws://127.0.0.1:8766")
+    await ws.send('{"role": "cli"}')
+    print(await ws.recv())
+    await ws.close()
+"""
+import asyncio
+import base64
+import hashlib
+import os
+import struct
+from urllib.parse import urlsplit
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+_ACCEPT_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+MAX_MESSAGE = 64 << 20  # bytes; a larger message closes the connection (1009)
+CLOSE_TIMEOUT = 2  # seconds to wait for the server's close frame
+
+
+class WebSocketError(Exception):
+    """The handshake failed or the server broke the protocol."""
+
+
+class InvalidStatus(WebSocketError):
+    """The server answered the handshake with ``status`` instead of 101."""
+
+    def __init__(self, status, reason=""):
+        super().__init__(f"server rejected WebSocket connection: HTTP {status} {reason}".rstrip())
+        self.status = status
+
+
+class ConnectionClosed(WebSocketError):
+    """The connection is closed; ``code`` is the close code received (1006: none)."""
+
+    def __init__(self, code=1006, reason=""):
+        super().__init__(f"connection closed ({code}{' ' + reason if reason else ''})")
+        self.code = code
+        self.reason = reason
+
+
+def _mask(data, key):
+    """``data`` XOR the 4-byte ``key`` repeated, as whole integers (fast for large frames)."""
+    n = len(data)
+    if not n:
+        return b""
+    keys = (key * (n // 4 + 1))[:n]
+    return (int.from_bytes(data, "big") ^ int.from_bytes(keys, "big")).to_bytes(n, "big")
+
+
+async def connect(url, *, open_timeout=10):
+    """Open a WebSocket to ``url`` (ws:// only); returns a WebSocket."""
+    parts = urlsplit(url)
+    if parts.scheme != "ws":
+        raise WebSocketError(f"unsupported URL (ws:// only): {url}")
+    host = parts.hostname or "127.0.0.1"
+    port = parts.port or 80
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), open_timeout)
+    key = base64.b64encode(os.urandom(16))
+    target = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+    netloc = host if port == 80 else f"{host}:{port}"
+    writer.write((f"GET {target} HTTP/1.1\r\nHost: {netloc}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                  f"Sec-WebSocket-Key: {key.decode()}\r\nSec-WebSocket-Version: 13\r\n\r\n").encode())
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), open_timeout)
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        writer.close()
+        raise WebSocketError("invalid handshake response") from None
+    status_line, *lines = head.decode("latin-1").split("\r\n")
+    fields = status_line.split(" ", 2)
+    headers = {}
+    for line in lines:
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if len(fields) < 2 or fields[1] != "101":
+        writer.close()
+        raise InvalidStatus(int(fields[1]) if len(fields) > 1 and fields[1].isdigit() else 0,
+                            fields[2] if len(fields) > 2 else "")
+    accept = base64.b64encode(hashlib.sha1(key + _ACCEPT_GUID).digest()).decode()
+    if headers.get("sec-websocket-accept") != accept:
+        writer.close()
+        raise WebSocketError("invalid Sec-WebSocket-Accept")
+    return WebSocket(reader, writer)
+
+
+class WebSocket:
+    """A client connection: ``send``, ``recv``, ``close`` and ``async for``, like ``websockets``'."""
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self.transport = writer.transport
+        self._closed = None  # ConnectionClosed, once closing has started
+        self.close_code = None
+
+    def _frame(self, opcode, payload):
+        key = os.urandom(4)
+        n = len(payload)
+        if n < 126:
+            head = struct.pack("!BB", 0x80 | opcode, 0x80 | n)
+        elif n < 1 << 16:
+            head = struct.pack("!BBH", 0x80 | opcode, 0x80 | 126, n)
+        else:
+            head = struct.pack("!BBQ", 0x80 | opcode, 0x80 | 127, n)
+        self._writer.write(head + key + _mask(payload, key))
+
+    async def send(self, message):
+        """Send a str as a text message, bytes as a binary one."""
+        if self._closed is not None:
+            raise self._closed
+        if isinstance(message, str):
+            self._frame(OP_TEXT, message.encode())
+        else:
+            self._frame(OP_BINARY, bytes(message))
+        try:
+            await self._writer.drain()
+        except (ConnectionError, OSError):
+            self._lost()
+            raise self._closed from None
+
+    async def _read_frame(self):
+        b0, b1 = await self._reader.readexactly(2)
+        n = b1 & 0x7F
+        if n == 126:
+            n = struct.unpack("!H", await self._reader.readexactly(2))[0]
+        elif n == 127:
+            n = struct.unpack("!Q", await self._reader.readexactly(8))[0]
+        if n > MAX_MESSAGE:
+            self._fail(1009, "message too big")
+        key = await self._reader.readexactly(4) if b1 & 0x80 else None
+        payload = await self._reader.readexactly(n)
+        return b0 & 0x80, b0 & 0x0F, _mask(payload, key) if key else payload
+
+    async def recv(self):
+        """The next message: str for text, bytes for binary. ConnectionClosed once closed."""
+        if self._closed is not None:
+            raise self._closed
+        parts = []
+        opcode = None
+        try:
+            while True:
+                fin, op, payload = await self._read_frame()
+                if op == OP_PING:
+                    self._frame(OP_PONG, payload)
+                    continue
+                if op == OP_PONG:
+                    continue
+                if op == OP_CLOSE:
+                    code = struct.unpack("!H", payload[:2])[0] if len(payload) >= 2 else 1005
+                    self._frame(OP_CLOSE, payload[:2])
+                    self._finish(code, payload[2:].decode("utf-8", "replace"))
+                    raise self._closed
+                if op != OP_CONTINUATION:
+                    opcode = op
+                parts.append(payload)
+                if sum(map(len, parts)) > MAX_MESSAGE:
+                    self._fail(1009, "message too big")
+                if fin:
+                    data = b"".join(parts)
+                    return data.decode() if opcode == OP_TEXT else data
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            self._lost()
+            raise self._closed from None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.recv()
+        except ConnectionClosed:
+            raise StopAsyncIteration from None
+
+    def _finish(self, code, reason=""):
+        if self._closed is None:
+            self.close_code = code
+            self._closed = ConnectionClosed(code, reason)
+        self._writer.close()
+
+    def _lost(self):
+        self._finish(1006)
+
+    def _fail(self, code, reason):
+        """Close with ``code`` for a message this side will not take; raises ConnectionClosed."""
+        self._frame(OP_CLOSE, struct.pack("!H", code))
+        self._finish(code, reason)
+        raise self._closed
+
+    async def close(self, code=1000):
+        """Close the connection, with the closing handshake if it is still open."""
+        if self._closed is None:
+            self._closed = ConnectionClosed(code)
+            self.close_code = code
+            try:
+                self._frame(OP_CLOSE, struct.pack("!H", code))
+                await self._writer.drain()
+                # The server answers with its own close frame, then closes the TCP connection
+                await asyncio.wait_for(self._reader.read(), CLOSE_TIMEOUT)
+            except (asyncio.TimeoutError, ConnectionError, OSError, RuntimeError):
+                pass  # RuntimeError: a cancelled recv() still holds the reader
+        self._writer.close()
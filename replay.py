@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# monocle-bridge - Bridge for Brilliant Monocle (proot CLI → Web Bluetooth)
+# Copyright (C) 2025 actuallyrizzn
+"""
+Replay a traffic capture through server.relay against simulated bridges.
+
+Record a session with the real phone, tab and device, then play its CLI
+side back offline as a repeatable benchmark:
+
+    MONOCLE_CAPTURE=session.cap python3 server.py   # record
+    python3 replay.py session.cap                     # as fast as the replies allow
+    python3 replay.py session.cap --speed 1 --json    # in real time
+
+Each CLI connection in the capture is opened again and sends its frames in
+order. A frame waits for the replies that had finished before it was sent,
+and with --speed also for its recorded time (scaled). The capture's bridge
+pages are replaced by one SimulatedBridge per device id they registered.
+Request latencies are reported next to the captured ones.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import sys
+import time
+
+try:
+    import websockets
+except ImportError:
+    print("Install: pip install websockets")
+    sys.exit(1)
+
+import server
+from bench import latency_stats
+from simulator import SimulatedBridge, SimulatedMonocle
+
+REPLAY_TIMEOUT = 30  # seconds to wait for a reply before going on without it
+
+
+class CapturedClient:
+    """The frames one CLI connection sent, and the replies each one waited for."""
+
+    def __init__(self, start):
+        self.start = start  # seconds into the capture
+        self.frames = []  # (seconds into the capture, frame, ids of requests finished since the last frame)
+        self.finished = []  # ids finished since the last frame sent
+        self.requests = {}  # request id -> when its first frame was sent
+        self.latencies = []  # captured request latencies, seconds
+        self.received = 0  # frames the relay sent it
+        self.end = start  # seconds into the capture of its last record
+
+
+def request_id(frame):
+    """The request id of a CLI frame, or None."""
+    if isinstance(frame, bytes):
+        return server.FRAME_HEADER.unpack_from(frame)[4] if len(frame) >= server.FRAME_HEADER.size else None
+    try:
+        return json.loads(frame).get("id")
+    except ValueError:
+        return None
+
+
+def load_capture(path):
+    """(CLI connections in the order they opened, device ids of the bridges) from a capture file."""
+    clients = {}  # connection -> CapturedClient
+    devices = set()
+    registered = set()  # bridge connections whose registration was seen
+    for at, conn, flags, frame in server.read_capture(path):
+        if not flags & server.CAPTURE_CLI:
+            if not flags & (server.CAPTURE_OUT | server.CAPTURE_CLOSED) and conn not in registered:
+                registered.add(conn)
+                devices.add(json.loads(frame).get("device"))
+            continue
+        client = clients.get(conn)
+        if client is None:
+            client = clients[conn] = CapturedClient(at)
+        client.end = at
+        if flags & server.CAPTURE_CLOSED:
+            client.frames.append((at, None, client.finished))
+            client.finished = []
+        elif not flags & server.CAPTURE_OUT:
+            rid = request_id(frame) if client.frames else None
+            if rid is not None and rid not in client.requests:
+                client.requests[rid] = at
+            client.frames.append((at, frame, client.finished))
+            client.finished = []
+        else:
+            client.received += 1
+            reply = json.loads(frame) if isinstance(frame, str) else {}
+            rid = reply.get("id")
+            if reply.get("type") in server.FINAL_TYPES and rid in client.requests:
+                client.finished.append(rid)
+                client.latencies.append(at - client.requests.pop(rid))
+    return list(clients.values()), devices or {None}
+
+
+def _fresh(frame, first):
+    """``frame`` as sent now: registration without a session to resume, requests restamped."""
+    if isinstance(frame, bytes):
+        return frame
+    data = json.loads(frame)
+    if first:
+        data.pop("session", None)
+        data.pop("received", None)
+    elif "sent_at" in data:
+        data["sent_at"] = round(time.time() * 1000, 1)
+    else:
+        return frame
+    return json.dumps(data)
+
+
+async def replay_client(url, client, origin, speed, stats):
+    """Play one captured CLI connection; adds its latencies and counts to ``stats``."""
+    loop = asyncio.get_running_loop()
+
+    async def pace(at):
+        if speed:
+            await asyncio.sleep(max(0.0, origin + at / speed - loop.time()))
+
+    await pace(client.start)
+    done = {}  # request id -> when its final reply arrived
+    arrived = asyncio.Event()
+    sent = {}  # request id -> when its first frame was sent
+
+    async def read(ws):
+        async for message in ws:
+            stats["frames"] += 1
+            if isinstance(message, bytes):
+                continue
+            reply = json.loads(message)
+            rid = reply.get("id")
+            if reply.get("type") in server.FINAL_TYPES and rid in sent and rid not in done:
+                done[rid] = loop.time()
+                stats["latencies"].append(done[rid] - sent[rid])
+                arrived.set()
+
+    async def finished(ids):
+        deadline = loop.time() + REPLAY_TIMEOUT
+        while any(rid not in done for rid in ids):
+            arrived.clear()
+            try:
+                await asyncio.wait_for(arrived.wait(), max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                stats["missing"] += sum(rid not in done for rid in ids)
+                return
+
+    async with websockets.connect(url, max_size=None) as ws:
+        reader = asyncio.create_task(read(ws))
+        for i, (at, frame, finished_before) in enumerate(client.frames):
+            await finished(finished_before)
+            await pace(at)
+            if frame is None:
+                break
+            rid = request_id(frame) if i else None
+            if rid is not None and rid not in sent:
+                sent[rid] = loop.time()
+                stats["requests"] += 1
+            await ws.send(_fresh(frame, i == 0))
+        else:
+            await finished(client.finished)
+        reader.cancel()
+        await asyncio.gather(reader, return_exceptions=True)
+
+
+@contextlib.asynccontextmanager
+async def simulated_relay(devices, args):
+    """The relay on an ephemeral port with a connected SimulatedBridge per device id; yields its URL."""
+    ws_server = await websockets.serve(server.relay, "127.0.0.1", 0, max_size=None)
+    url = f"ws://127.0.0.1:{ws_server.sockets[0].getsockname()[1]}"
+    try:
+        async with contextlib.AsyncExitStack() as stack:
+            for device_id in sorted(devices, key=str):
+                device = SimulatedMonocle(mtu=args.mtu, latency=args.latency / 1000,
+                                          notify_interval=args.notify_interval / 1000)
+                bridge = await stack.enter_async_context(SimulatedBridge(url, device, device_id=device_id))
+                bridge.connected = True
+            yield url
+    finally:
+        ws_server.close()
+        await ws_server.wait_closed()
+
+
+async def run_replay(args):
+    """Replay ``args.capture``; returns the captured and replayed request statistics."""
+    clients, devices = load_capture(args.capture)
+    captured = [s for client in clients for s in client.latencies]
+    stats = {"requests": 0, "missing": 0, "frames": 0, "latencies": []}
+    server.metrics = server.RelayMetrics()
+    async with simulated_relay(devices, args) as url:
+        start = time.perf_counter()
+        origin = asyncio.get_running_loop().time() - min((c.start for c in clients), default=0) / (args.speed or 1)
+        await asyncio.gather(*(replay_client(url, client, origin, args.speed, stats) for client in clients))
+        elapsed = time.perf_counter() - start
+    results = {"clients": len(clients), "devices": len(devices), "elapsed_s": round(elapsed, 3),
+               "sent": stats["requests"], "missing": stats["missing"]}
+    if captured:
+        span = max(c.end for c in clients) - min(c.start for c in clients)
+        results["captured"] = latency_stats(captured, sum(c.received for c in clients), span or 1)
+    if stats["latencies"]:
+        results["replayed"] = latency_stats(stats["latencies"], stats["frames"], elapsed)
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("capture", help="capture file written by server.py with MONOCLE_CAPTURE")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="replay at this multiple of the recorded pace (default 0: as fast as possible)")
+    parser.add_argument("--mtu", type=int, default=128, help="simulated BLE ATT MTU")
+    parser.add_argument("--latency", type=float, default=7.5, help="one-way BLE latency, ms")
+    parser.add_argument("--notify-interval", type=float, default=7.5, help="minimum gap between notifications, ms")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args(argv)
+    if args.speed < 0:
+        parser.error("--speed must not be negative")
+    return args
+
+
+def main():
+    args = parse_args()
+    results = asyncio.run(run_replay(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for key, value in results.items():
+        if isinstance(value, dict):
+            print(f"{key}:")
+            for name, stat in value.items():
+                print(f"  {name:<16} {stat}")
+        else:
+            print(f"{key:<18} {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,74 +7,1365 @@ Monocle Bridge Server - relays between CLI (proot) and Web Bluetooth (Chrome).
 Run in proot. Then open http://127.0.0.1:8765 in Chrome on the same Android device.
 """
 import asyncio
+import collections
+import gzip
+import hashlib
+import itertools
 import json
+import os
+import re
+import secrets
+import struct
 import sys
+import time
 from pathlib import Path
 
 try:
     import websockets
+    from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+    from websockets.frames import Opcode
 except ImportError:
     print("Install: pip install websockets")
     sys.exit(1)
 
 PORT = 8765
 BRIDGE_DIR = Path(__file__).resolve().parent
-bridge_ws = None
-cli_ws = None
+# URL path -> page asset served by http_handler
+STATIC_FILES = {"/": "bridge.html", "/bridge.html": "bridge.html"}
+METRICS_PATH = "/metrics"
+KEEPALIVE_TIMEOUT = 30  # seconds an idle keep-alive connection stays open
+_static_cache = {}  # file name -> {"mtime", "body", "gzip", "etag"}
+# One bridge page per Monocle, keyed by the device id it registered with
+# (None for a page that gave none). CLI requests are routed by _route.
+bridges = {}  # bridge id -> Bridge
+_bridge_order = itertools.count()
+cli_clients = {}  # client id -> CLI websocket
+cli_bridge = {}  # client id -> id of the bridge its requests without a device go to
+_client_ids = itertools.count(1)
+outboxes = {}  # websocket -> Outbox
+sessions = {}  # session id -> Session
+cli_sessions = {}  # client id -> Session
+polls = {}  # (bridge id, expression, interval) -> Poll
+_poll_ids = itertools.count(1)
+_poll_replies = {}  # request id of a poll in flight -> Future for its reply
+
+# A peer that registers with "resume" gets a Session: if its websocket drops
+# (Android backgrounding the tab, a flaky proxy), frames for it are held and
+# it may come back within SESSION_TTL seconds and pick up where it left off.
+# Each side keeps its last REPLAY_FRAMES / REPLAY_BYTES sent frames to replay.
+SESSION_TTL = float(os.environ.get("MONOCLE_SESSION_TTL", 30))
+REPLAY_FRAMES = int(os.environ.get("MONOCLE_REPLAY_FRAMES", 1024))
+REPLAY_BYTES = int(os.environ.get("MONOCLE_REPLAY_BYTES", 4 << 20))
+LEFT_CODES = (1000, 1001)  # close codes of a peer that left on purpose: its session ends
+
+# Each connection's outbound frames wait in a bounded Outbox drained by its
+# own writer task, so a slow reader only holds up frames addressed to it.
+# The policy applies when a CLI's queue is full; the bridge's queue always
+# blocks, since a dropped request would never be answered. One bridge's
+# frames for all its CLIs go through one relay loop, so a CLI queue never
+# makes it wait: where "block" or "merge" would, the CLI is disconnected
+# instead, and its session keeps the frames for it to resume.
+OUTBOX_POLICIES = ("block", "drop_oldest", "merge")
+OUTBOX_POLICY = os.environ.get("MONOCLE_OUTBOX_POLICY", "block")
+OUTBOX_FRAMES = int(os.environ.get("MONOCLE_OUTBOX_FRAMES", 256))
+OUTBOX_BYTES = int(os.environ.get("MONOCLE_OUTBOX_BYTES", 1 << 20))
+OUTBOX_CLOSE_TIMEOUT = 1.0  # seconds to let a closing connection's queue drain
+
+# WebSocket compression (permessage-deflate) when the peer offers it, as
+# Chrome and websockets clients do. Messages under WS_COMPRESS_MIN bytes go
+# out uncompressed: most frames are small requests and status replies, where
+# deflating costs more time than the bytes it saves. So do raw data channel
+# frames (camera JPEGs, microphone PCM), which hardly deflate at all.
+WS_COMPRESSION_POLICIES = ("deflate", "none")
+WS_COMPRESSION = os.environ.get("MONOCLE_WS_COMPRESSION", "deflate")
+WS_COMPRESS_MIN = int(os.environ.get("MONOCLE_WS_COMPRESS_MIN", 256))
+
+# Watches: CLIs subscribe to the value of an expression on their Monocle.
+# The relay runs one Poll per (bridge, expression, interval) and fans each
+# changed value out to every watcher, so device traffic grows with the
+# distinct queries, not the watchers. Polls reach the bridge as ordinary
+# repl requests from the reserved client id POLL_CLIENT.
+POLL_CLIENT = 0
+WATCH_MIN_INTERVAL = 0.1  # seconds between polls, at the least
+WATCH_POLL_TIMEOUT = 30  # seconds to wait for one poll's reply before the next
+
+# Traffic capture (MONOCLE_CAPTURE=path): every frame the relay receives or
+# sends, appended to a binary log that replay.py can play back. The file
+# starts with CAPTURE_MAGIC; each record is a CAPTURE_RECORD header, then
+# the frame (text as UTF-8). Gaps longer than the header holds (about 71
+# minutes) are shortened.
+CAPTURE_PATH = os.environ.get("MONOCLE_CAPTURE")
+CAPTURE_MAGIC = b"MONOCAP1"
+CAPTURE_RECORD = struct.Struct("!IBII")  # microseconds since the previous record, flags, connection, length
+CAPTURE_OUT = 1  # sent by the relay (else received)
+CAPTURE_CLI = 2  # a CLI connection (else a bridge page)
+CAPTURE_BINARY = 4  # a binary frame
+CAPTURE_CLOSED = 8  # the connection closed (no frame)
+CAPTURE_FLUSH_BYTES = 64 << 10
+CAPTURE_FLUSH_INTERVAL = 0.5  # seconds
+capture = None  # TrafficCapture while recording
+
+# Binary frames: fixed header, then payload. The client field sits at a fixed
+# offset so the relay can stamp and route binary frames without decoding them.
+FRAME_HEADER = struct.Struct("!BBHIII")  # kind, flags, reserved, client, request id, seq
+_FRAME_CLIENT = slice(4, 8)
+FRAME_DATA = 5  # bridge -> CLI: raw data channel bytes
+# Bridge frames written by bridge.html start with the client tag
+_CLIENT_TAG = re.compile(r'\{"client":(\d+)[,}]')
+# Heads of frames as the CLI and bridge write them, for timing without a parse
+_REQUEST_HEAD = re.compile(r'\{"id": ?(\d+)(?:, ?"sent_at": ?([\d.]+))?')
+_REPLY_HEAD = re.compile(r'\{"client":(\d+),"id":(\d+),"type":"(\w+)"')
+_REPLY_TIMING = re.compile(r'"timing":\{"recv":(\d+),"start":(\d+),"done":(\d+)\}\}$')
+# Status frames a newer frame with the same (client, id, type) makes obsolete;
+# the "merge" policy replaces them in place instead of queueing both
+STATUS_TYPES = {"connected", "repl_started", "bridge_gone", "file_progress", "watch_value"}
+_STATUS_HEAD = re.compile(r'\{(?:"client": ?(\d+), ?)?(?:"id": ?(\d+|null), ?)?"type": ?"(\w+)"')
+# CLI frames that jump the bridge's outbound queue (see Outbox.put)
+_URGENT = re.compile(r'"type": ?"interrupt"')
+# CLI requests the relay may answer from the bridges' link state (see _answer_locally)
+_LOCAL_REQUEST = re.compile(r'"type": ?"(status|connect|devices)"')
+# Subscription requests the relay serves itself (see _watch_request)
+_WATCH_REQUEST = re.compile(r'"type": ?"(watch|unwatch)"')
+# The device a CLI request is addressed to (not a quoted key inside a string)
+_DEVICE_FIELD = re.compile(r'(?<!\\)"device": ?"([^"\\]*)"')
+# The tag _tag_client appends to a CLI frame
+_SENDER_TAG = re.compile(r'"client":(\d+)\}$')
+# Reply types that end a request
+FINAL_TYPES = {"connected", "repl_response", "repl_batch_done", "repl_done", "file_done", "file_list",
+               "file_manifest", "data_done", "interrupted", "watch_done", "unwatched"}
+
+
+def _now_ms():
+    return time.time() * 1000
+
+
+class ThresholdDeflate(PerMessageDeflate):
+    """permessage-deflate that sends messages under WS_COMPRESS_MIN bytes, and data frames, as they are."""
+
+    def encode(self, frame):
+        # RFC 7692 lets the sender leave any message uncompressed (RSV1 clear)
+        if frame.opcode in (Opcode.TEXT, Opcode.BINARY) and frame.fin and (
+                len(frame.data) < WS_COMPRESS_MIN or frame.opcode == Opcode.BINARY and frame.data[:1] == bytes([FRAME_DATA])):
+            return frame
+        return super().encode(frame)
+
+
+class ThresholdDeflateFactory(ServerPerMessageDeflateFactory):
+    def process_request_params(self, params, accepted_extensions):
+        response, ext = super().process_request_params(params, accepted_extensions)
+        return response, ThresholdDeflate(ext.remote_no_context_takeover, ext.local_no_context_takeover,
+                                          ext.remote_max_window_bits, ext.local_max_window_bits,
+                                          ext.compress_settings)
+
+
+def ws_compression():
+    """Keyword arguments for websockets.serve implementing WS_COMPRESSION."""
+    if WS_COMPRESSION == "none":
+        return {"compression": None}
+    # Same window and memory settings as websockets' own compression="deflate"
+    factory = ThresholdDeflateFactory(server_max_window_bits=12, client_max_window_bits=12,
+                                      compress_settings={"memLevel": 5})
+    return {"compression": None, "extensions": [factory]}
+
+
+class Histogram:
+    """Cumulative Prometheus histogram with one series per label value."""
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help_text, label):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.series = {}  # label value -> {"buckets": [...], "count", "sum"}
+
+    def observe(self, label_value, seconds):
+        series = self.series.setdefault(label_value, {"buckets": [0] * len(self.BUCKETS), "count": 0, "sum": 0.0})
+        seconds = max(0.0, seconds)  # stamps from different clocks can be slightly out of order
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                series["buckets"][i] += 1
+        series["count"] += 1
+        series["sum"] += seconds
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for value, series in sorted(self.series.items()):
+            tag = f'{self.label}="{value}"'
+            for bound, count in zip(self.BUCKETS, series["buckets"]):
+                lines.append(f'{self.name}_bucket{{{tag},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{tag},le="+Inf"}} {series["count"]}')
+            lines.append(f"{self.name}_sum{{{tag}}} {series['sum']:.6f}")
+            lines.append(f"{self.name}_count{{{tag}}} {series['count']}")
+        return lines
+
+
+class RelayMetrics:
+    """Counters and per-hop latency for /metrics.
+
+    Requests are keyed by (client, request id), read from frame heads and
+    binary headers without decoding the frame. The CLI stamps ``sent_at``,
+    the relay notes when it received and forwarded the request, and the
+    bridge's final reply carries ``timing`` (received, started, done), all
+    wall-clock milliseconds on the same phone. The bridge's
+    ``bridge_metrics`` reports (queue depth, BLE write and notify samples)
+    end here and are not forwarded.
+    """
+
+    HOPS = (
+        ("cli_to_relay", "CLI send to relay receive"),
+        ("relay_to_bridge", "relay forward to bridge page receive"),
+        ("bridge_queue", "waiting in the bridge page's queue"),
+        ("device", "BLE transfer and execution on the Monocle"),
+        ("bridge_to_relay", "final reply from the bridge page to the relay"),
+        ("relay", "whole request as seen by the relay"),
+    )
+
+    def __init__(self):
+        self.inflight = {}  # (client, id) -> [sent_at, received, forwarded] (ms)
+        self.frames = {"cli_to_bridge": 0, "bridge_to_cli": 0}
+        self.bytes = {"cli_to_bridge": 0, "bridge_to_cli": 0}
+        self.connections = {"bridge": 0, "cli": 0}
+        self.reconnects = {"bridge": 0, "ble": 0}
+        self.bridges_seen = set()
+        self.resumes = {"bridge": 0, "cli": 0}
+        self.replayed = 0
+        self.watch = {"queries": 0, "updates": 0}  # polls sent to devices, values sent to watchers
+        self.ble_connects = {}  # bridge id -> BLE connections it reported
+        self.bridge_queues = {}  # bridge id -> requests queued in the page at its last report
+        self.hops = Histogram(
+            "monocle_hop_latency_seconds",
+            "Request latency per hop: " + "; ".join(f"{h}: {d}" for h, d in self.HOPS) + ".",
+            "hop",
+        )
+        self.outbox = {role: {"high_water": 0, "dropped": 0, "merged": 0, "disconnected": 0} for role in ("bridge", "cli")}
+        self.ble = Histogram(
+            "monocle_ble_latency_seconds",
+            "BLE latency reported by the bridge page: write (one acknowledged write) and notify (write to first notification).",
+            "op",
+        )
+
+    def connected(self, role, bridge_id=None):
+        if role == "bridge":
+            if bridge_id in self.bridges_seen:
+                self.reconnects["bridge"] += 1
+            self.bridges_seen.add(bridge_id)
+        self.connections[role] += 1
+
+    @property
+    def bridge_queue(self):
+        return sum(self.bridge_queues.values())
+
+    def bridge_left(self, bridge_id):
+        self.bridge_queues.pop(bridge_id, None)
+
+    def request_received(self, client_id, message):
+        """Count a CLI frame and start timing it; return its key (None if untracked)."""
+        self.frames["cli_to_bridge"] += 1
+        self.bytes["cli_to_bridge"] += len(message)
+        if isinstance(message, bytes):
+            key = (client_id, int.from_bytes(message[8:12], "big"))
+            sent_at = None
+        else:
+            head = _REQUEST_HEAD.match(message)
+            if not head:
+                return None
+            key = (client_id, int(head.group(1)))
+            sent_at = float(head.group(2)) if head.group(2) else None
+        self.inflight[key] = [sent_at, _now_ms(), None]
+        return key
+
+    def request_forwarded(self, key):
+        if key in self.inflight:
+            self.inflight[key][2] = _now_ms()
+
+    def bridge_frame(self, message, bridge_id=None):
+        """Account for a bridge frame; return True if it is a metrics report to consume."""
+        if isinstance(message, str) and message.startswith('{"type":"bridge_metrics"'):
+            self._absorb_report(json.loads(message), bridge_id)
+            return True
+        self.frames["bridge_to_cli"] += 1
+        self.bytes["bridge_to_cli"] += len(message)
+        if isinstance(message, bytes):
+            return False
+        head = _REPLY_HEAD.match(message)
+        if head and head.group(3) in FINAL_TYPES:
+            stamps = self.inflight.pop((int(head.group(1)), int(head.group(2))), None)
+            if stamps:
+                self._observe(stamps, _REPLY_TIMING.search(message, max(0, len(message) - 96)))
+        return False
+
+    def _observe(self, stamps, timing):
+        sent_at, received, forwarded = stamps
+        now = _now_ms()
+        if sent_at is not None:
+            self.hops.observe("cli_to_relay", (received - sent_at) / 1000)
+        self.hops.observe("relay", (now - received) / 1000)
+        if timing:
+            recv, start, done = (int(v) for v in timing.groups())
+            if forwarded is not None:
+                self.hops.observe("relay_to_bridge", (recv - forwarded) / 1000)
+            self.hops.observe("bridge_queue", (start - recv) / 1000)
+            self.hops.observe("device", (done - start) / 1000)
+            self.hops.observe("bridge_to_relay", (now - done) / 1000)
+
+    def _absorb_report(self, report, bridge_id):
+        self.bridge_queues[bridge_id] = report.get("queued", 0)
+        for ms in report.get("write_ms", []):
+            self.ble.observe("write", ms / 1000)
+        for ms in report.get("notify_ms", []):
+            self.ble.observe("notify", ms / 1000)
+        connects = report.get("ble_connects", 0)
+        seen = self.ble_connects.get(bridge_id, 0)
+        self.reconnects["ble"] += max(0, connects - (0 if seen else 1))
+        self.ble_connects[bridge_id] = seen + connects
+
+    def forget_client(self, client_id):
+        for key in [k for k in self.inflight if k[0] == client_id]:
+            del self.inflight[key]
+
+    def render(self):
+        """Prometheus text exposition format."""
+        def metric(name, kind, help_text, samples):
+            return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"] + [
+                f"{name}{labels} {value}" for labels, value in samples
+            ]
+
+        lines = []
+        lines += metric("monocle_requests_in_flight", "gauge",
+                        "Requests relayed to the bridge and not yet answered.", [("", len(self.inflight))])
+        lines += metric("monocle_bridge_queue_depth", "gauge",
+                        "Requests waiting in the bridge page's queues at its last report.", [("", self.bridge_queue)])
+        lines += metric("monocle_bridge_connected", "gauge",
+                        "Bridge pages registered (one per Monocle).", [("", len(bridges))])
+        lines += metric("monocle_bridge_requests_in_flight", "gauge",
+                        "Requests forwarded to each bridge page and not yet answered.",
+                        [(f'{{bridge="{b.id or ""}"}}', len(b.inflight)) for b in bridges.values()])
+        lines += metric("monocle_cli_clients", "gauge", "Registered CLI connections.", [("", len(cli_clients))])
+        lines += metric("monocle_relayed_frames_total", "counter", "Frames relayed, by direction.",
+                        [(f'{{direction="{d}"}}', n) for d, n in self.frames.items()])
+        lines += metric("monocle_relayed_bytes_total", "counter",
+                        "Payload relayed, by direction (characters for text frames, bytes for binary).",
+                        [(f'{{direction="{d}"}}', n) for d, n in self.bytes.items()])
+        lines += metric("monocle_connections_total", "counter", "WebSocket registrations, by role.",
+                        [(f'{{role="{r}"}}', n) for r, n in self.connections.items()])
+        lines += metric("monocle_reconnects_total", "counter",
+                        "Reconnections after the first connection: bridge pages to relay (per device id), and to their Monocle over BLE.",
+                        [(f'{{link="{l}"}}', n) for l, n in self.reconnects.items()])
+        lines += metric("monocle_session_resumes_total", "counter", "Sessions resumed after a lost connection, by role.",
+                        [(f'{{role="{r}"}}', n) for r, n in self.resumes.items()])
+        lines += metric("monocle_session_replayed_frames_total", "counter",
+                        "Frames sent again to a resumed peer (missed or held while it was away).",
+                        [("", self.replayed)])
+        lines += metric("monocle_watch_polls", "gauge",
+                        "Distinct watched expressions being polled (one per bridge, expression and interval).",
+                        [("", len(polls))])
+        lines += metric("monocle_watchers", "gauge", "Watch requests subscribed to those polls.",
+                        [("", sum(len(p.watchers) for p in polls.values()))])
+        lines += metric("monocle_watch_queries_total", "counter", "Polls sent to a Monocle for watches.",
+                        [("", self.watch["queries"])])
+        lines += metric("monocle_watch_updates_total", "counter", "Changed values sent to watchers.",
+                        [("", self.watch["updates"])])
+        depth = {"bridge": 0, "cli": 0}
+        for box in outboxes.values():
+            depth[box.role] += len(box.frames)
+        lines += metric("monocle_outbox_depth", "gauge", "Frames waiting in outbound queues, by receiving role.",
+                        [(f'{{role="{r}"}}', n) for r, n in depth.items()])
+        lines += metric("monocle_outbox_high_water", "gauge", "Most frames ever queued for one connection, by role.",
+                        [(f'{{role="{r}"}}', s["high_water"]) for r, s in self.outbox.items()])
+        lines += metric("monocle_outbox_dropped_total", "counter", "Frames dropped from full queues (drop_oldest).",
+                        [(f'{{role="{r}"}}', s["dropped"]) for r, s in self.outbox.items()])
+        lines += metric("monocle_outbox_merged_total", "counter", "Status frames replaced by a newer one (merge).",
+                        [(f'{{role="{r}"}}', s["merged"]) for r, s in self.outbox.items()])
+        lines += metric("monocle_outbox_disconnects_total", "counter",
+                        "Connections dropped because their full queue would have held up the relay.",
+                        [(f'{{role="{r}"}}', s["disconnected"]) for r, s in self.outbox.items()])
+        lines += self.hops.render()
+        lines += self.ble.render()
+        return "\n".join(lines) + "\n"
+
+
+metrics = RelayMetrics()
+
+
+def _status_key(message):
+    """(client, id, type) of a status frame the merge policy may replace, else None."""
+    if not isinstance(message, str):
+        return None
+    head = _STATUS_HEAD.match(message)
+    if head and head.group(3) in STATUS_TYPES:
+        return head.groups()
+    return None
+
+
+class Outbox:
+    """Bounded outbound queue for one connection, drained by its own writer task.
+
+    Holds at most OUTBOX_FRAMES frames or OUTBOX_BYTES of payload (a single
+    larger frame is let through on its own). When full, ``put`` applies the
+    policy: "block" waits for room, "drop_oldest" discards from the front,
+    "merge" first replaces a queued status frame the new one supersedes and
+    otherwise blocks. A CLI's queue does not wait: it drops the connection
+    (see _overflow). Urgent frames (a CLI's interrupt) skip ahead of other
+    clients' frames. With a session, every frame is recorded for replay as
+    it goes out, and frames left when the connection fails are kept.
+    """
+
+    def __init__(self, ws, role, policy="block", max_frames=None, max_bytes=None, session=None):
+        if policy not in OUTBOX_POLICIES:
+            raise ValueError(f"unknown outbox policy: {policy}")
+        self.ws = ws
+        self.role = role
+        self.policy = policy
+        self.max_frames = max_frames or OUTBOX_FRAMES
+        self.max_bytes = max_bytes or OUTBOX_BYTES
+        self.session = session
+        self.frames = collections.deque()
+        self.size = 0
+        self.broken = False
+        self._ready = asyncio.Event()
+        self._room = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._writer = asyncio.create_task(self._drain())
+
+    def _full(self):
+        return bool(self.frames) and (len(self.frames) >= self.max_frames or self.size >= self.max_bytes)
+
+    def _merge(self, message):
+        key = _status_key(message)
+        if key is None:
+            return False
+        for i, queued in enumerate(self.frames):
+            if _status_key(queued) == key:
+                self.size += len(message) - len(queued)
+                self.frames[i] = message
+                metrics.outbox[self.role]["merged"] += 1
+                return True
+        return False
+
+    async def put(self, message, urgent=False):
+        if urgent:
+            # Ahead of other senders' frames (the sender's own earlier ones
+            # keep their order), and never held back by a full queue
+            sender = _frame_sender(message)
+            at = 0
+            for i, queued in enumerate(self.frames):
+                if _frame_sender(queued) == sender:
+                    at = i + 1
+            self.frames.insert(at, message)
+            self.size += len(message)
+            self._idle.clear()
+            self._ready.set()
+            return
+        if self.policy == "merge" and self._merge(message):
+            return
+        if self.policy == "drop_oldest":
+            while self._full():
+                self.size -= len(self.frames.popleft())
+                metrics.outbox[self.role]["dropped"] += 1
+        if self.role == "cli" and self._full() and not self.broken:
+            self._overflow()
+        while self._full() and not self.broken:
+            self._room.clear()
+            await self._room.wait()
+        self.frames.append(message)
+        self.size += len(message)
+        stats = metrics.outbox[self.role]
+        stats["high_water"] = max(stats["high_water"], len(self.frames))
+        self._idle.clear()
+        self._ready.set()
+
+    def _overflow(self):
+        """Drop a CLI that stopped reading rather than hold up the bridge's relay loop.
+
+        Queued frames are kept: with a session they are held for the CLI to
+        resume (a lost connection, not one left on purpose).
+        """
+        self.broken = True
+        self._room.set()
+        metrics.outbox[self.role]["disconnected"] += 1
+        transport = getattr(self.ws, "transport", None)
+        if transport is not None:
+            transport.abort()
+
+    async def _drain(self):
+        while True:
+            if not self.frames:
+                self._idle.set()
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            message = self.frames.popleft()
+            self.size -= len(message)
+            self._room.set()
+            if self.session is not None:
+                self.session.record(message)
+            if capture is not None:
+                capture.record(self.ws, self.role, message, out=True)
+            try:
+                await self.ws.send(message)
+            except Exception:
+                # The connection is gone; its relay() loop cleans up
+                if self.session is None:
+                    self.frames.clear()
+                    self.size = 0
+                    continue
+                self.broken = True
+                self._room.set()
+                self._idle.set()
+                return
+
+    async def flush(self):
+        """Wait until every queued frame has been handed to the websocket."""
+        await self._idle.wait()
+
+    async def close(self):
+        try:
+            await asyncio.wait_for(self.flush(), OUTBOX_CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        self._writer.cancel()
+        await asyncio.gather(self._writer, return_exceptions=True)
+
+    def take(self):
+        """Stop the writer and return the frames it has not sent."""
+        self._writer.cancel()
+        frames = list(self.frames)
+        self.frames.clear()
+        self.size = 0
+        self.broken = True
+        self._room.set()
+        return frames
+
+
+def _outbox(ws, role):
+    """The Outbox of ``ws``, created on first use."""
+    box = outboxes.get(ws)
+    if box is None:
+        box = outboxes[ws] = Outbox(ws, role, OUTBOX_POLICY if role == "cli" else "block")
+    return box
+
+
+class TrafficCapture:
+    """Appends every relayed frame to a capture file without blocking the event loop.
+
+    Records collect in memory; a writer task hands them to a thread in
+    batches, every CAPTURE_FLUSH_INTERVAL or once CAPTURE_FLUSH_BYTES are
+    waiting. Connections are numbered in the order they are first seen.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = 0
+        self._file = open(path, "wb")
+        self._file.write(CAPTURE_MAGIC)
+        self._start = time.monotonic()
+        self._elapsed = 0  # microseconds from the start to the last record
+        self._conns = {}  # websocket -> connection number
+        self._conn_ids = itertools.count(1)
+        self._buffer = bytearray()
+        self._full = asyncio.Event()
+        self._closing = False
+        self._writer = asyncio.create_task(self._drain())
+
+    def record(self, ws, role, message, out=False):
+        """Log ``message`` as received from (or, with ``out``, sent to) ``ws``."""
+        flags = (CAPTURE_OUT if out else 0) | (CAPTURE_CLI if role == "cli" else 0)
+        if isinstance(message, str):
+            message = message.encode()
+        else:
+            flags |= CAPTURE_BINARY
+        self._append(ws, flags, message)
+
+    def closed(self, ws, role):
+        """Log the end of ``ws``; a later connection gets a new number."""
+        if ws in self._conns:
+            self._append(ws, CAPTURE_CLOSED | (CAPTURE_CLI if role == "cli" else 0), b"")
+            del self._conns[ws]
+
+    def _append(self, ws, flags, payload):
+        conn = self._conns.get(ws)
+        if conn is None:
+            conn = self._conns[ws] = next(self._conn_ids)
+        now = int((time.monotonic() - self._start) * 1e6)
+        delta = min(now - self._elapsed, 0xFFFFFFFF)
+        self._elapsed += delta
+        self._buffer += CAPTURE_RECORD.pack(delta, flags, conn, len(payload))
+        self._buffer += payload
+        self.records += 1
+        if len(self._buffer) >= CAPTURE_FLUSH_BYTES:
+            self._full.set()
+
+    def _write(self, data):
+        self._file.write(data)
+        self._file.flush()
+
+    async def _flush(self):
+        data, self._buffer = self._buffer, bytearray()
+        self._full.clear()
+        if data:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, data)
+
+    async def _drain(self):
+        # The only writer: batches reach the file in order, and close() waits for the last one
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._full.wait(), CAPTURE_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            await self._flush()
+        await self._flush()
+
+    async def close(self):
+        """Write what is left and close the file."""
+        self._closing = True
+        self._full.set()
+        await asyncio.shield(self._writer)
+        self._file.close()
+
+
+def read_capture(path):
+    """Yield (seconds since the start, connection, flags, frame) for each record of a capture file.
+
+    Text frames come back as str, binary ones as bytes. A record cut short
+    (the server stopped mid-write) ends the capture.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{path}: not a monocle capture file")
+        elapsed = 0
+        while True:
+            head = f.read(CAPTURE_RECORD.size)
+            if len(head) < CAPTURE_RECORD.size:
+                return
+            delta, flags, conn, length = CAPTURE_RECORD.unpack(head)
+            frame = f.read(length)
+            if len(frame) < length:
+                return
+            elapsed += delta
+            yield elapsed / 1e6, conn, flags, frame if flags & CAPTURE_BINARY else frame.decode()
+
+
+class Session:
+    """A resumable peer: its state outlives the websocket for SESSION_TTL.
+
+    Frames carry no sequence numbers. Each end counts the frames it sent and
+    received in the session (registration replies included) and keeps the
+    last ones it sent. A peer resuming says how many it received, the relay
+    answers with its own count, and each side replays what the other missed.
+    """
+
+    def __init__(self, role, key=None):
+        self.id = secrets.token_hex(8)
+        self.role = role
+        self.key = key  # client id of a CLI, bridge id of a bridge
+        self.ws = None
+        self.sent = 0
+        self.received = 0
+        self.log = collections.deque()  # (ordinal, frame) of the last frames sent
+        self.log_bytes = 0
+        self.held = collections.deque()  # frames waiting for the peer to come back
+        self.held_bytes = 0
+        self.expiry = None
+
+    def record(self, message):
+        self.sent += 1
+        self.log.append((self.sent, message))
+        self.log_bytes += len(message)
+        while len(self.log) > REPLAY_FRAMES or self.log_bytes > REPLAY_BYTES:
+            self.log_bytes -= len(self.log.popleft()[1])
+
+    def hold(self, message):
+        """Keep a frame while the peer is away; False once past the replay bounds."""
+        self.held.append(message)
+        self.held_bytes += len(message)
+        return len(self.held) <= REPLAY_FRAMES and self.held_bytes <= REPLAY_BYTES
+
+    def park(self, box):
+        """Detach from the dropped connection whose Outbox is ``box`` and start the TTL."""
+        for message in reversed(box.take() if box else []):
+            self.held.appendleft(message)
+            self.held_bytes += len(message)
+        self.ws = None
+        self.expiry = asyncio.create_task(_expire_session(self))
+
+    def replay(self, received):
+        """Frames to send a peer that has ``received`` frames, or None if some are gone."""
+        missed = [frame for ordinal, frame in self.log if ordinal > received]
+        if received > self.sent or len(missed) != self.sent - received:
+            return None
+        # They go out again and are numbered again as they do
+        while self.log and self.log[-1][0] > received:
+            self.log_bytes -= len(self.log.pop()[1])
+        self.sent = received
+        frames = missed + list(self.held)
+        self.held.clear()
+        self.held_bytes = 0
+        return frames
+
+
+class Bridge:
+    """A registered bridge page: one Chrome tab and the Monocle it drives."""
+
+    def __init__(self, bridge_id, ws=None, features=()):
+        self.id = bridge_id
+        self.ws = ws  # None while its session waits for it to come back
+        self.features = list(features)  # optional protocol features it announced
+        self.session = None
+        # Its BLE link as it last reported it (link_state frames), so status
+        # and connect requests are answered here without a trip to the device
+        self.link = {"connected": False, "device": None}
+        self.inflight = set()  # (client, request id) forwarded and not yet answered
+        self.joined = next(_bridge_order)
+
+    def names(self):
+        """What a request's ``device`` may call it: its id or its Monocle's name."""
+        return {self.id, self.link["device"]} - {None}
+
+    def load(self):
+        """Sort key for _route: present, Monocle connected, fewest requests, oldest."""
+        return self.ws is None, not self.link["connected"], len(self.inflight), self.joined
+
+    def notice(self, kind):
+        """A bridge_away / bridge_gone frame about this bridge."""
+        return {"type": kind} if self.id is None else {"type": kind, "device": self.id}
+
+    def summary(self):
+        return {"id": self.id, **self.link, "busy": len(self.inflight), "away": self.ws is None}
+
+
+async def _expire_session(session):
+    await asyncio.sleep(SESSION_TTL)
+    session.expiry = None
+    await _end_session(session)
+
+
+def _forget_session(session):
+    """Unregister a session; True if it was still registered."""
+    if sessions.pop(session.id, None) is None:
+        return False
+    if session.expiry is not None:
+        session.expiry.cancel()
+    session.ws = None
+    if session.role == "bridge":
+        bridge = bridges.get(session.key)
+        if bridge is not None and bridge.session is session:
+            bridge.session = None
+    elif cli_sessions.get(session.key) is session:
+        del cli_sessions[session.key]
+    return True
+
+
+async def _end_session(session):
+    """Drop a session whose peer did not come back, cleaning up as for a plain disconnect."""
+    ws = session.ws
+    bridge = bridges.get(session.key) if session.role == "bridge" else None
+    if bridge is not None and bridge.session is not session:
+        bridge = None
+    if not _forget_session(session):
+        return
+    if bridge is not None:
+        bridge.ws = None
+    elif session.role == "cli":
+        _cli_gone(session.key)
+    if ws is not None:
+        await ws.close()
+    if bridge is not None:
+        await _bridge_gone(bridge)
+
+
+def _cli_gone(client_id):
+    cli_clients.pop(client_id, None)
+    cli_bridge.pop(client_id, None)
+    metrics.forget_client(client_id)
+    _unwatch(lambda key, poll: key[0] == client_id)
+
+
+async def _bridge_gone(bridge):
+    """Forget ``bridge``; requests it had in flight will never be answered."""
+    targets = _affected_clis(bridge)
+    if bridges.get(bridge.id) is bridge:
+        del bridges[bridge.id]
+    for key in bridge.inflight:
+        metrics.inflight.pop(key, None)
+    for client_id in [c for c, b in cli_bridge.items() if b == bridge.id]:
+        del cli_bridge[client_id]
+    metrics.bridge_left(bridge.id)
+    ended = _unwatch(lambda key, poll: poll.key[0] == bridge.id)
+    # Let CLIs stop waiting
+    try:
+        await _tell_watchers(ended, {"type": "watch_done", "ok": False, "error": "bridge disconnected"})
+        await _tell_clis(targets, json.dumps(bridge.notice("bridge_gone")))
+    except Exception:
+        pass
+
+
+def _resume(data, role):
+    """The Session a registration resumes and the frames to replay to it, else (None, None)."""
+    session = sessions.get(data.get("session"))
+    if session is None or session.role != role:
+        return None, None
+    if session.ws is not None:
+        # The old connection has not noticed it is gone yet
+        old = session.ws
+        session.park(outboxes.pop(old, None))
+        asyncio.ensure_future(old.close())
+    session.expiry.cancel()
+    session.expiry = None
+    frames = session.replay(int(data.get("received", 0)))
+    return (session, frames) if frames is not None else (None, None)
+
+
+def _route(client_id, device=None, pin=True):
+    """The Bridge for a CLI's request, or None if there is none.
+
+    A request naming a ``device`` (bridge id or Monocle name) goes there.
+    Other requests from one CLI connection stick to one bridge, picked the
+    first time: the least busy one with its Monocle connected.
+    """
+    if device is not None:
+        return next((b for b in bridges.values() if device in b.names()), None)
+    bridge = bridges.get(cli_bridge[client_id]) if client_id in cli_bridge else None
+    if bridge is None and bridges:
+        bridge = min(bridges.values(), key=Bridge.load)
+        if pin:
+            cli_bridge[client_id] = bridge.id
+    return bridge
+
+
+def _affected_clis(bridge):
+    """CLIs to tell that ``bridge`` is away or gone: all of them (None) if it is the only one."""
+    if all(b is bridge for b in bridges.values()):
+        return None
+    return {client for client, _ in bridge.inflight} | {c for c, b in cli_bridge.items() if b == bridge.id}
+
+
+def _common_features():
+    """Features every registered bridge supports, so a CLI may use them whichever it gets."""
+    features = [set(b.features) for b in bridges.values()]
+    return sorted(set.intersection(*features)) if features else []
+
+
+def _request_device(message):
+    """The ``device`` a CLI request is addressed to, read from the frame head (None if none)."""
+    if isinstance(message, bytes):
+        return None
+    target = _DEVICE_FIELD.search(message, 0, 200)
+    return target.group(1) if target else None
+
+
+def _unroutable(client_id, message, device):
+    """The relay's reply to a request no bridge can take (None if it has no ID)."""
+    if isinstance(message, bytes):
+        rid = int.from_bytes(message[8:12], "big")
+    else:
+        head = _REQUEST_HEAD.match(message)
+        if not head:
+            return None
+        rid = int(head.group(1))
+    error = f"no bridge for device {device}" if device is not None else "no bridge connected"
+    return json.dumps({"client": client_id, "id": rid, "type": "bridge_gone", "error": error})
+
+
+def _settle(bridge, message):
+    """Take a request off the bridge's load once its final reply goes by."""
+    if bridge.inflight and isinstance(message, str):
+        head = _REPLY_HEAD.match(message)
+        if head and head.group(3) in FINAL_TYPES:
+            bridge.inflight.discard((int(head.group(1)), int(head.group(2))))
+
+
+def _well_formed(message):
+    """Whether a CLI frame can be tagged and parsed by the bridge: a JSON object, or a whole binary header."""
+    if isinstance(message, bytes):
+        return len(message) >= FRAME_HEADER.size
+    body = message.strip()
+    return body.startswith("{") and body.endswith("}")
+
+
+def _tag_client(message, client_id):
+    """Stamp the sender's client id into a CLI frame without parsing it.
+
+    For JSON the tag is appended as the last key, so it wins over any
+    ``client`` the CLI sent itself.
+    """
+    if isinstance(message, bytes):
+        return message[:_FRAME_CLIENT.start] + client_id.to_bytes(4, "big") + message[_FRAME_CLIENT.stop:]
+    body = message.rstrip()[:-1].rstrip()
+    sep = "" if body.endswith("{") else ","
+    return f'{body}{sep}"client":{client_id}}}'
+
+
+def _frame_sender(message):
+    """CLI that sent a frame tagged by _tag_client (None if untagged)."""
+    if isinstance(message, bytes):
+        return int.from_bytes(message[_FRAME_CLIENT], "big")
+    tag = _SENDER_TAG.search(message)
+    return int(tag.group(1)) if tag else None
+
+
+def _frame_client(message):
+    """Target CLI of a bridge frame (None for all), read without a full parse if possible."""
+    if isinstance(message, bytes):
+        return int.from_bytes(message[_FRAME_CLIENT], "big") or None
+    tag = _CLIENT_TAG.match(message)
+    if tag:
+        return int(tag.group(1))
+    return json.loads(message).get("client")
+
+
+async def _send_to_bridge(bridge, message, urgent=False):
+    if bridge.ws is not None and getattr(bridge.ws, "open", True):
+        await _outbox(bridge.ws, "bridge").put(message, urgent)
+    elif bridge.session is not None and not bridge.session.hold(message):
+        await _end_session(bridge.session)
+
+
+async def _send_to_clis(target, message):
+    """Send a bridge frame to CLI ``target``, or to all CLIs if it is None."""
+    if target is not None:
+        targets = [target] if target in cli_clients or target in cli_sessions else []
+    else:
+        targets = list(cli_clients.keys() | cli_sessions.keys())
+    for client_id in targets:
+        ws = cli_clients.get(client_id)
+        if ws is not None and getattr(ws, "open", True):
+            await _outbox(ws, "cli").put(message)
+        elif ws is None and not cli_sessions[client_id].hold(message):
+            await _end_session(cli_sessions[client_id])
+
+
+async def _tell_clis(targets, message):
+    """Send a relay notice to the CLIs in ``targets``, or to all CLIs if it is None."""
+    if targets is None:
+        await _send_to_clis(None, message)
+        return
+    for client_id in targets:
+        await _send_to_clis(client_id, message)
+
+
+async def _forward(client_id, message):
+    """Relay a CLI frame to the bridge _route picks; answer it here if there is none."""
+    device = _request_device(message)
+    urgent = isinstance(message, str) and _URGENT.search(message, 0, 200) is not None
+    if urgent:
+        # An interrupt ends the sender's watches too (those listed in "ids")
+        ids = json.loads(message).get("ids")
+        ended = _unwatch(lambda key, poll: key[0] == client_id and (ids is None or key[1] in ids))
+        await _tell_watchers(ended, {"type": "watch_done", "ok": True, "interrupted": True})
+    bridge = _route(client_id, device)
+    targets = [bridge] if bridge is not None else []
+    if urgent and device is None:
+        # An interrupt goes to every bridge running or queueing the sender's requests
+        busy = [b for b in bridges.values() if any(c == client_id for c, _ in b.inflight)]
+        targets = busy or targets
+    if not targets:
+        answer = _unroutable(client_id, message, device)
+        if answer is not None:
+            await _send_to_clis(client_id, answer)
+        return
+    key = metrics.request_received(client_id, message)
+    tagged = _tag_client(message, client_id)
+    for bridge in targets:
+        if key is not None:
+            bridge.inflight.add(key)
+        await _send_to_bridge(bridge, tagged, urgent)
+    metrics.request_forwarded(key)
+
+
+def _absorb_link_state(bridge, message):
+    """Update the bridge's link from a link_state frame; return True if it was one."""
+    if not (isinstance(message, str) and message.startswith('{"type":"link_state"')):
+        return False
+    report = json.loads(message)
+    bridge.link.update(connected=bool(report.get("connected")), device=report.get("device"))
+    return True
+
+
+def _answer_locally(client_id, message):
+    """The relay's reply to status, devices, or connect while the link is up; else None."""
+    if not isinstance(message, str) or not _LOCAL_REQUEST.search(message, 0, 200):
+        return None
+    req = json.loads(message)
+    head = {"client": client_id, "id": req.get("id")}
+    if req.get("type") == "devices":
+        listed = sorted(bridges.values(), key=lambda b: b.joined)
+        return json.dumps({**head, "type": "devices", "devices": [b.summary() for b in listed]})
+    bridge = _route(client_id, req.get("device"), pin=False)
+    if req.get("type") == "status":
+        link = bridge.link if bridge is not None else {"connected": False, "device": None}
+        return json.dumps({**head, "type": "status", "bridge": bridge is not None, **link})
+    if req.get("type") == "connect" and bridge is not None and bridge.ws is not None \
+            and bridge.link["connected"] and not req.get("fresh"):
+        return json.dumps({**head, "type": "connected", "ok": True, "device": bridge.link["device"], "cached": True})
+    return None
+
+
+class Poll:
+    """One expression polled on one bridge's Monocle for all of its watchers.
+
+    Each reply whose output differs from the last goes to every watcher as
+    a watch_value; a new watcher gets the latest one straight away.
+    """
+
+    def __init__(self, bridge_id, expr, interval):
+        self.key = (bridge_id, expr, interval)
+        self.watchers = set()  # (client id, watch request id)
+        self.latest = None  # the last watch_value fields sent
+        self.task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        bridge_id, expr, interval = self.key
+        while self.watchers and bridge_id in bridges:
+            started = time.monotonic()
+            bridge = bridges[bridge_id]
+            if bridge.ws is not None:  # else it is away: wait for it to come back
+                reply = await self._query(bridge, expr)
+                if reply is not None:
+                    await self._update(reply.get("data", ""))
+            await asyncio.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+    async def _query(self, bridge, expr):
+        """Run ``expr`` as a repl request from POLL_CLIENT; its reply, or None after a timeout."""
+        rid = next(_poll_ids)
+        waiter = _poll_replies[rid] = asyncio.get_running_loop().create_future()
+        bridge.inflight.add((POLL_CLIENT, rid))
+        metrics.watch["queries"] += 1
+        try:
+            await _send_to_bridge(bridge, json.dumps({"id": rid, "type": "repl", "code": expr,
+                                                      "client": POLL_CLIENT}))
+            return await asyncio.wait_for(waiter, WATCH_POLL_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            _poll_replies.pop(rid, None)
+            bridge.inflight.discard((POLL_CLIENT, rid))  # after a timeout no reply will clear it
+
+    async def _update(self, data):
+        if self.latest is not None and self.latest["data"] == data:
+            return
+        ok = not data.startswith("ERROR:") and "Traceback (most recent call last)" not in data
+        self.latest = {"type": "watch_value", "data": data, "ok": ok, "at": _now_ms()}
+        await _tell_watchers(list(self.watchers), self.latest)
+
+
+def _poll_reply(message):
+    """Hand a bridge frame addressed to POLL_CLIENT to the poll waiting for it."""
+    reply = json.loads(message)
+    waiter = _poll_replies.get(reply.get("id"))
+    if waiter is not None and not waiter.done() and reply.get("type") in FINAL_TYPES:
+        waiter.set_result(reply)
+
+
+def _unwatch(match):
+    """Remove the watchers ``match(watcher, poll)`` selects; returns them.
+
+    A poll left without watchers stops.
+    """
+    ended = []
+    for key, poll in list(polls.items()):
+        gone = {watcher for watcher in poll.watchers if match(watcher, poll)}
+        poll.watchers -= gone
+        ended += gone
+        if not poll.watchers:
+            poll.task.cancel()
+            del polls[key]
+    return ended
+
+
+async def _tell_watchers(watchers, fields):
+    for client_id, rid in watchers:
+        if fields["type"] == "watch_value":
+            metrics.watch["updates"] += 1
+        await _send_to_clis(client_id, json.dumps({"client": client_id, "id": rid, **fields}))
+
+
+async def _watch_request(client_id, message):
+    """Serve a watch or unwatch request here; False if ``message`` is neither.
+
+    watch subscribes the sender to the shared poll of its expression and
+    interval on the bridge _route picks: watch_started, then watch_value
+    for each change, until watch_done. unwatch ends the sender's watches
+    (those listed in "ids") and answers unwatched with how many it ended.
+    """
+    if not isinstance(message, str) or not _WATCH_REQUEST.search(message, 0, 200):
+        return False
+    req = json.loads(message)
+    if req.get("type") not in ("watch", "unwatch"):
+        return False
+    rid = req.get("id")
+    head = {"client": client_id, "id": rid}
+    if req["type"] == "unwatch":
+        ids = req.get("ids")
+        ended = _unwatch(lambda key, poll: key[0] == client_id and (ids is None or key[1] in ids))
+        await _tell_watchers(ended, {"type": "watch_done", "ok": True})
+        await _send_to_clis(client_id, json.dumps({**head, "type": "unwatched", "count": len(ended)}))
+        return True
+    expr = req.get("expr")
+    interval = req.get("interval", 1.0)
+    device = req.get("device")
+    bridge = _route(client_id, device)
+    if not isinstance(expr, str) or not expr.strip():
+        error = "watch needs an expression"
+    elif not isinstance(interval, (int, float)) or interval < WATCH_MIN_INTERVAL:
+        error = f"interval must be at least {WATCH_MIN_INTERVAL} s"
+    elif bridge is None:
+        error = f"no bridge for device {device}" if device is not None else "no bridge connected"
+    else:
+        error = None
+    if error is not None:
+        await _send_to_clis(client_id, json.dumps({**head, "type": "watch_done", "ok": False, "error": error}))
+        return True
+    key = (bridge.id, expr, float(interval))
+    poll = polls.get(key)
+    if poll is None:
+        poll = polls[key] = Poll(*key)
+    poll.watchers.add((client_id, rid))
+    await _send_to_clis(client_id, json.dumps({**head, "type": "watch_started", "watchers": len(poll.watchers)}))
+    if poll.latest is not None:
+        await _tell_watchers([(client_id, rid)], poll.latest)
+    return True
 
 
 async def relay(websocket, path=None):
-    global bridge_ws, cli_ws
     role = None
+    client_id = None
+    bridge = None  # this connection's Bridge, for a bridge page
+    session = None
 
     try:
         async for message in websocket:
-            data = json.loads(message) if isinstance(message, str) else message
+            if role is None:
+                # Only the registration frame is parsed; everything after it
+                # is forwarded as raw text or binary frames.
+                data = json.loads(message) if isinstance(message, str) else {}
+                if data.get("role") not in ("bridge", "cli"):
+                    continue
+                role = data["role"]
+                if capture is not None:
+                    capture.record(websocket, role, message)
+                session, replay = _resume(data, role)
+                stale = sessions.get(data.get("session"))
+                if session is None and stale is not None and stale.role == role:
+                    await _end_session(stale)  # too far behind to resume
 
-            if data.get("role") == "bridge":
-                role = "bridge"
-                bridge_ws = websocket
-                await websocket.send(json.dumps({"type": "registered", "role": "bridge"}))
-                continue
-            elif data.get("role") == "cli":
-                role = "cli"
-                cli_ws = websocket
-                await websocket.send(json.dumps({"type": "registered", "role": "cli"}))
+                if role == "bridge":
+                    bridge_id = session.key if session else data.get("device")
+                    bridge = bridges.get(bridge_id)
+                    if bridge is not None and (session is None or bridge.session is not session):
+                        # A new page for the same device takes over from the old one
+                        if bridge.session is not None:
+                            _forget_session(bridge.session)
+                        del bridges[bridge_id]
+                        bridge = None
+                    if bridge is None:
+                        bridge = bridges[bridge_id] = Bridge(bridge_id)
+                    bridge.ws = websocket
+                    bridge.features = list(data.get("features", []))
+                    metrics.connected("bridge", bridge_id)
+                    reply = {"type": "registered", "role": "bridge"}
+                    if bridge_id is not None:
+                        reply["device"] = bridge_id
+                else:
+                    client_id = session.key if session else next(_client_ids)
+                    cli_clients[client_id] = websocket
+                    metrics.connected("cli")
+                    reply = {
+                        "type": "registered", "role": "cli", "client": client_id,
+                        "features": _common_features(),
+                    }
+
+                if session is None and (data.get("resume") or "session" in data):
+                    session = Session(role, bridge.id if bridge else client_id)
+                    sessions[session.id] = session
+                    if bridge is not None:
+                        bridge.session = session
+                    else:
+                        cli_sessions[client_id] = session
+                if session is not None:
+                    session.ws = websocket
+                    reply.update(session=session.id, resumed=replay is not None, received=session.received)
+                    box = outboxes[websocket] = Outbox(websocket, role, OUTBOX_POLICY if role == "cli" else "block",
+                                                       session=session)
+                    await box.put(json.dumps(reply))
+                    if replay is not None:
+                        metrics.resumes[role] += 1
+                        metrics.replayed += len(replay)
+                    for frame in replay or []:
+                        await box.put(frame)
+                else:
+                    await _outbox(websocket, role).put(json.dumps(reply))
                 continue
 
-            # Relay: forward to the other client
-            other = cli_ws if websocket == bridge_ws else bridge_ws
-            if other and getattr(other, "open", True):
-                await other.send(message)
+            if session is not None:
+                session.received += 1
+            if capture is not None:
+                capture.record(websocket, role, message)
+            # Relay: CLI frames are tagged with the sender so the bridge can
+            # echo it back; bridge frames are routed by that tag.
+            if role == "cli":
+                if not _well_formed(message):
+                    # Tagged, it would reach the bridge page as a frame it cannot parse
+                    await _outbox(websocket, role).put(
+                        json.dumps({"client": client_id, "type": "error", "error": "malformed frame"}))
+                    continue
+                answer = _answer_locally(client_id, message)
+                if answer is not None:
+                    await _outbox(websocket, role).put(answer)
+                    continue
+                if not await _watch_request(client_id, message):
+                    await _forward(client_id, message)
+            elif _absorb_link_state(bridge, message):
+                continue
+            elif not metrics.bridge_frame(message, bridge.id):
+                _settle(bridge, message)
+                target = _frame_client(message)
+                if target == POLL_CLIENT:
+                    _poll_reply(message)
+                else:
+                    await _send_to_clis(target, message)
     except Exception:
         pass
     finally:
-        if role == "bridge":
-            bridge_ws = None
-        elif role == "cli":
-            cli_ws = None
+        box = outboxes.pop(websocket, None)
+        if session is not None and session.ws is websocket and websocket.close_code not in LEFT_CODES:
+            # Lost rather than closed: hold on for the peer to resume
+            session.park(box)
+            box = None
+            if bridge is not None and bridge.ws is websocket:
+                bridge.ws = None
+                # Requests in flight may yet be answered; CLIs wait for the bridge
+                await _tell_clis(_affected_clis(bridge), json.dumps(bridge.notice("bridge_away")))
+            elif role == "cli" and cli_clients.get(client_id) is websocket:
+                del cli_clients[client_id]
+        else:
+            if session is not None and session.ws is websocket:
+                # Closed on purpose: nothing to resume
+                _forget_session(session)
+                session = None
+            if bridge is not None and bridge.ws is websocket and bridges.get(bridge.id) is bridge:
+                bridge.ws = None
+                await _bridge_gone(bridge)
+            elif role == "cli" and session is None:
+                _cli_gone(client_id)
+        if box is not None:
+            await box.close()
+        if capture is not None:
+            capture.closed(websocket, role)
+
+
+def _load_asset(name):
+    """Return the cached page asset ``name``, re-reading the file only when its mtime changes."""
+    path = BRIDGE_DIR / name
+    mtime = path.stat().st_mtime_ns
+    asset = _static_cache.get(name)
+    if asset is None or asset["mtime"] != mtime:
+        body = path.read_bytes()
+        asset = {
+            "mtime": mtime,
+            "body": body,
+            "gzip": gzip.compress(body, compresslevel=9, mtime=0),
+            "etag": '"%s"' % hashlib.sha1(body).hexdigest()[:16],
+        }
+        _static_cache[name] = asset
+    return asset
+
+
+def _parse_request(head):
+    """Split a request head into (method, path, version, headers)."""
+    lines = head.decode("latin-1").split("\r\n")
+    parts = lines[0].split()
+    method = parts[0] if parts else "GET"
+    path = parts[1].split("?", 1)[0] if len(parts) > 1 else "/"
+    version = parts[2] if len(parts) > 2 else "HTTP/1.0"
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        if value:
+            headers[name.strip().lower()] = value.strip()
+    return method, path, version, headers
 
 
 async def http_handler(reader, writer):
-    data = await reader.read(2048)
-    req = data.decode().split("\r\n", 1)[0]
-    path = req.split()[1] if " " in req else "/"
-    if path == "/" or path == "/bridge.html":
-        html = (BRIDGE_DIR / "bridge.html").read_text()
-        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nConnection: close\r\n\r\n")
-        writer.write(html.encode())
-    else:
-        writer.write(b"HTTP/1.1 404 Not Found\r\nConnection: close\r\n\r\n")
-    await writer.drain()
-    writer.close()
+    """Serve the bridge page over HTTP/1.1 with keep-alive, ETag revalidation and gzip."""
+    try:
+        while True:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT)
+            except asyncio.IncompleteReadError as e:
+                if e.partial.strip():
+                    writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    await writer.drain()
+                break
+            except (asyncio.TimeoutError, asyncio.LimitOverrunError, ConnectionError):
+                break
+
+            method, path, version, headers = _parse_request(head)
+            connection = headers.get("connection", "").lower()
+            keep_alive = connection == "keep-alive" or (version == "HTTP/1.1" and connection != "close")
+            conn_header = b"Connection: keep-alive\r\n" if keep_alive else b"Connection: close\r\n"
+
+            name = STATIC_FILES.get(path)
+            if path == METRICS_PATH:
+                body = metrics.render().encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                    + b"Cache-Control: no-store\r\nContent-Length: %d\r\n" % len(body)
+                    + conn_header + b"\r\n"
+                )
+                if method != "HEAD":
+                    writer.write(body)
+            elif name is None:
+                writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n" + conn_header + b"\r\n")
+            else:
+                asset = _load_asset(name)
+                if headers.get("if-none-match") == asset["etag"]:
+                    writer.write(
+                        b"HTTP/1.1 304 Not Modified\r\nETag: " + asset["etag"].encode() + b"\r\n"
+                        + conn_header + b"\r\n"
+                    )
+                else:
+                    use_gzip = "gzip" in headers.get("accept-encoding", "")
+                    body = asset["gzip"] if use_gzip else asset["body"]
+                    writer.write(
+                        b"HTTP/1.1 200 OK\r\nContent-Type: text/html; charset=utf-8\r\n"
+                        + b"Cache-Control: no-cache\r\nVary: Accept-Encoding\r\n"
+                        + b"ETag: " + asset["etag"].encode() + b"\r\n"
+                        + (b"Content-Encoding: gzip\r\n" if use_gzip else b"")
+                        + b"Content-Length: %d\r\n" % len(body)
+                        + conn_header + b"\r\n"
+                    )
+                    if method != "HEAD":
+                        writer.write(body)
+            await writer.drain()
+            if not keep_alive:
+                break
+    finally:
+        writer.close()
 
 
 async def main():
+    global capture
+    if OUTBOX_POLICY not in OUTBOX_POLICIES:
+        print(f"MONOCLE_OUTBOX_POLICY must be one of: {', '.join(OUTBOX_POLICIES)}")
+        sys.exit(1)
+    if WS_COMPRESSION not in WS_COMPRESSION_POLICIES:
+        print(f"MONOCLE_WS_COMPRESSION must be one of: {', '.join(WS_COMPRESSION_POLICIES)}")
+        sys.exit(1)
     http_server = await asyncio.start_server(http_handler, "0.0.0.0", PORT)
-    ws_server = await websockets.serve(relay, "0.0.0.0", PORT + 1, ping_interval=20, ping_timeout=10)
+    ws_server = await websockets.serve(relay, "0.0.0.0", PORT + 1, ping_interval=20, ping_timeout=10,
+                                       **ws_compression())
     print(f"Monocle bridge: http://127.0.0.1:{PORT}  ws://127.0.0.1:{PORT+1}", flush=True)
     print("Open the URL in Chrome on this device, then run: monocle-cli connect", flush=True)
-    await asyncio.Future()
+    if CAPTURE_PATH:
+        capture = TrafficCapture(CAPTURE_PATH)
+        print(f"Capturing relayed frames to {CAPTURE_PATH}", flush=True)
+    try:
+        await asyncio.Future()
+    finally:
+        if capture is not None:
+            await capture.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,1651 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: AGPL-3.0-or-later
+# monocle-bridge - Bridge for Brilliant Monocle (proot CLI → Web Bluetooth)
+# Copyright (C) 2025 actuallyrizzn
+"""
+Simulated Monocle and bridge page, for tests and benchmarks without hardware.
+
+SimulatedMonocle models the device end of the Nordic UART link: writes and
+notifications limited to the MTU payload, one-way BLE latency, a minimum gap
+between notifications, and a MicroPython-like REPL (friendly with auto-indent,
+raw and raw-paste modes) that runs code in the host Python. Raw-REPL programs run
+in a thread with the link as sys.stdin / sys.stdout and a filesystem
+jailed to a temporary directory, so bridge.html's file helpers run as-is.
+
+SimulatedBridge plays bridge.html: it registers with the relay and serves the
+same WebSocket protocol against a SimulatedMonocle, using the page's
+completion rules (prompt / raw-REPL markers) and round-robin scheduling.
+
+Run standalone to attach a simulated device to a running server:
+    python3 simulator.py [ws://127.0.0.1:8766]
+"""
+import asyncio
+import base64
+import builtins
+import codecs
+import codeop
+import collections
+import contextlib
+import ctypes
+import io
+import json
+import math
+import os
+import re
+import struct
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import types
+import zlib
+from pathlib import Path
+
+try:
+    import websockets
+except ImportError:
+    print("Install: pip install websockets")
+    sys.exit(1)
+
+PROMPT = b">>> "
+# A line the friendly REPL continues with "... " until it gets a blank line (as in bridge.html)
+COMPOUND = re.compile(r"^\s*(?:@|(?:if|for|while|def|class|with|try|async)\b)|:\s*$")
+RAW_BANNER = b"raw REPL; CTRL-B to exit\r\n>"
+FRIENDLY_BANNER = b"\r\nMicroPython v1.20.0 (simulated) on Monocle\r\nType \"help()\" for more information.\r\n>>> "
+# Run by resync: only its output (not the echo) ends with RESYNC_END
+RESYNC_LINE = b"'monocle' + '-resync'\r\n"
+RESYNC_END = b"'monocle-resync'\r\n" + PROMPT
+
+# Binary frame layout shared with server.py, monocle-cli.py and bridge.html
+FRAME_HEADER = struct.Struct("!BBHIII")  # kind, flags, reserved, client, request id, seq
+FRAME_REPL_CHUNK = 1
+FRAME_REPL_CODE = 2
+FRAME_FILE_PUSH = 3
+FRAME_FILE_DATA = 4
+FRAME_DATA = 5
+FLAG_STREAM = 1
+# Reply types that end a request; they carry the request's timestamps
+FINAL_TYPES = {"connected", "repl_response", "repl_batch_done", "repl_done", "file_done", "file_list",
+               "file_manifest", "data_done", "interrupted"}
+REQUEST_TYPES = {"connect", "repl", "repl_batch", "file_push", "file_pull", "file_ls", "file_rm", "file_manifest",
+                 "data_capture"}
+# Session resume with the relay, as in bridge.html
+RECONNECT_DELAY = 0.05
+RECONNECT_MAX_DELAY = 5.0
+REPLAY_FRAMES = 1024
+
+# File transfer, as in bridge.html
+BRIDGE_HTML = Path(__file__).resolve().parent / "bridge.html"
+FILE_HEADER = struct.Struct("<IHI")  # offset, length, CRC-32
+FILE_ATTEMPTS = 3
+FILE_PULL_CHUNK = 512
+FILE_PROGRESS_MS = 250
+FILE_PULL_CHUNK_DEFLATED = 2048
+FILE_DEFLATED = 0x8000  # length flag of a pulled frame holding a zlib stream
+FILE_FINAL_TYPES = {"file_ls": "file_list", "file_manifest": "file_manifest"}  # else file_done
+COMPRESS_MIN = 512
+COMPRESS_RATIO = 0.9
+
+# Raw data channel, as in bridge.html
+DATA_SOURCES = {"camera", "microphone"}
+DATA_FLUSH_BYTES = 4096
+DATA_FLUSH_MS = 20
+DEFAULT_SAMPLE_RATE = 8000
+DEFAULT_BIT_DEPTH = 16
+DATA_TAIL_TIMEOUT = 5.0  # bridge.html waits linkTimeout() for data the end line overtook
+DEVICE_DATA_BUFFER = 8  # raw data packets the device queues before bluetooth.send raises OSError
+
+
+def _now_ms():
+    return round(time.time() * 1000)
+
+
+def _load_device_helpers():
+    """The device programs of bridge.html's DEVICE_HELPERS, so both run the same code."""
+    block = re.search(r"const DEVICE_HELPERS = \{(.*?)\n    \};", BRIDGE_HTML.read_text(), re.S).group(1)
+    return {name: body.replace("\\\\", "\\") for name, body in re.findall(r"(\w+): `(.*?)`,", block, re.S)}
+
+
+DEVICE_HELPERS = _load_device_helpers()
+
+
+def device_helper(name, bare=False, **args):
+    """Helper program ``name`` with its $NAME placeholders filled in, as bridge.html builds it."""
+    code = ("" if bare else DEVICE_HELPERS["prelude"]) + DEVICE_HELPERS[name]
+    for key, value in args.items():
+        code = code.replace("$" + key, json.dumps(value))
+    return code
+
+
+class _DeviceStdin:
+    """Bytes written to the RX characteristic while a program runs (thread-safe)."""
+
+    def __init__(self):
+        self.buffer = self
+        self.closed = False
+        self._data = bytearray()
+        self._cond = threading.Condition()
+
+    def feed(self, data):
+        with self._cond:
+            self._data += data
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def _wait(self, ready, timeout=None):
+        # Short waits so a Ctrl-C (an async exception) reaches the waiting thread
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while not ready():
+                if self.closed:
+                    raise OSError("device closed")
+                left = 0.05 if deadline is None else min(0.05, deadline - time.monotonic())
+                if left <= 0:
+                    return False
+                self._cond.wait(left)
+            return True
+
+    def read(self, n=1):
+        self._wait(lambda: len(self._data) >= n)
+        with self._cond:
+            data = bytes(self._data[:n])
+            del self._data[:n]
+        return data
+
+    def poll(self, timeout_ms):
+        return self._wait(lambda: bool(self._data), None if timeout_ms < 0 else timeout_ms / 1000)
+
+
+class _DeviceStdout:
+    """sys.stdout of a running program: text gets CRLF line endings, .buffer is raw."""
+
+    def __init__(self, send):
+        self._send = send
+        self.buffer = types.SimpleNamespace(write=self._write_bytes)
+
+    def write(self, text):
+        self._send(text.replace("\n", "\r\n").encode())
+        return len(text)
+
+    def _write_bytes(self, data):
+        self._send(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class _DeflateIO:
+    """MicroPython's deflate.DeflateIO (zlib format), on the host's zlib."""
+
+    def __init__(self, stream, format=2, wbits=0, close=False):
+        self._stream = stream
+        self._close = close
+        self._inflater = zlib.decompressobj()
+        self._deflater = None
+        self._pending = b""
+
+    def read(self, n=-1):
+        while n < 0 or len(self._pending) < n:
+            chunk = self._stream.read(256)
+            if not chunk:
+                self._pending += self._inflater.flush()
+                break
+            self._pending += self._inflater.decompress(chunk)
+        n = len(self._pending) if n < 0 else n
+        data, self._pending = self._pending[:n], self._pending[n:]
+        return data
+
+    def write(self, data):
+        self._deflater = self._deflater or zlib.compressobj()
+        self._stream.write(self._deflater.compress(data))
+        return len(data)
+
+    def close(self):
+        if self._deflater:
+            self._stream.write(self._deflater.flush())
+        if self._close:
+            self._stream.close()
+
+
+def _test_image(size=6000):
+    """Bytes framed like a JPEG (SOI ... EOI): what the simulated camera captures."""
+    return b"\xff\xd8\xff\xe0" + bytes((i * 7 + i // 251) & 0xFF for i in range(size)) + b"\xff\xd9"
+
+
+def _test_tone(seconds, sample_rate, bit_depth, hz=440):
+    """Signed little-endian PCM of a sine tone: what the simulated microphone records."""
+    count = int(seconds * sample_rate)
+    amplitude = (1 << (bit_depth - 1)) // 4
+    samples = (round(amplitude * math.sin(2 * math.pi * hz * i / sample_rate)) for i in range(count))
+    return struct.pack(f"<{count}{'h' if bit_depth == 16 else 'b'}", *samples)
+
+
+class SimulatedMonocle:
+    """Device side of a Nordic UART link running a MicroPython-like REPL.
+
+    ``write`` is a write to the RX characteristic; TX notifications are
+    delivered to every callable in ``listeners`` as bytes. ``zlib`` picks the
+    firmware's compression support: None, "inflate" (an older build's
+    zlib.decompress) or "deflate" (the deflate module, compression included).
+
+    With ``raw_data`` the device also has the raw data service: programs
+    send on it with ``bluetooth.send`` and its notifications go to
+    ``data_listeners``. ``camera`` captures ``camera_image``; ``microphone``
+    records a tone in real time. ``display.show`` puts its primitives on
+    ``screen``, each as (constructor name, *args[, kwargs]).
+    """
+
+    name = "monocle"  # advertised BLE name
+
+    def __init__(self, mtu=128, latency=0.0, notify_interval=0.0, paste_window=128, root=None, mpy=None,
+                 zlib=None, raw_data=True):
+        self.payload = mtu - 3  # ATT header takes 3 bytes
+        self.latency = latency  # one-way BLE latency, seconds
+        self.notify_interval = notify_interval  # minimum gap between notifications
+        self.paste_window = paste_window
+        self.listeners = []
+        self.on_write = None  # optional callable(data) -> data, to inject link faults
+        self._tempdir = None if root else tempfile.TemporaryDirectory(prefix="monocle-fs-")
+        self.root = Path(root or self._tempdir.name).resolve()  # the device filesystem
+        self.mpy = mpy  # sys.implementation._mpy to report; the host cannot run .mpy files either way
+        self.zlib = zlib
+        self.raw_data = raw_data
+        self.data_listeners = []
+        self.camera_image = _test_image()
+        self.data_notifications = 0
+        self.data_bytes_out = 0
+        self.screen = []
+        self.screen_updates = 0
+        self._data_tx = None
+        self._data_notifier = None
+        self._data_slots = threading.BoundedSemaphore(DEVICE_DATA_BUFFER)
+        self.namespace = {"__name__": "__main__", "__builtins__": self._builtins()}
+        self.mode = "friendly"
+        self.writes = 0
+        self.notifications = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._line = bytearray()
+        self._block = []  # friendly-REPL lines of an unfinished compound statement
+        self._indent = 0  # spaces the friendly REPL put at the start of self._line
+        self._raw = bytearray()
+        self._paste_request = bytearray()
+        self._paste_unacked = 0
+        self._tx = None
+        self._notifier = None
+        self._loop = None
+        self._stdin = None  # while a raw-REPL program runs
+        self._stdout = None
+        self._thread = None
+        self._kbd_intr = 3
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._tx = asyncio.Queue()
+        self._notifier = asyncio.create_task(self._notify_loop())
+        self._data_tx = asyncio.Queue()
+        self._data_notifier = asyncio.create_task(self._data_notify_loop())
+
+    async def close(self):
+        if self._stdin:
+            self._stdin.close()
+        for notifier in (self._notifier, self._data_notifier):
+            if notifier:
+                notifier.cancel()
+                await asyncio.gather(notifier, return_exceptions=True)
+        self._notifier = self._data_notifier = None
+        if self._tempdir:
+            self._tempdir.cleanup()
+
+    async def write(self, data):
+        """Write one packet to the RX characteristic."""
+        if len(data) > self.payload:
+            raise ValueError(f"write of {len(data)} bytes exceeds MTU payload {self.payload}")
+        self.writes += 1
+        self.bytes_in += len(data)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.on_write:
+            data = self.on_write(data)
+        for byte in data:
+            self._feed(byte)
+
+    # --- TX side -------------------------------------------------------------
+
+    def _send(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        ready = asyncio.get_running_loop().time() + self.latency
+        for i in range(0, len(data), self.payload):
+            self._tx.put_nowait((ready, data[i:i + self.payload]))
+
+    async def _notify_loop(self):
+        loop = asyncio.get_running_loop()
+        last = 0.0
+        while True:
+            ready, chunk = await self._tx.get()
+            at = max(ready, last + self.notify_interval)
+            if at > loop.time():
+                await asyncio.sleep(at - loop.time())
+            last = loop.time()
+            self.notifications += 1
+            self.bytes_out += len(chunk)
+            for listener in list(self.listeners):
+                listener(chunk)
+
+    # --- Raw data service ----------------------------------------------------
+
+    def _send_data(self, data):
+        self._data_tx.put_nowait((asyncio.get_running_loop().time() + self.latency, data))
+
+    async def _data_notify_loop(self):
+        loop = asyncio.get_running_loop()
+        last = 0.0
+        while True:
+            ready, chunk = await self._data_tx.get()
+            at = max(ready, last + self.notify_interval)
+            if at > loop.time():
+                await asyncio.sleep(at - loop.time())
+            last = loop.time()
+            self.data_notifications += 1
+            self.data_bytes_out += len(chunk)
+            self._data_slots.release()
+            for listener in list(self.data_listeners):
+                listener(chunk)
+
+    # --- REPL ----------------------------------------------------------------
+
+    def _feed(self, byte):
+        getattr(self, "_feed_" + self.mode.replace("-", "_"))(byte)
+
+    def _feed_friendly(self, byte):
+        if byte == 0x01:
+            self.mode = "raw"
+            self._raw.clear()
+            self._send(RAW_BANNER)
+        elif byte == 0x02:
+            self._send(FRIENDLY_BANNER)
+        elif byte == 0x03:
+            self._line.clear()
+            self._block.clear()
+            self._indent = 0
+            self._send(b"\r\nKeyboardInterrupt\r\n>>> ")
+        elif byte == 0x0A:
+            line = self._line.decode()
+            typed = line[self._indent:]  # the auto-indent was echoed with the prompt
+            self._line.clear()
+            self._indent = 0
+            self._block.append(line if line.strip() else "")  # Enter on just the auto-indent ends the block
+            source = "\n".join(self._block)
+            try:
+                complete = codeop.compile_command(source, "<stdin>", "single") is not None
+            except SyntaxError:
+                complete = True
+            if complete and (len(self._block) == 1 or not line.strip()):
+                self._block.clear()
+                out, err = self._run(source, "single")
+                self._send(typed + "\r\n" + out + err + ">>> ")
+            else:
+                # Auto-indent: a continuation line starts with the indentation
+                # of the line above, one level deeper after a colon
+                self._indent = len(line) - len(line.lstrip()) + (4 if line.rstrip().endswith(":") else 0)
+                self._line.extend(b" " * self._indent)
+                self._send(typed + "\r\n... " + " " * self._indent)
+        elif byte != 0x0D:
+            self._line.append(byte)
+
+    def _feed_raw(self, byte):
+        if byte == 0x01:
+            self._raw.clear()
+            self._send(RAW_BANNER)
+        elif byte == 0x02:
+            self.mode = "friendly"
+            self._send(FRIENDLY_BANNER)
+        elif byte == 0x03:
+            self._raw.clear()
+        elif byte == 0x04:
+            self._send("OK")
+            self._start_program()
+        elif byte == 0x05 and not self._raw:
+            self.mode = "paste-request"
+            self._paste_request.clear()
+        else:
+            self._raw.append(byte)
+
+    def _feed_paste_request(self, byte):
+        self._paste_request.append(byte)
+        if len(self._paste_request) < 2:
+            return
+        if bytes(self._paste_request) == b"A\x01":
+            self.mode = "paste"
+            self._raw.clear()
+            self._paste_unacked = 0
+            self._send(b"R\x01" + struct.pack("<H", self.paste_window))
+        else:
+            self.mode = "raw"
+
+    def _feed_paste(self, byte):
+        if byte == 0x04:
+            self._send(b"\x04")
+            self._start_program()
+            return
+        if byte == 0x03:
+            # Ctrl-C aborts the paste; it is reported like a compile error
+            self._send(b"\x04")
+            self._raw.clear()
+            self.mode = "raw"
+            self._send("\x04Traceback (most recent call last):\r\nKeyboardInterrupt: \r\n\x04>")
+            return
+        self._raw.append(byte)
+        self._paste_unacked += 1
+        if self._paste_unacked > self.paste_window:
+            raise RuntimeError("raw-paste window overrun")
+        if self._paste_unacked == self.paste_window:
+            self._paste_unacked = 0
+            self._send(b"\x01")
+
+    def _feed_running(self, byte):
+        if byte == 0x03 and self._kbd_intr == 3:
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                ctypes.c_ulong(self._thread.ident), ctypes.py_object(KeyboardInterrupt))
+        else:
+            self._stdin.feed(bytes([byte]))
+
+    def _exec(self, source, mode):
+        """Run source in the device namespace; return the traceback text ("" if none)."""
+        try:
+            exec(compile(source, "<stdin>", mode), self.namespace)
+        except (Exception, KeyboardInterrupt) as e:  # the REPL reports it; it does not stop the device
+            lineno = getattr(e, "lineno", None) or (traceback.extract_tb(e.__traceback__)[-1].lineno)
+            return (
+                "Traceback (most recent call last):\n"
+                f'  File "<stdin>", line {lineno}, in <module>\n'
+                + "".join(traceback.format_exception_only(type(e), e))
+            )
+        return ""
+
+    def _run(self, source, mode):
+        """Run source to completion (friendly REPL); return (stdout, traceback) with CRLF endings."""
+        out = io.StringIO()
+        self._stdout = _DeviceStdout(lambda data: out.write(data.decode(errors="replace")))
+        with contextlib.redirect_stdout(out):
+            err = self._exec(source, mode)
+        return out.getvalue().replace("\r\n", "\n").replace("\n", "\r\n"), err.replace("\n", "\r\n")
+
+    def _start_program(self):
+        """Run the raw-REPL buffer in a thread, with the link as its stdin and stdout."""
+        source = self._raw.decode()
+        self._raw.clear()
+        self.mode = "running"
+        self._stdin = _DeviceStdin()
+        self._stdout = _DeviceStdout(lambda data: self._loop.call_soon_threadsafe(self._send, data))
+
+        def run():
+            err = self._exec(source, "exec")
+            self._loop.call_soon_threadsafe(self._program_done, err)
+
+        self._thread = threading.Thread(target=run, name="monocle-program", daemon=True)
+        self._thread.start()
+
+    def _program_done(self, err):
+        # Input the program did not read goes to the raw REPL, as on the device
+        unread = bytes(self._stdin._data)
+        self.mode = "raw"
+        self._stdin = None
+        self._kbd_intr = 3
+        self._send("\x04" + err.replace("\n", "\r\n") + "\x04>")
+        for byte in unread:
+            self._feed(byte)
+
+    # --- Device modules and filesystem -----------------------------------------
+
+    def _path(self, path):
+        """Host path of a device path, which may not leave the device root."""
+        full = (self.root / str(path).lstrip("/")).resolve()
+        if full != self.root and self.root not in full.parents:
+            raise OSError(2, "ENOENT")
+        return full
+
+    def _builtins(self):
+        table = dict(vars(builtins))
+        modules = {"os": self._os_module(), "sys": self._sys_module(), "time": self._time_module(),
+                   "micropython": self._micropython_module(), "select": self._select_module(),
+                   "bluetooth": self._bluetooth_module(), "camera": self._camera_module(),
+                   "microphone": self._microphone_module(), "display": self._display_module(),
+                   "deflate": None, "zlib": None}
+        if self.zlib == "deflate":
+            modules["deflate"] = self._module("deflate", DeflateIO=_DeflateIO, AUTO=0, RAW=1, ZLIB=2, GZIP=3)
+        elif self.zlib == "inflate":
+            modules["zlib"] = self._module("zlib", decompress=zlib.decompress)
+
+        def device_import(name, globals=None, locals=None, fromlist=(), level=0):
+            if name in modules:
+                if modules[name] is None:
+                    raise ImportError(f"no module named '{name}'")
+                return modules[name]
+            return builtins.__import__(name, globals, locals, fromlist, level)
+
+        def device_open(path, mode="r", *args, **kwargs):
+            return builtins.open(self._path(path), mode, *args, **kwargs)
+
+        def device_print(*args, sep=" ", end="\n", file=None):
+            (file or self._stdout).write(sep.join(str(a) for a in args) + end)
+
+        table.update(__import__=device_import, open=device_open, print=device_print)
+        return table
+
+    def _module(self, name, **attrs):
+        module = types.ModuleType(name)
+        module.__dict__.update(attrs)
+        return module
+
+    def _os_module(self):
+        return self._module(
+            "os",
+            listdir=lambda path="": os.listdir(self._path(path)),
+            stat=lambda path: tuple(os.stat(self._path(path)))[:10],
+            remove=lambda path: os.remove(self._path(path)),
+            rename=lambda old, new: os.rename(self._path(old), self._path(new)),
+            mkdir=lambda path: os.mkdir(self._path(path)),
+            rmdir=lambda path: os.rmdir(self._path(path)),
+            getcwd=lambda: "/",
+        )
+
+    def _sys_module(self):
+        device = self
+
+        class DeviceSys(types.ModuleType):
+            platform = "monocle"
+
+            @property
+            def implementation(self):
+                info = types.SimpleNamespace(name="micropython", version=(1, 20, 0))
+                if device.mpy is not None:
+                    info._mpy = device.mpy
+                return info
+
+            @property
+            def stdin(self):
+                return device._stdin
+
+            @property
+            def stdout(self):
+                return device._stdout
+
+        return DeviceSys("sys")
+
+    def _time_module(self):
+        return self._module(
+            "time",
+            time=time.time, sleep=time.sleep, localtime=time.localtime,
+            sleep_ms=lambda ms: time.sleep(ms / 1000),
+            sleep_us=lambda us: time.sleep(us / 1e6),
+            ticks_ms=lambda: int(time.monotonic() * 1000),
+            ticks_us=lambda: int(time.monotonic() * 1e6),
+            ticks_add=lambda ticks, delta: ticks + delta,
+            ticks_diff=lambda new, old: new - old,
+        )
+
+    def _bluetooth_module(self):
+        def send(data):
+            if not self.raw_data:
+                raise OSError("raw data service not available")
+            if len(data) > self.payload:
+                raise ValueError(f"data exceeds max_length() of {self.payload}")
+            if not self._data_slots.acquire(blocking=False):
+                raise OSError("busy")  # the notification queue is full
+            self._loop.call_soon_threadsafe(self._send_data, bytes(data))
+
+        return self._module("bluetooth", send=send, max_length=lambda: self.payload, connected=lambda: True)
+
+    def _camera_module(self):
+        state = {"image": b""}
+
+        def capture():
+            state["image"] = self.camera_image
+
+        def read(n=254):
+            data, state["image"] = state["image"][:n], state["image"][n:]
+            return data or None
+
+        return self._module("camera", capture=capture, read=read, image_ready=lambda: True)
+
+    def _microphone_module(self):
+        state = {"pcm": b"", "width": 2, "rate": DEFAULT_SAMPLE_RATE, "started": 0.0, "read": 0}
+
+        def record(seconds=5.0, sample_rate=DEFAULT_SAMPLE_RATE, bit_depth=DEFAULT_BIT_DEPTH):
+            state.update(pcm=_test_tone(seconds, sample_rate, bit_depth), width=bit_depth // 8,
+                         rate=sample_rate, started=time.monotonic(), read=0)
+
+        def read(samples=127):
+            # Only what has been recorded so far; None once it has all been read
+            width = state["width"]
+            recorded = min(len(state["pcm"]), int((time.monotonic() - state["started"]) * state["rate"]) * width)
+            if state["read"] >= len(state["pcm"]):
+                return None
+            end = min(recorded, state["read"] + samples * width)
+            data = state["pcm"][state["read"]:end]
+            state["read"] = end
+            return data
+
+        return self._module("microphone", record=record, read=read)
+
+    def _display_module(self):
+        def primitive(name):
+            return lambda *args, **kwargs: (name, *args, kwargs) if kwargs else (name, *args)
+
+        def show(*objects):
+            self.screen = list(objects)
+            self.screen_updates += 1
+
+        def clear():
+            show()
+
+        names = ("Text", "Rectangle", "Line", "HLine", "VLine", "Fill", "Polygon", "Polyline")
+        constants = ("TOP_LEFT", "TOP_CENTER", "TOP_RIGHT", "MIDDLE_LEFT", "MIDDLE_CENTER", "MIDDLE_RIGHT",
+                     "BOTTOM_LEFT", "BOTTOM_CENTER", "BOTTOM_RIGHT")
+        return self._module("display", show=show, clear=clear, WIDTH=640, HEIGHT=400,
+                            **{name: primitive(name) for name in names}, **{name: name for name in constants})
+
+    def _micropython_module(self):
+        def kbd_intr(char):
+            self._kbd_intr = char
+
+        return self._module("micropython", kbd_intr=kbd_intr, const=lambda value: value)
+
+    def _select_module(self):
+        class Poll:
+            def __init__(self):
+                self._streams = []
+
+            def register(self, stream, mask=1):
+                self._streams.append(stream)
+
+            def poll(self, timeout=-1):
+                ready = self._streams and self._streams[0].poll(timeout)
+                return [(self._streams[0], 1)] if ready else []
+
+        return self._module("select", poll=Poll, POLLIN=1)
+
+
+class _TxReader:
+    """Byte buffer over a device's TX notifications with marker-based reads."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.heard = None  # called on the next notification, then cleared
+        self.failure = None  # set by fail(); reads raise until reset()
+        self._event = asyncio.Event()
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        if self.heard:
+            heard, self.heard = self.heard, None
+            heard()
+        self._event.set()
+
+    def fail(self, reason):
+        """Make pending and later reads raise RuntimeError(reason), like a tripped link watchdog."""
+        self.failure = reason
+        self._event.set()
+
+    def reset(self):
+        self.buffer.clear()
+        self.failure = None
+
+    def _check(self):
+        if self.failure:
+            raise RuntimeError(self.failure)
+
+    async def _wait(self):
+        self._event.clear()
+        await self._event.wait()
+        self._check()
+
+    async def read(self, n):
+        self._check()
+        while len(self.buffer) < n:
+            await self._wait()
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    async def read_until(self, marker, on_data=None):
+        """Return the bytes before ``marker``; with on_data, hand them over as they arrive."""
+        self._check()
+        while True:
+            end = self.buffer.find(marker)
+            if end != -1:
+                data = bytes(self.buffer[:end])
+                del self.buffer[:end + len(marker)]
+                if on_data is None:
+                    return data
+                if data:
+                    on_data(data)
+                return b""
+            safe = len(self.buffer) - len(marker) + 1
+            if on_data is not None and safe > 0:
+                on_data(bytes(self.buffer[:safe]))
+                del self.buffer[:safe]
+            await self._wait()
+
+
+class SimulatedBridge:
+    """Stand-in for bridge.html that serves the relay protocol from a SimulatedMonocle."""
+
+    features = ["binary"]
+
+    def __init__(self, url, device=None, compress=True, device_id=None):
+        self.url = url
+        self.device = device or SimulatedMonocle()
+        self.device_id = device_id  # registered as the page's device id (bridge.html ?device=)
+        self.compress = compress  # bridge.html without ?compress=0
+        self.ws = None
+        self.connected = False  # BLE link up (set by a connect request)
+        self.device_zlib = None  # the device's zlib level once probed
+        self.srtt = None
+        self.rttvar = 0.0
+        self._queues = {}  # priority -> OrderedDict(client -> deque of requests)
+        self._busy = False
+        self._active = None  # the request the device is working on
+        self._tasks = []
+        self._rx = _TxReader()
+        self.device.listeners.append(self._rx.feed)
+        self.device.data_listeners.append(self._on_data)
+        self._data_sink = None  # set while a data_capture owns the raw data channel
+        self._samples = {"write_ms": [], "notify_ms": []}  # BLE samples since the last report
+        self._ble_connects = 0
+        self.session = None
+        self._sent = 0
+        self._received = 0
+        self._log = collections.deque()  # (ordinal, frame) of the last frames sent
+        self._ready = False  # registered on the current websocket
+
+    async def start(self):
+        await self.device.start()
+        await self._connect()
+        await self._report_link_state()
+        self._tasks.append(asyncio.create_task(self._recv_loop()))
+
+    async def _connect(self):
+        """Open the websocket and register, resuming the session if there is one."""
+        self.ws = await websockets.connect(self.url, max_size=None)
+        hello = {"role": "bridge", "features": self.features, "resume": True}
+        if self.device_id is not None:
+            hello["device"] = self.device_id
+        if self.session:
+            hello.update(session=self.session, received=self._received)
+        await self.ws.send(json.dumps(hello))
+        reg = json.loads(await self.ws.recv())
+        missed = []
+        if reg.get("resumed"):
+            self._received += 1
+            missed = [frame for ordinal, frame in self._log if ordinal > reg["received"]]
+        else:
+            self._received = 1
+        # Renumbered as the relay counts them from here
+        received = reg.get("received", 0)
+        self._log = collections.deque((received + 1 + i, frame) for i, frame in enumerate(missed))
+        self._sent = received + len(missed)
+        self.session = reg.get("session")
+        self._ready = True
+        for frame in missed:
+            await self.ws.send(frame)
+
+    async def _reconnect(self):
+        delay = RECONNECT_DELAY
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self._connect()
+                return
+            except (OSError, websockets.exceptions.WebSocketException):
+                delay = min(2 * delay, RECONNECT_MAX_DELAY)
+
+    def drop_connection(self):
+        """Lose the websocket without a close handshake, as when Android backgrounds the tab."""
+        self.ws.transport.abort()
+
+    async def _send(self, data):
+        # Every frame to the relay goes through here, so it can be replayed
+        if self.session:
+            self._sent += 1
+            self._log.append((self._sent, data))
+            if len(self._log) > REPLAY_FRAMES:
+                self._log.popleft()
+        if self._ready:
+            try:
+                await self.ws.send(data)
+            except websockets.exceptions.ConnectionClosed:
+                pass  # replayed once the session is resumed
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        if self.ws:
+            await self.ws.close()
+        await self.device.close()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # --- WebSocket side ------------------------------------------------------
+
+    async def _recv_loop(self):
+        while True:
+            with contextlib.suppress(websockets.exceptions.ConnectionClosed):
+                async for message in self.ws:
+                    self._received += 1
+                    msg = json.loads(message) if isinstance(message, str) else self._decode_frame(message)
+                    msg["recv_at"] = _now_ms()
+                    if msg.get("type") == "interrupt":
+                        await self._interrupt(msg)  # out of band, as in bridge.html
+                    elif msg.get("type") in REQUEST_TYPES:
+                        self._enqueue(msg)
+            self._ready = False
+            await self._reconnect()
+
+    def _decode_frame(self, data):
+        kind, flags, _, client, rid, _ = FRAME_HEADER.unpack_from(data)
+        msg = {"client": client, "id": rid, "binary": True}
+        payload = data[FRAME_HEADER.size:]
+        if kind == FRAME_REPL_CODE:
+            msg.update(type="repl", code=payload.decode(), stream=bool(flags & FLAG_STREAM))
+        elif kind == FRAME_FILE_PUSH:
+            path, _, contents = payload.partition(b"\0")
+            msg.update(type="file_push", path=path.decode(), data=contents)
+        return msg
+
+    async def _reply(self, msg, frame):
+        # Compact, client first and timing last, exactly as bridge.html writes it
+        out = {"client": msg.get("client"), "id": msg.get("id"), **frame}
+        if frame["type"] in FINAL_TYPES:
+            out["timing"] = {"recv": msg.get("recv_at"), "start": msg.get("start_at"), "done": _now_ms()}
+        await self._send(json.dumps(out, separators=(",", ":")))
+
+    async def disconnect(self):
+        """Drop the BLE link, as on a gattserverdisconnected event."""
+        self.connected = False
+        await self._report_link_state()
+
+    async def _report_link_state(self):
+        report = {"type": "link_state", "connected": self.connected, "device": self.device.name}
+        await self._send(json.dumps(report, separators=(",", ":")))
+
+    async def _report_metrics(self):
+        queued = sum(len(q) for clients in self._queues.values() for q in clients.values())
+        report = {"type": "bridge_metrics", "queued": queued,
+                  **self._samples, "ble_connects": self._ble_connects}
+        self._samples = {"write_ms": [], "notify_ms": []}
+        self._ble_connects = 0
+        await self._send(json.dumps(report, separators=(",", ":")))
+
+    async def _send_frame(self, kind, msg, seq, payload):
+        await self._send(FRAME_HEADER.pack(kind, 0, 0, msg.get("client") or 0, msg.get("id") or 0, seq) + payload)
+
+    def _enqueue(self, msg):
+        priority = msg.get("priority")
+        level = priority if isinstance(priority, int) else 0
+        clients = self._queues.setdefault(level, collections.OrderedDict())
+        clients.setdefault(msg.get("client"), collections.deque()).append(msg)
+        if not self._busy:
+            # Busy from here, like pump() in bridge.html, so a request arriving
+            # before the task starts does not start a second one
+            self._busy = True
+            self._tasks.append(asyncio.create_task(self._pump()))
+
+    def _next_request(self):
+        if not self._queues:
+            return None
+        level = max(self._queues)
+        clients = self._queues[level]
+        client, queue = next(iter(clients.items()))
+        msg = queue.popleft()
+        # Move this client to the back so the next one gets the following turn
+        del clients[client]
+        if queue:
+            clients[client] = queue
+        if not clients:
+            del self._queues[level]
+        return msg
+
+    async def _pump(self):
+        try:
+            while (msg := self._next_request()) is not None:
+                msg["start_at"] = _now_ms()
+                self._active = msg
+                await self._handle(msg)
+                self._active = None
+                if msg.get("abandoned"):
+                    await self._resync()
+                await self._report_metrics()
+        finally:
+            self._active = None
+            self._busy = False
+
+    # --- Interrupts (bridge.html "Interrupts") --------------------------------
+
+    @staticmethod
+    def _final_type(msg):
+        if msg["type"] == "connect":
+            return "connected"
+        if msg["type"] == "repl":
+            return "repl_done" if msg.get("stream") else "repl_response"
+        if msg["type"] == "repl_batch":
+            return "repl_batch_done"
+        if msg["type"] == "data_capture":
+            return "data_done"
+        return FILE_FINAL_TYPES.get(msg["type"], "file_done")
+
+    async def _fail_request(self, msg, error):
+        final = self._final_type(msg)
+        msg.setdefault("start_at", _now_ms())
+        if final == "repl_response":
+            await self._reply(msg, {"type": final, "data": "ERROR: " + error})
+        elif final == "repl_batch_done":
+            await self._reply(msg, {"type": final, "count": 0, "error": error})
+        else:
+            await self._reply(msg, {"type": final, "ok": False, "error": error})
+
+    async def _interrupt(self, msg):
+        msg["start_at"] = _now_ms()
+        ids = msg.get("ids")
+
+        def targets(req):
+            return req.get("client") == msg.get("client") and (ids is None or req.get("id") in ids)
+
+        cancelled = []
+        for level in list(self._queues):
+            clients = self._queues[level]
+            queue = clients.get(msg.get("client"))
+            if not queue:
+                continue
+            cancelled += [req for req in queue if targets(req)]
+            queue = collections.deque(req for req in queue if not targets(req))
+            if queue:
+                clients[msg.get("client")] = queue
+            else:
+                del clients[msg.get("client")]
+            if not clients:
+                del self._queues[level]
+        for req in cancelled:
+            await self._fail_request(req, "cancelled")
+        running = self._active is not None and targets(self._active)
+        if running:
+            await self._interrupt_active(self._active)
+        await self._reply(msg, {"type": "interrupted", "running": running, "cancelled": len(cancelled)})
+
+    async def _interrupt_active(self, msg):
+        msg["interrupted"] = msg.get("interrupted", 0) + 1
+        if msg["type"] in ("file_push", "connect"):
+            return  # _push_frames ends a push with a bad frame
+        msg["ctrl_c"] = True
+        await self.device.write(b"\x03")
+        if msg["type"] != "repl" or msg["interrupted"] > 1:
+            msg["abandoned"] = True
+            self._rx.fail("interrupted")
+
+    def _ctrl_c_sent(self):
+        return bool(self._active and self._active.get("ctrl_c"))
+
+    async def _resync(self):
+        self._rx.reset()
+        self._expect()
+        await self._write(b"\x03\x03\x02" + RESYNC_LINE)
+        await self._rx.read_until(RESYNC_END)
+
+    async def _handle(self, msg):
+        if msg["type"] == "connect":
+            frame = {"type": "connected", "ok": True, "device": self.device.name}
+            if self.connected and not msg.get("fresh"):
+                frame["reused"] = True  # the GATT connection is still up
+            else:
+                self.connected = True
+                self.device_zlib = None
+                self._ble_connects += 1
+                await self._report_link_state()
+            await self._reply(msg, frame)
+        elif msg["type"] == "repl" and msg.get("stream"):
+            await self._stream_repl(msg)
+        elif msg["type"] == "repl":
+            out = []
+            result = await self._run_repl(msg, lambda data: out.append(data), lambda: self._started(msg))
+            data = "ERROR: " + result["error"] if result.get("error") else "".join(out).strip()
+            frame = {"type": "repl_response", "data": data}
+            if msg.get("interrupted"):
+                frame["interrupted"] = True
+            await self._reply(msg, {**frame, **self._link_stats()})
+        elif msg["type"] == "repl_batch":
+            await self._batch(msg)
+        elif msg["type"].startswith("file_"):
+            await self._file(msg)
+        elif msg["type"] == "data_capture":
+            await self._capture_data(msg)
+
+    # --- Link timing ---------------------------------------------------------
+
+    def _sample_rtt(self, ms):
+        if self.srtt is None:
+            self.srtt, self.rttvar = ms, ms / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - ms)
+            self.srtt = 0.875 * self.srtt + 0.125 * ms
+
+    def _link_stats(self):
+        if self.srtt is None:
+            return {}
+        return {"rtt_ms": round(self.srtt), "rto_ms": round(self.srtt + max(10, 4 * self.rttvar))}
+
+    def _expect(self):
+        sent = time.perf_counter()
+
+        def heard():
+            ms = (time.perf_counter() - sent) * 1000
+            self._sample_rtt(ms)
+            self._samples["notify_ms"].append(ms)
+
+        self._rx.heard = heard
+
+    # --- Device side ---------------------------------------------------------
+
+    async def _write(self, data, stop=None):
+        """Write data in MTU-sized packets; stop early once stop() returns true."""
+        if isinstance(data, str):
+            data = data.encode()
+        for i in range(0, len(data), self.device.payload):
+            if stop and stop():
+                return
+            started = time.perf_counter()
+            await self.device.write(data[i:i + self.device.payload])
+            self._samples["write_ms"].append((time.perf_counter() - started) * 1000)
+
+    @staticmethod
+    def _terminated(code):
+        text = code.rstrip("\n")
+        return text + ("\n\n" if "\n" in text or COMPOUND.search(text) else "\n")
+
+    def _needs_raw_paste(self, code):
+        return "\n" in code.strip() or bool(COMPOUND.search(code)) or len(code) > self.device.payload
+
+    async def _run_repl(self, msg, emit, on_started=None):
+        """Run msg["code"], passing decoded output to emit; return {"ok", "error"?}."""
+        if not self.connected:
+            return {"ok": False, "error": "Not connected to Monocle"}
+        self._rx.buffer.clear()
+        if self._needs_raw_paste(msg["code"]):
+            try:
+                return await self._raw_paste(await self._paste_code(msg["code"]), emit, on_started)
+            except RuntimeError as e:
+                return {"ok": False, "error": str(e)}
+        ok = True
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+
+        def output(data):
+            nonlocal ok
+            text = decoder.decode(data)
+            if "Traceback (most recent call last)" in text:
+                ok = False
+            emit(text)
+
+        self._expect()
+        await self._write(self._terminated(msg["code"]))
+        await self._rx.read_until(b"\r\n")  # echo of the input line
+        if on_started:
+            await on_started()
+        await self._rx.read_until(PROMPT, output)
+        return {"ok": ok}
+
+    async def _raw_paste(self, code, emit, on_started=None, during=None, emit_err=None):
+        try:
+            return await self._raw_paste_run(code, emit, on_started, during, emit_err)
+        except RuntimeError:
+            if self._ctrl_c_sent():
+                self._active["abandoned"] = True  # _pump resyncs the REPL
+            raise
+
+    def _abandon_if_interrupted(self):
+        if self._ctrl_c_sent():
+            raise RuntimeError("interrupted")
+
+    async def _raw_paste_run(self, code, emit, on_started, during, emit_err):
+        data = code.encode()
+        self._abandon_if_interrupted()
+        self._expect()
+        await self._write(b"\r\x01")
+        await self._rx.read_until(RAW_BANNER)
+        self._abandon_if_interrupted()
+        await self._write(b"\x05A\x01")
+        reply = await self._rx.read(2)
+        if reply == b"R\x01":
+            increment = struct.unpack("<H", await self._rx.read(2))[0]
+            window = increment
+            offset = 0
+            while offset < len(data) and not self._ctrl_c_sent():
+                while window == 0 or self._rx.buffer:
+                    if (await self._rx.read(1)) == b"\x01":
+                        window += increment
+                n = min(window, len(data) - offset)
+                await self._write(data[offset:offset + n], self._ctrl_c_sent)
+                offset += n
+                window -= n
+            if self._ctrl_c_sent():
+                # The device ends the paste with \x04 and reports KeyboardInterrupt
+                while (await self._rx.read(1)) != b"\x04":
+                    pass
+            else:
+                await self._write(b"\x04")
+                await self._rx.read_until(b"\x04")
+        else:
+            increment = 128
+            await self._write(data, self._ctrl_c_sent)
+            self._abandon_if_interrupted()
+            await self._write(b"\x04")
+            await self._rx.read_until(b"OK")
+        if on_started:
+            await on_started()
+        if during:
+            await during(increment)
+        ok = True
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+
+        def error(chunk):
+            nonlocal ok
+            ok = False
+            (emit_err or emit)(decoder.decode(chunk))
+
+        await self._rx.read_until(b"\x04", lambda chunk: emit(decoder.decode(chunk)))
+        await self._rx.read_until(b"\x04", error)
+        await self._rx.read_until(b">")
+        await self._write(b"\x02")
+        await self._rx.read_until(PROMPT)
+        return {"ok": ok}
+
+    async def _started(self, msg):
+        """Tell the CLI the device is running msg's code: from here on only the link is timed."""
+        await self._reply(msg, {"type": "repl_started", **self._link_stats()})
+
+    async def _stream_repl(self, msg):
+        output = asyncio.Queue()  # decoded chunks, then None when the run ends
+
+        async def run():
+            try:
+                return await self._run_repl(msg, output.put_nowait, lambda: self._started(msg))
+            finally:
+                output.put_nowait(None)
+
+        task = asyncio.create_task(run())
+        seq = 0
+        while (data := await output.get()) is not None:
+            if msg.get("binary"):
+                await self._send_frame(FRAME_REPL_CHUNK, msg, seq, data.encode())
+            else:
+                await self._reply(msg, {"type": "repl_chunk", "data": data})
+            seq += 1
+        result = await task
+        if msg.get("interrupted"):
+            result["interrupted"] = True
+        await self._reply(msg, {"type": "repl_done", **result, **self._link_stats()})
+
+    async def _batch(self, msg):
+        snippets = msg.get("snippets", [])
+        if not self.connected:
+            await self._reply(msg, {"type": "repl_batch_done", "count": 0, "error": "Not connected to Monocle"})
+            return
+        done = {"count": 0}
+        started = []
+
+        async def on_started():
+            if not started:
+                started.append(True)
+                await self._started(msg)
+
+        async def result(index, data):
+            await self._reply(msg, {"type": "repl_batch_result", "index": index, "data": data.strip()})
+            done["count"] += 1
+
+        index = 0
+        try:
+            while index < len(snippets) and not self._ctrl_c_sent():
+                if self._needs_raw_paste(snippets[index]):
+                    # Blocks go through raw-paste: the friendly REPL would auto-indent them again
+                    out = []
+                    await self._raw_paste(await self._paste_code(snippets[index]), out.append, on_started)
+                    await result(index, "".join(out))
+                    index += 1
+                else:
+                    end = index
+                    while end < len(snippets) and not self._needs_raw_paste(snippets[end]):
+                        end += 1
+                    await self._pipeline(snippets, index, end, result, on_started)
+                    index = end
+        except RuntimeError as e:
+            done["error"] = str(e)
+        await self._reply(msg, {"type": "repl_batch_done", **done, **self._link_stats()})
+
+    async def _pipeline(self, snippets, start, end, result, on_started):
+        """Write single-line snippets[start:end] back to back; match results up by prompt."""
+        self._rx.buffer.clear()
+
+        async def write_all():
+            for code in snippets[start:end]:
+                if self._ctrl_c_sent():
+                    break
+                await self._write(self._terminated(code))
+                await on_started()
+
+        self._expect()
+        writer = asyncio.create_task(write_all())
+        try:
+            for index in range(start, end):
+                out = (await self._rx.read_until(PROMPT)).decode(errors="replace")
+                await result(index, "\r\n".join(out.split("\r\n")[1:]))  # drop the echo
+        finally:
+            await writer
+
+    # --- File transfer (bridge.html "File transfer") -------------------------
+
+    async def _file(self, msg):
+        final = FILE_FINAL_TYPES.get(msg["type"], "file_done")
+        if not self.connected:
+            await self._reply(msg, {"type": final, "ok": False, "error": "Not connected to Monocle"})
+            return
+        handler = {"file_push": self._push_file, "file_pull": self._pull_file,
+                   "file_ls": self._list_files, "file_rm": self._remove_file,
+                   "file_manifest": self._read_manifest}[msg["type"]]
+        self._rx.buffer.clear()
+        try:
+            await handler(msg)
+        except RuntimeError as e:
+            await self._reply(msg, {"type": final, "ok": False, "path": msg.get("path"), "error": str(e),
+                                    **self._link_stats()})
+
+    async def _file_line(self):
+        self._expect()
+        return (await self._rx.read_until(b"\n")).decode(errors="replace").rstrip("\r")
+
+    def _file_progress(self, msg, total):
+        last = 0.0
+
+        async def progress(done):
+            nonlocal last
+            now = time.perf_counter()
+            if (now - last) * 1000 < FILE_PROGRESS_MS and done < total:
+                return
+            last = now
+            await self._reply(msg, {"type": "file_progress", "done": done, "total": total})
+
+        return progress
+
+    @staticmethod
+    def _throughput(size, started):
+        elapsed = (time.perf_counter() - started) * 1000
+        return {"elapsed_ms": round(elapsed), "bytes_per_s": round(size * 1000 / max(elapsed, 1))}
+
+    async def _run_helper(self, code, during=None):
+        """Raw-paste a helper program; return (stdout, traceback)."""
+        out, err = [], []
+        await self._raw_paste(code, out.append, during=during, emit_err=err.append)
+        return "".join(out), "".join(err)
+
+    async def _push_file(self, msg):
+        data = msg["data"] if isinstance(msg["data"], bytes) else base64.b64decode(msg.get("data", ""))
+        packed = await self._deflate_for_device(data)
+        wire = packed or data
+        started = time.perf_counter()
+        progress = self._file_progress(msg, len(data))
+        resumed_from = None
+
+        async def sent(offset):
+            await progress(round(offset * len(data) / len(wire)))
+
+        for _ in range(FILE_ATTEMPTS):
+            result = {}
+            if msg.get("interrupted"):
+                raise RuntimeError("interrupted")
+
+            async def during(window):
+                result.update(await self._push_frames(wire, data, msg.get("window") or window, sent))
+
+            await self._run_helper(device_helper("push", PATH=msg["path"], DEFLATED=1 if packed else 0), during)
+            if "fatal" in result:
+                raise RuntimeError(result["fatal"])
+            if result.get("interrupted"):
+                raise RuntimeError("interrupted")
+            if resumed_from is None:
+                resumed_from = result["resumed_from"]
+            if result.get("done"):
+                if not result["ok"]:
+                    raise RuntimeError("size or CRC of the file on the device does not match")
+                frame = {"type": "file_done", "ok": True, "path": msg["path"], "size": len(data),
+                         "resumed_from": resumed_from}
+                if packed:
+                    frame["ble_bytes"] = len(wire) - resumed_from
+                delivered = round((len(wire) - resumed_from) * len(data) / len(wire)) if wire else 0
+                await self._reply(msg, {**frame, **self._throughput(delivered, started), **self._link_stats()})
+                return
+        raise RuntimeError("too many corrupted frames")
+
+    async def _push_frames(self, wire, data, window, progress):
+        """Send wire (data, or data as a zlib stream); check the device's copy against data."""
+        ready = await self._file_line()
+        if not ready.startswith("R"):
+            return {"fatal": ready[1:] or "no reply from device"}
+        have, have_crc = map(int, ready[1:].split())
+        keep = 0 < have <= len(wire) and zlib.crc32(wire[:have]) == have_crc
+        offset = have if keep else 0
+        resumed_from = offset
+
+        def interrupted():
+            return bool(self._active and self._active.get("interrupted"))
+
+        await self._write(("K" if keep or interrupted() else "Z") + f"{window}\n")
+        payload = max(16, min(self.device.payload, window // 2) - FILE_HEADER.size)
+        inflight = collections.deque()  # (end offset, frame size) of unacknowledged frames
+        inflight_bytes = 0
+        ended = False
+        while True:
+            if not ended and interrupted():
+                # A frame for the wrong offset: the device keeps the .part and answers E
+                await self._write(FILE_HEADER.pack(0xFFFFFFFF, 1, 0) + b"\0")
+                ended = True
+            while not ended:
+                chunk = wire[offset:offset + payload]
+                frame = FILE_HEADER.pack(offset, len(chunk), zlib.crc32(chunk) if chunk else 0) + chunk
+                if inflight and inflight_bytes + len(frame) > window:
+                    break
+                await self._write(frame)
+                if not chunk:
+                    ended = True
+                    break
+                offset += len(chunk)
+                inflight.append((offset, len(frame)))
+                inflight_bytes += len(frame)
+                await progress(offset)
+            line = await self._file_line()
+            kind, arg = line[:1], line[1:]
+            if kind == "A":
+                while inflight and inflight[0][0] <= int(arg):
+                    inflight_bytes -= inflight.popleft()[1]
+            elif kind == "D":
+                size, crc = map(int, arg.split())
+                return {"done": True, "ok": size == len(data) and crc == zlib.crc32(data),
+                        "resumed_from": resumed_from}
+            elif kind == "E":
+                return {"offset": int(arg), "resumed_from": resumed_from, "interrupted": interrupted()}
+            else:
+                return {"fatal": arg or line}
+
+    async def _pull_file(self, msg):
+        started = time.perf_counter()
+        resumed_from = offset = msg.get("offset") or 0
+        seq = 0
+        progress = None
+        ble_bytes = 0
+        deflate = await self._device_zlib_level() >= 2
+
+        async def on_data(data, start, size):
+            nonlocal seq, progress
+            if msg.get("binary"):
+                await self._send_frame(FRAME_FILE_DATA, msg, seq, data)
+            else:
+                await self._reply(msg, {"type": "file_data", "seq": seq, "data": base64.b64encode(data).decode()})
+            seq += 1
+            progress = progress or self._file_progress(msg, size)
+            await progress(start + len(data))
+
+        for _ in range(FILE_ATTEMPTS):
+            result = {}
+
+            async def during(window):
+                result.update(await self._pull_frames(offset, on_data))
+
+            helper = device_helper("pull", PATH=msg["path"], OFFSET=offset,
+                                   CHUNK=FILE_PULL_CHUNK_DEFLATED if deflate else FILE_PULL_CHUNK,
+                                   DEFLATE=1 if deflate else 0)
+            await self._run_helper(helper, during)
+            if "fatal" in result:
+                raise RuntimeError(result["fatal"])
+            offset = result["offset"]
+            ble_bytes += result["ble_bytes"]
+            if result.get("done"):
+                frame = {"type": "file_done", "ok": True, "path": msg["path"], "size": result["size"],
+                         "crc": result["crc"], "resumed_from": resumed_from}
+                if deflate:
+                    frame["ble_bytes"] = ble_bytes
+                await self._reply(msg, {**frame, **self._throughput(offset - resumed_from, started),
+                                        **self._link_stats()})
+                return
+        raise RuntimeError("too many corrupted frames")
+
+    async def _pull_frames(self, offset, on_data):
+        start = await self._file_line()
+        if not start.startswith("S"):
+            return {"fatal": start[1:] or "no reply from device"}
+        size = int(start[1:].split()[0])
+        good = True
+        ble_bytes = 0
+        while True:
+            if len(self._rx.buffer) < FILE_HEADER.size:
+                self._expect()
+            at, n, crc = FILE_HEADER.unpack(await self._rx.read(FILE_HEADER.size))
+            if not n:
+                end = {"offset": offset, "ble_bytes": ble_bytes}
+                return {**end, "done": True, "size": size, "crc": crc} if good else end
+            length = n & ~FILE_DEFLATED
+            if len(self._rx.buffer) < length:
+                self._expect()
+            data = await self._rx.read(length)
+            ble_bytes += length
+            if good and n & FILE_DEFLATED:
+                try:
+                    data = zlib.decompress(data)
+                except zlib.error:
+                    data = None
+            # After a bad frame the rest of this run is discarded; the next run restarts there
+            if good and data is not None and at == offset and zlib.crc32(data) == crc:
+                await on_data(data, offset, size)
+                offset += len(data)
+            else:
+                good = False
+
+    async def _list_files(self, msg):
+        path = msg.get("path") or "/"
+        out, err = await self._run_helper(device_helper("ls", PATH=path))
+        entries = []
+        error = err.strip() or None
+        for line in out.split("\n"):
+            line = line.rstrip("\r")
+            if not line:
+                continue
+            if line.startswith("X"):
+                error = line[1:]
+                continue
+            is_dir, size, name = line.split(" ", 2)
+            entries.append({"name": name, "size": int(size), "dir": is_dir == "1"})
+        frame = {"type": "file_list", "ok": not error, "path": path, "entries": entries}
+        if error:
+            frame["error"] = error
+        await self._reply(msg, frame)
+
+    async def _remove_file(self, msg):
+        out, err = await self._run_helper(device_helper("rm", PATH=msg["path"]))
+        text = out.strip()
+        frame = {"type": "file_done", "ok": text == "OK", "path": msg["path"]}
+        if not frame["ok"]:
+            frame["error"] = text[1:] if text.startswith("X") else (err.strip() or text)
+        await self._reply(msg, frame)
+
+    async def _read_manifest(self, msg):
+        path = msg.get("path") or "/"
+        expect = -1 if msg.get("expect") is None else msg["expect"]
+        out, err = await self._run_helper(device_helper("manifest", PATH=path, EXPECT=expect))
+        entries = []
+        digest = None
+        mpy = 0
+        error = err.strip() or None
+        for line in out.split("\n"):
+            line = line.rstrip("\r")
+            if not line:
+                continue
+            if line.startswith("X"):
+                error = line[1:]
+            elif line.startswith("M"):
+                digest = int(line[1:])
+            elif line.startswith("V"):
+                mpy = int(line[1:])
+            else:
+                size, crc, name = line.split(" ", 2)
+                entries.append({"name": name, "size": int(size), "crc": int(crc)})
+        if not error and digest is None:
+            error = "no manifest from device"
+        frame = {"type": "file_manifest", "ok": not error, "path": path, "digest": digest, "mpy": mpy}
+        if error:
+            frame["error"] = error
+        elif digest == expect:
+            frame["unchanged"] = True
+        else:
+            frame["entries"] = entries
+        await self._reply(msg, frame)
+
+    # --- Raw data channel (bridge.html "Raw data channel") -------------------
+
+    def _on_data(self, chunk):
+        if self._data_sink:
+            self._data_sink(chunk)  # else dropped, as on the page
+
+    async def _capture_data(self, msg):
+        source = msg.get("source")
+        error = None
+        if not self.connected:
+            error = "Not connected to Monocle"
+        elif not self.device.raw_data:
+            error = "Monocle has no raw data service"
+        elif source not in DATA_SOURCES:
+            error = f"unknown source: {source}"
+        if error:
+            await self._reply(msg, {"type": "data_done", "ok": False, "source": source, "error": error})
+            return
+        started = time.perf_counter()
+        sample_rate = msg.get("sample_rate") or DEFAULT_SAMPLE_RATE
+        bit_depth = msg.get("bit_depth") or DEFAULT_BIT_DEPTH
+        received = {"size": 0, "crc": 0}
+        chunks = asyncio.Queue()  # notifications, then None
+
+        def sink(chunk):
+            received["size"] += len(chunk)
+            received["crc"] = zlib.crc32(chunk, received["crc"])
+            chunks.put_nowait(chunk)
+
+        async def forward():
+            # Coalesce up to DATA_FLUSH_BYTES or DATA_FLUSH_MS, as the page does
+            pending = bytearray()
+            seq = 0
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.get(), DATA_FLUSH_MS / 1000 if pending else None)
+                except asyncio.TimeoutError:
+                    chunk = b""
+                if chunk:
+                    pending += chunk
+                if pending and (not chunk or len(pending) >= DATA_FLUSH_BYTES):
+                    if msg.get("binary"):
+                        await self._send_frame(FRAME_DATA, msg, seq, bytes(pending))
+                    else:
+                        await self._reply(msg, {"type": "data_chunk", "seq": seq,
+                                                "data": base64.b64encode(pending).decode()})
+                    pending = bytearray()
+                    seq += 1
+                if chunk is None:
+                    return
+
+        async def on_started():
+            await self._reply(msg, {"type": "data_started", **self._link_stats()})
+
+        end = {}
+
+        async def during(window):
+            start = await self._file_line()
+            if start != "S":
+                end["line"] = "X" + (start[1:] or "no reply from device")
+                return
+            end["line"] = (await self._rx.read_until(b"\n")).decode(errors="replace").rstrip("\r")
+
+        self._rx.buffer.clear()
+        self._data_sink = sink
+        forwarder = asyncio.create_task(forward())
+        try:
+            helper = device_helper("capture", SOURCE=source, SECONDS=msg.get("seconds") or 0,
+                                   SAMPLE_RATE=sample_rate, BIT_DEPTH=bit_depth)
+            await self._raw_paste(helper, lambda data: None, on_started, during)
+            line = end["line"]
+            if not line.startswith("D"):
+                raise RuntimeError(line[1:] or "no reply from device")
+            total, crc = map(int, line[1:].split())
+            # The end line on the REPL can overtake the last data notifications
+            deadline = time.monotonic() + DATA_TAIL_TIMEOUT
+            while received["size"] < total and time.monotonic() < deadline:
+                await asyncio.sleep(0.005)
+            if (received["size"], received["crc"]) != (total, crc):
+                raise RuntimeError(f"raw data channel lost data ({received['size']} of {total} bytes arrived)")
+            frame = {"type": "data_done", "ok": True, "source": source, "size": total, "crc": crc}
+            if source == "microphone":
+                frame.update(sample_rate=sample_rate, bit_depth=bit_depth)
+            frame.update(self._throughput(total, started))
+        except RuntimeError as e:
+            frame = {"type": "data_done", "ok": False, "source": source, "size": received["size"], "error": str(e)}
+        finally:
+            self._data_sink = None
+            chunks.put_nowait(None)
+            await forwarder
+        await self._reply(msg, {**frame, **self._link_stats()})
+
+    # --- BLE compression (bridge.html "BLE compression") ---------------------
+
+    async def _device_zlib_level(self):
+        """0: no zlib on the device, 1: it can inflate, 2: it can also deflate. Probed once per connection."""
+        if not self.compress:
+            return 0
+        if self.device_zlib is None:
+            out, _ = await self._run_helper(device_helper("zlib"))
+            match = re.search(r"Z(\d)", out)
+            self.device_zlib = int(match.group(1)) if match else 0
+        return self.device_zlib
+
+    async def _deflate_for_device(self, data):
+        """data as a zlib stream, or None if it is small, does not compress well or cannot be inflated."""
+        if len(data) < COMPRESS_MIN or not await self._device_zlib_level():
+            return None
+        packed = zlib.compress(data)
+        return packed if len(packed) <= len(data) * COMPRESS_RATIO else None
+
+    async def _paste_code(self, code):
+        source = code.encode()
+        packed = await self._deflate_for_device(source)
+        if packed is None:
+            return code
+        loader = device_helper("exec", bare=True, DATA=base64.b64encode(packed).decode())
+        return loader if len(loader) < len(source) else code
+
+
+async def _main():
+    url = sys.argv[1] if len(sys.argv) > 1 else "ws://127.0.0.1:8766"
+    async with SimulatedBridge(url) as bridge:
+        bridge.connected = True
+        print(f"Simulated Monocle attached to {url}", flush=True)
+        await asyncio.Future()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -1,4 +1,6 @@
 """Pytest fixtures for monocle-bridge tests."""
+import asyncio
+import json
 import sys
 from pathlib import Path
 
@@ -10,18 +12,81 @@ if str(PROJECT_ROOT) not in sys.path:
     sys.path.insert(0, str(PROJECT_ROOT))
 
 
+def _clear_server_globals(server_mod):
+    """Empty the relay's registries, cancelling the tasks its outboxes, sessions and polls left running."""
+    tasks = [box._writer for box in server_mod.outboxes.values()]
+    tasks += [session.expiry for session in server_mod.sessions.values() if session.expiry is not None]
+    tasks += [poll.task for poll in server_mod.polls.values()]
+    if server_mod.capture is not None:
+        tasks.append(server_mod.capture._writer)
+    for task in tasks:
+        if not task.done() and not task.get_loop().is_closed():
+            task.cancel()
+    server_mod.bridges.clear()
+    server_mod.cli_clients.clear()
+    server_mod.cli_bridge.clear()
+    server_mod.outboxes.clear()
+    server_mod.sessions.clear()
+    server_mod.cli_sessions.clear()
+    server_mod.polls.clear()
+    server_mod.capture = None
+
+
 @pytest.fixture(autouse=True)
 def reset_server_globals():
-    """Reset server globals before each test to avoid cross-test pollution."""
+    """Reset server globals before and after each test to avoid cross-test pollution."""
     import server as server_mod
-    server_mod.bridge_ws = None
-    server_mod.cli_ws = None
+    _clear_server_globals(server_mod)
+    server_mod.metrics = server_mod.RelayMetrics()
     yield
-    server_mod.bridge_ws = None
-    server_mod.cli_ws = None
+    _clear_server_globals(server_mod)
 
 
 @pytest.fixture
 def bridge_dir():
     """Path to monocle-bridge project root."""
     return PROJECT_ROOT
+
+
+class ScriptedLink:
+    """Stand-in for a registered relay link: answers each request with ``script(frame)``.
+
+    ``script`` returns the replies to a request frame (its id is filled in);
+    binary frames are passed as ``{"id": ..., "binary": bytes}``.
+    """
+
+    def __init__(self, script=lambda frame: []):
+        self.script = script
+        self.sent = []
+        self.inbox = asyncio.Queue()
+
+    async def send(self, message):
+        self.sent.append(message)
+        if isinstance(message, str):
+            frame = json.loads(message)
+        else:
+            frame = {"id": int.from_bytes(message[8:12], "big"), "binary": message}
+        for reply in self.script(frame):
+            self.push({"id": frame["id"], **reply})
+
+    def push(self, reply):
+        """Deliver a frame to the client as if the relay sent it."""
+        self.inbox.put_nowait(json.dumps(reply))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.inbox.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def close(self):
+        self.inbox.put_nowait(None)
+
+
+@pytest.fixture
+def scripted_link():
+    """The ScriptedLink class, for a MonocleClient(link=...) with canned replies."""
+    return ScriptedLink
@@ -32,3 +32,117 @@ def test_bridge_html_contains_web_bluetooth():
     content = BRIDGE_HTML.read_text()
     assert "navigator.bluetooth" in content
     assert "requestDevice" in content
+
+
+def test_bridge_html_handles_repl_batch():
+    """bridge.html pipelines repl_batch snippets and streams indexed results."""
+    content = BRIDGE_HTML.read_text()
+    assert "repl_batch" in content
+    assert "repl_batch_result" in content
+    assert "repl_batch_done" in content
+
+
+def test_bridge_html_chunks_writes_and_uses_raw_paste():
+    """bridge.html splits writes to the BLE payload size and speaks raw-paste mode."""
+    content = BRIDGE_HTML.read_text()
+    assert "CHUNK_SIZE" in content
+    assert "writeChunked" in content
+    assert "COMPOUND.test(code)" in content  # one-line compound statements need a blank line
+    assert "\\x05A\\x01" in content  # raw-paste request
+    assert "raw REPL; CTRL-B to exit" in content
+
+
+def test_bridge_html_streams_repl_output():
+    """bridge.html forwards output as repl_chunk frames and ends with repl_done."""
+    content = BRIDGE_HTML.read_text()
+    assert "repl_chunk" in content
+    assert "repl_done" in content
+
+
+def test_bridge_html_speaks_binary_frames():
+    """bridge.html announces binary support and puts client first in replies."""
+    content = BRIDGE_HTML.read_text()
+    assert "features: FEATURES" in content
+    assert "binaryType = 'arraybuffer'" in content
+    assert "FRAME_HEADER_SIZE = 16" in content
+    assert "{ client: msg.client, id: msg.id }" in content
+
+
+def test_bridge_html_reports_timing_and_ble_metrics():
+    """bridge.html stamps final replies and reports BLE samples to the relay."""
+    content = BRIDGE_HTML.read_text()
+    assert "out.timing = { recv: msg.recvAt, start: msg.startAt, done: Date.now() }" in content
+    assert "type: 'bridge_metrics'" in content
+    assert "bleSamples.write_ms.push" in content
+    assert "bleSamples.notify_ms.push" in content
+
+
+def test_bridge_html_transfers_files():
+    """bridge.html handles file requests with CRC-checked, windowed helper programs."""
+    content = BRIDGE_HTML.read_text()
+    for kind in ("file_push", "file_pull", "file_ls", "file_rm"):
+        assert f"'{kind}'" in content
+    assert "FRAME_FILE_PUSH = 3" in content
+    assert "FRAME_FILE_DATA = 4" in content
+    assert "const DEVICE_HELPERS = {" in content
+    assert "micropython.kbd_intr(-1)" in content  # file data may contain Ctrl-C bytes
+    assert "function crc32(bytes, crc)" in content
+    assert "manifest: `" in content  # device-side hashing for sync
+
+
+def test_bridge_html_deflates_large_payloads_for_ble():
+    """bridge.html probes the device's zlib and sends large code and files compressed."""
+    content = BRIDGE_HTML.read_text()
+    assert "new CompressionStream('deflate')" in content
+    assert "new DecompressionStream('deflate')" in content
+    assert "zlib: `" in content and "exec: `" in content
+    assert "deviceZlib = null;" in content  # probed again on every BLE connection
+    assert "get('compress') !== '0'" in content
+
+
+def test_bridge_html_schedules_by_priority_and_interrupts_out_of_band():
+    """Interrupts bypass the queue; their Ctrl-C shares the GATT write chain."""
+    content = BRIDGE_HTML.read_text()
+    assert "msg.type === 'interrupt'" in content
+    assert "'interrupted'" in content.split("const FINAL_TYPES")[1].split(";")[0]
+    assert "sort((a, b) => b - a)" in content  # higher priority first
+    assert "gattWrite(new Uint8Array([3])" in content
+    assert "failRequest(req, 'cancelled')" in content
+    assert "await resync()" in content
+
+
+def test_bridge_html_reuses_ble_link_and_reports_its_state():
+    """connect reuses a live GATT link or a remembered device; state changes go to the relay."""
+    content = BRIDGE_HTML.read_text()
+    assert "if (linkUp() && !fresh) return true;" in content
+    assert "navigator.bluetooth.getDevices" in content
+    assert "'gattserverdisconnected'" in content
+    assert "type: 'link_state'" in content
+
+
+def test_bridge_html_reconnects_and_resumes_its_relay_session():
+    """A dropped websocket is reopened with backoff and the session resumed; frames to the relay are replayed."""
+    content = BRIDGE_HTML.read_text()
+    assert "resume: true" in content
+    assert "session: session, received: framesReceived" in content
+    assert "reconnectTimer = setTimeout(connectWebSocket, reconnectDelay)" in content
+    assert "sentLog.filter(([n]) => n > reg.received)" in content
+    # Only the registration bypasses the replay log
+    assert content.count("ws.send(") == 3
+
+
+def test_bridge_html_registers_a_device_id_per_tab():
+    content = BRIDGE_HTML.read_text()
+    assert "get('device')" in content
+    assert "sessionStorage" in content
+    assert "device: DEVICE_ID" in content
+
+
+def test_bridge_html_opens_raw_data_service_for_captures():
+    """bridge.html relays the raw data service as binary frames for data_capture."""
+    content = BRIDGE_HTML.read_text()
+    assert "e5700001-7bac-429a-b4ce-57ff900f479d" in content
+    assert "e5700003-7bac-429a-b4ce-57ff900f479d" in content
+    assert "optionalServices: [REPL_SERVICE, DATA_SERVICE]" in content
+    assert "'data_capture'" in content.split("const REQUEST_TYPES")[1].split(";")[0]
+    assert "sendFrame(FRAME_DATA" in content
@@ -69,6 +69,46 @@ async def test_server_relay_bridge_to_cli():
         await http_server.wait_closed()
 
 
+@pytest.mark.asyncio
+async def test_server_multiplexes_several_cli_clients():
+    """Two CLIs share one bridge; each gets only the replies to its own requests."""
+    port_ws = 18768
+    ws_server = await websockets.serve(server.relay, "127.0.0.1", port_ws)
+
+    try:
+        bridge = await websockets.connect(f"ws://127.0.0.1:{port_ws}")
+        await bridge.send(json.dumps({"role": "bridge"}))
+        await bridge.recv()
+
+        clis = []
+        for _ in range(2):
+            cli = await websockets.connect(f"ws://127.0.0.1:{port_ws}")
+            await cli.send(json.dumps({"role": "cli"}))
+            await cli.recv()
+            clis.append(cli)
+
+        await clis[0].send(json.dumps({"type": "repl", "id": 1, "code": "'a'"}))
+        await clis[1].send(json.dumps({"type": "repl", "id": 1, "code": "'b'"}))
+        requests = [json.loads(await asyncio.wait_for(bridge.recv(), timeout=2)) for _ in range(2)]
+        assert requests[0]["client"] != requests[1]["client"]
+
+        # Answer out of order; routing must follow the client tag
+        for req in reversed(requests):
+            await bridge.send(json.dumps({
+                "type": "repl_response", "id": req["id"], "client": req["client"],
+                "data": req["code"].strip("'"),
+            }))
+        a = json.loads(await asyncio.wait_for(clis[0].recv(), timeout=2))
+        b = json.loads(await asyncio.wait_for(clis[1].recv(), timeout=2))
+        assert (a["data"], b["data"]) == ("a", "b")
+
+        for ws in [bridge, *clis]:
+            await ws.close()
+    finally:
+        ws_server.close()
+        await ws_server.wait_closed()
+
+
 @pytest.mark.asyncio
 async def test_http_serves_bridge_html():
     """HTTP server serves bridge.html with expected content."""
@@ -5,7 +5,7 @@ import json
 import sys
 from io import StringIO
 from pathlib import Path
-from unittest.mock import AsyncMock, MagicMock, patch
+from unittest.mock import AsyncMock, patch
 
 import pytest
 
@@ -16,102 +16,127 @@ spec = importlib.util.spec_from_file_location(
 monocle_cli = importlib.util.module_from_spec(spec)
 sys.modules["monocle_cli"] = monocle_cli
 spec.loader.exec_module(monocle_cli)
+import monocle_client
+
+
+def _run_cli(argv, link):
+    """Run monocle-cli with ``argv`` over ``link`` (as if through a daemon); returns its status."""
+    return patch("sys.argv", ["monocle-cli", *argv]), \
+        patch.object(monocle_cli, "open_daemon_link", AsyncMock(return_value=link))
 
 
 @pytest.mark.asyncio
-async def test_cli_connect_success():
+async def test_cli_connect_success(scripted_link):
     """CLI connect command prints success when bridge responds ok."""
-    mock_ws = AsyncMock()
-    mock_ws.recv = AsyncMock(return_value=json.dumps({"type": "registered", "role": "cli"}))
-    mock_ws.send = AsyncMock()
+    link = scripted_link(lambda frame: [{"type": "connected", "ok": True}])
+    argv, daemon = _run_cli(["connect"], link)
+    with argv, daemon, patch("sys.stdout", new_callable=StringIO) as out:
+        assert await monocle_cli.cli() == 0
+    assert "Connected to Monocle" in out.getvalue()
 
-    cm = MagicMock()
-    cm.__aenter__ = AsyncMock(return_value=mock_ws)
-    cm.__aexit__ = AsyncMock(return_value=None)
 
-    with patch.object(monocle_cli, "websockets") as mock_ws_mod:
-        mock_ws_mod.connect = MagicMock(return_value=cm)
+@pytest.mark.asyncio
+async def test_cli_connect_failure(scripted_link):
+    """CLI connect command prints failure when bridge responds not ok."""
+    link = scripted_link(lambda frame: [{"type": "connected", "ok": False}])
+    argv, daemon = _run_cli(["connect"], link)
+    with argv, daemon, patch("sys.stdout", new_callable=StringIO) as out:
+        assert await monocle_cli.cli() == 1
+    assert "Connection failed" in out.getvalue()
 
-        with patch("sys.argv", ["monocle-cli", "connect"]):
-            with patch("sys.stdout", new_callable=StringIO) as out:
-                with patch.object(monocle_cli, "pending") as mock_pending:
-                    mock_pending.get = AsyncMock(
-                        return_value={"type": "connected", "ok": True}
-                    )
-                    await monocle_cli.cli()
-                assert "Connected to Monocle" in out.getvalue()
+
+@pytest.mark.asyncio
+async def test_cli_repl_prints_response(scripted_link):
+    """CLI repl command prints response data."""
+    link = scripted_link(lambda frame: [{"type": "repl_response", "data": "2"}])
+    argv, daemon = _run_cli(["repl", "1+1"], link)
+    with argv, daemon, patch("sys.stdout", new_callable=StringIO) as out:
+        await monocle_cli.cli()
+    assert "2" in out.getvalue()
 
 
 @pytest.mark.asyncio
-async def test_cli_connect_failure():
-    """CLI connect command prints failure when bridge responds not ok."""
-    mock_ws = AsyncMock()
-    mock_ws.recv = AsyncMock(return_value=json.dumps({"type": "registered", "role": "cli"}))
-    mock_ws.send = AsyncMock()
+async def test_cli_repl_timeout(scripted_link):
+    """CLI repl prints (timeout) when the device never answers."""
+    argv, daemon = _run_cli(["repl", "sleep(100)"], scripted_link())
+    with argv, daemon, patch.object(monocle_client, "DEFAULT_START_TIMEOUT", 0.05), \
+            patch("sys.stdout", new_callable=StringIO) as out:
+        assert await monocle_cli.cli() == 1
+    assert "(timeout)" in out.getvalue()
 
-    cm = MagicMock()
-    cm.__aenter__ = AsyncMock(return_value=mock_ws)
-    cm.__aexit__ = AsyncMock(return_value=None)
 
-    with patch.object(monocle_cli, "websockets") as mock_ws_mod:
-        mock_ws_mod.connect = MagicMock(return_value=cm)
+@pytest.mark.asyncio
+async def test_cli_repl_streams_chunks_and_returns_status(scripted_link):
+    """repl asks for streaming, writes chunks as they arrive and reports failure."""
+    link = scripted_link(lambda frame: [
+        {"type": "repl_chunk", "data": "line 1\r\nli"},
+        {"type": "repl_chunk", "data": "ne 2\r\n"},
+        {"type": "repl_done", "ok": False},
+    ])
+    argv, daemon = _run_cli(["repl", "run()"], link)
+    with argv, daemon, patch("sys.stdout", new_callable=StringIO) as out:
+        status = await monocle_cli.cli()
 
-        with patch("sys.argv", ["monocle-cli", "connect"]):
-            with patch("sys.stdout", new_callable=StringIO) as out:
-                with patch.object(monocle_cli, "pending") as mock_pending:
-                    mock_pending.get = AsyncMock(
-                        return_value={"type": "connected", "ok": False}
-                    )
-                    await monocle_cli.cli()
-                assert "Connection failed" in out.getvalue()
+    assert json.loads(link.sent[-1])["stream"] is True
+    assert out.getvalue() == "line 1\nline 2\n"
+    assert status == 1
 
 
 @pytest.mark.asyncio
-async def test_cli_repl_prints_response():
-    """CLI repl command prints response data."""
-    mock_ws = AsyncMock()
-    mock_ws.recv = AsyncMock(return_value=json.dumps({"type": "registered", "role": "cli"}))
-    mock_ws.send = AsyncMock()
+async def test_sigint_sends_interrupt_then_quits_with_130(scripted_link):
+    """First Ctrl-C asks the bridge to interrupt; the second stops waiting."""
+    client = monocle_client.MonocleClient(link=scripted_link())
+    await client.connect()
+    with patch.object(monocle_cli, "interrupt_sent", False), \
+            patch("sys.argv", ["monocle-cli", "repl", "while True: pass"]), \
+            patch("sys.stderr", new_callable=StringIO) as err:
+        task = asyncio.create_task(monocle_cli.run_command(client))
+        await asyncio.sleep(0.01)
+        monocle_cli.handle_sigint(client, task)
+        await asyncio.sleep(0.01)
+        assert not task.done()
+        assert json.loads(client.link.sent[-1])["type"] == "interrupt"
+        monocle_cli.handle_sigint(client, task)
+        assert await task == monocle_cli.INTERRUPTED_STATUS
+    assert "interrupting" in err.getvalue()
+    await client.close()
 
-    cm = MagicMock()
-    cm.__aenter__ = AsyncMock(return_value=mock_ws)
-    cm.__aexit__ = AsyncMock(return_value=None)
 
-    with patch.object(monocle_cli, "websockets") as mock_ws_mod:
-        mock_ws_mod.connect = MagicMock(return_value=cm)
-
-        with patch("sys.argv", ["monocle-cli", "repl", "1+1"]):
-            with patch("sys.stdout", new_callable=StringIO) as out:
-                with patch.object(monocle_cli, "pending") as mock_pending:
-                    mock_pending.get = AsyncMock(
-                        return_value={"type": "repl_response", "data": "2"}
-                    )
-                    await monocle_cli.cli()
-                assert "2" in out.getvalue()
+def test_target_options_are_taken_from_argv():
+    argv = ["monocle-cli", "--device", "left", "repl", "1+1"]
+    assert monocle_cli.take_target_options(argv) == ("left", False)
+    assert argv == ["monocle-cli", "repl", "1+1"]
+    argv = ["monocle-cli", "--all", "status"]
+    assert monocle_cli.take_target_options(argv) == (None, True)
+    assert argv == ["monocle-cli", "status"]
+    argv = ["monocle-cli", "repl", "--all"]
+    assert monocle_cli.take_target_options(argv) == (None, False)
 
 
 @pytest.mark.asyncio
-async def test_cli_repl_timeout():
-    """CLI repl prints (timeout) on timeout."""
-    mock_ws = AsyncMock()
-    mock_ws.recv = AsyncMock(return_value=json.dumps({"type": "registered", "role": "cli"}))
-    mock_ws.send = AsyncMock()
-
-    cm = MagicMock()
-    cm.__aenter__ = AsyncMock(return_value=mock_ws)
-    cm.__aexit__ = AsyncMock(return_value=None)
+async def test_cli_devices_lists_bridge_pages(scripted_link):
+    link = scripted_link(lambda frame: [{"type": "devices", "devices": [
+        {"id": "left", "connected": True, "device": "monocle", "busy": 2, "away": False},
+        {"id": "tab-1a2b3c", "connected": False, "device": None, "busy": 0, "away": False},
+    ]}])
+    argv, daemon = _run_cli(["devices"], link)
+    with argv, daemon, patch("sys.stdout", new_callable=StringIO) as out:
+        assert await monocle_cli.cli() == 0
+    assert out.getvalue().splitlines() == [
+        "left: Monocle connected (monocle), 2 request(s) in flight",
+        "tab-1a2b3c: Monocle not connected",
+    ]
 
-    with patch.object(monocle_cli, "websockets") as mock_ws_mod:
-        mock_ws_mod.connect = MagicMock(return_value=cm)
 
-        with patch("sys.argv", ["monocle-cli", "repl", "sleep(100)"]):
-            with patch("sys.stdout", new_callable=StringIO) as out:
-                with patch.object(monocle_cli, "pending") as mock_pending:
-                    mock_pending.get = AsyncMock(
-                        side_effect=asyncio.TimeoutError()
-                    )
-                    await monocle_cli.cli()
-                assert "(timeout)" in out.getvalue()
+@pytest.mark.asyncio
+async def test_cli_status_prints_link_state(scripted_link):
+    link = scripted_link(lambda frame: [{"type": "status", "bridge": True, "connected": True, "device": "monocle"}])
+    argv, daemon = _run_cli(["status"], link)
+    with argv, daemon, patch("sys.stdout", new_callable=StringIO) as out:
+        assert await monocle_cli.cli() == 0
+    assert json.loads(link.sent[0])["type"] == "status"
+    assert out.getvalue().strip() == "Monocle connected (monocle)"
+    assert monocle_cli.link_summary({"bridge": True}) == "Bridge ready; Monocle not connected"
 
 
 def test_main_connection_refused():
@@ -133,3 +158,227 @@ def test_main_invalid_status():
         with pytest.raises(SystemExit) as exc:
             monocle_cli.main()
         assert exc.value.code == 1
+
+
+async def _fake_bridge(url):
+    """Register as bridge and answer every repl with its code reversed."""
+    import websockets as ws_mod
+
+    ws = await ws_mod.connect(url)
+    await ws.send(json.dumps({"role": "bridge"}))
+    await ws.recv()
+
+    async def serve():
+        async for msg in ws:
+            req = json.loads(msg)
+            await ws.send(json.dumps({
+                "type": "repl_response", "id": req["id"], "client": req["client"],
+                "data": req["code"][::-1],
+            }))
+
+    return ws, asyncio.create_task(serve())
+
+
+@pytest.mark.asyncio
+async def test_daemon_serves_commands_over_unix_socket(tmp_path):
+    """With a daemon running, commands go over its socket instead of a new websocket."""
+    import websockets as ws_mod
+    import server
+
+    port = 18770
+    url = f"ws://127.0.0.1:{port}"
+    sock = str(tmp_path / "cli.sock")
+    ws_server = await ws_mod.serve(server.relay, "127.0.0.1", port)
+    bridge, bridge_task = await _fake_bridge(url)
+
+    with patch.object(monocle_client, "WS_URL", url), \
+            patch.object(monocle_cli, "SOCKET_PATH", sock):
+        with patch("sys.argv", ["monocle-cli", "daemon"]), patch("sys.stdout", new_callable=StringIO):
+            daemon_task = asyncio.create_task(monocle_cli.cli())
+            for _ in range(100):
+                if Path(sock).exists():
+                    break
+                await asyncio.sleep(0.01)
+        try:
+            with patch.object(monocle_client.RelayLink, "_connect", side_effect=AssertionError("not via daemon")):
+                with patch("sys.argv", ["monocle-cli", "repl", "abc"]):
+                    with patch("sys.stdout", new_callable=StringIO) as out:
+                        await monocle_cli.cli()
+            assert out.getvalue().strip() == "cba"
+        finally:
+            daemon_task.cancel()
+            bridge_task.cancel()
+            await asyncio.gather(daemon_task, bridge_task, return_exceptions=True)
+            await bridge.close()
+            ws_server.close()
+            await ws_server.wait_closed()
+    assert not Path(sock).exists()
+
+
+@pytest.mark.asyncio
+async def test_daemon_drops_late_replies_to_a_client_that_left(tmp_path):
+    """A reply to a local client that disconnected mid-request never reaches another client."""
+    import websockets as ws_mod
+    import server
+
+    port = 18771
+    url = f"ws://127.0.0.1:{port}"
+    sock = str(tmp_path / "cli.sock")
+    ws_server = await ws_mod.serve(server.relay, "127.0.0.1", port)
+    bridge = await ws_mod.connect(url)
+    await bridge.send(json.dumps({"role": "bridge"}))
+    await bridge.recv()
+    with patch.object(monocle_client, "WS_URL", url), patch.object(monocle_cli, "SOCKET_PATH", sock):
+        with patch("sys.argv", ["monocle-cli", "daemon"]), patch("sys.stdout", new_callable=StringIO):
+            daemon_task = asyncio.create_task(monocle_cli.cli())
+            for _ in range(100):
+                if Path(sock).exists():
+                    break
+                await asyncio.sleep(0.01)
+        try:
+            a = await monocle_cli.open_daemon_link()
+            await a.send(json.dumps({"id": 1, "type": "repl", "code": "slow"}))
+            slow = json.loads(await bridge.recv())
+            await a.close()  # left mid-request, e.g. a second Ctrl-C
+            b = await monocle_cli.open_daemon_link()
+            await b.send(json.dumps({"id": 1, "type": "repl", "code": "fast"}))
+            fast = json.loads(await bridge.recv())
+            for req in (slow, fast):
+                await bridge.send(json.dumps({"type": "repl_response", "id": req["id"], "client": req["client"],
+                                              "data": f"reply to {req['code']}"}))
+            assert json.loads(await asyncio.wait_for(b.recv(), 5)) == {
+                "type": "repl_response", "id": 1, "client": fast["client"], "data": "reply to fast"}
+            await b.close()
+        finally:
+            daemon_task.cancel()
+            await asyncio.gather(daemon_task, return_exceptions=True)
+            await bridge.close()
+            ws_server.close()
+            await ws_server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_open_daemon_link_ignores_stale_socket(tmp_path):
+    """A leftover socket file with no daemon behind it falls back to a direct connection."""
+    sock = tmp_path / "stale.sock"
+    sock.write_text("")
+    with patch.object(monocle_cli, "SOCKET_PATH", str(sock)):
+        assert await monocle_cli.open_daemon_link() is None
+
+
+def test_split_snippets_groups_indented_lines():
+    """Indented lines stay with the statement that opens the block."""
+    text = "import display\n\nfor i in range(3):\n    print(i)\n\nx = 1\n"
+    assert monocle_cli.split_snippets(text) == [
+        "import display",
+        "for i in range(3):\n    print(i)",
+        "x = 1",
+    ]
+
+
+def test_split_snippets_keeps_compound_statements_whole():
+    """Clauses, decorated definitions and open brackets stay with the statement they continue."""
+    text = ("if x:\n    a=1\nelif y:\n    a=2\nelse:\n    a=3\n@dec\ndef f():\n    pass\n"
+            "try:\n    g()\nexcept E:\n    pass\nfinally:\n    h()\nitems = [\n1,\n2]\nx = 1\n")
+    assert monocle_cli.split_snippets(text) == [
+        "if x:\n    a=1\nelif y:\n    a=2\nelse:\n    a=3",
+        "@dec\ndef f():\n    pass",
+        "try:\n    g()\nexcept E:\n    pass\nfinally:\n    h()",
+        "items = [\n1,\n2]",
+        "x = 1",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_cli_batch_streams_results_in_order(scripted_link):
+    """batch sends one repl_batch frame and prints each result as it arrives."""
+    link = scripted_link(lambda frame: [
+        {"type": "repl_batch_result", "index": 0, "data": ""},
+        {"type": "repl_batch_result", "index": 1, "data": "3"},
+        {"type": "repl_batch_done", "count": 2},
+    ])
+    argv, daemon = _run_cli(["batch", "a = 3", "a"], link)
+    with argv, daemon, patch("sys.stdout", new_callable=StringIO) as out:
+        assert await monocle_cli.cli() == 0
+
+    sent = json.loads(link.sent[-1])
+    assert sent["type"] == "repl_batch"
+    assert sent["snippets"] == ["a = 3", "a"]
+    assert out.getvalue() == "3\n"
+
+
+@pytest.mark.asyncio
+async def test_cli_batch_fails_when_the_batch_does(scripted_link):
+    """batch exits 1 when the bridge reports an error, goes away or never answers."""
+    failures = [
+        [{"type": "repl_batch_result", "index": 0, "data": ""},
+         {"type": "repl_batch_done", "count": 1, "error": "Link timeout"}],
+        [{"type": "bridge_gone", "error": "bridge disconnected"}],
+    ]
+    for replies in failures:
+        argv, daemon = _run_cli(["batch", "a = 3", "a"], scripted_link(lambda frame, replies=replies: replies))
+        with argv, daemon, patch("sys.stdout", new_callable=StringIO) as out:
+            assert await monocle_cli.cli() == 1
+        assert out.getvalue().startswith("(")
+    argv, daemon = _run_cli(["batch", "a"], scripted_link())
+    with argv, daemon, patch.object(monocle_client, "DEFAULT_START_TIMEOUT", 0.05), \
+            patch("sys.stdout", new_callable=StringIO) as out:
+        assert await monocle_cli.cli() == 1
+    assert "(timeout)" in out.getvalue()
+
+
+FAKE_MPY_CROSS = """#!{python}
+import sys
+if sys.argv[1] == "--version":
+    print("MicroPython v1.22.0 on 2024-01-01; mpy-cross emitting mpy v6.2")
+    sys.exit(0)
+args = sys.argv[1:]
+source = open(args[-1], "rb").read()
+if b"syntax error" in source:
+    sys.exit("SyntaxError")
+with open({log!r}, "a") as log:
+    log.write(args[args.index("-s") + 1] + "\\n")
+open(args[args.index("-o") + 1], "wb").write(b"M\\x06" + source[::-1])
+"""
+
+
+@pytest.fixture
+def fake_mpy_cross(tmp_path):
+    """An mpy-cross stand-in emitting mpy v6; returns the file it logs compiled names to."""
+    log = tmp_path / "compiled.log"
+    exe = tmp_path / "mpy-cross"
+    exe.write_text(FAKE_MPY_CROSS.format(python=sys.executable, log=str(log)))
+    exe.chmod(0o755)
+    with patch.object(monocle_cli, "MPY_CROSS", str(exe)), \
+            patch.object(monocle_cli, "MPY_CACHE_DIR", tmp_path / "cache"), \
+            patch.dict(monocle_cli._mpy_cross_versions, clear=True):
+        yield log
+
+
+def test_compile_mpy_caches_by_source_and_matches_device_version(fake_mpy_cross, tmp_path):
+    src = tmp_path / "util.py"
+    src.write_text("X = 1\n")
+    device_mpy = 6 | 2 << 8
+    first = monocle_cli.compile_mpy(src, "util.py", device_mpy)
+    assert first.read_bytes() == b"M\x06" + b"\n1 = X"
+    assert monocle_cli.compile_mpy(src, "util.py", device_mpy) == first
+    assert fake_mpy_cross.read_text().splitlines() == ["util.py"]  # second call hit the cache
+    assert monocle_cli.compile_mpy(src, "util.py", 5) is None  # device has another .mpy version
+    assert monocle_cli.compile_mpy(src, "util.py", 0) is None  # device cannot import .mpy
+    src.write_text("syntax error(\n")
+    assert monocle_cli.compile_mpy(src, "util.py", device_mpy) is None
+
+
+def test_upload_artifact_keeps_boot_files_as_source(fake_mpy_cross, tmp_path):
+    src = tmp_path / "main.py"
+    src.write_text("print(1)\n")
+    assert monocle_cli.upload_artifact(src, "/main.py", 6) == (src, "/main.py")
+    path, remote = monocle_cli.upload_artifact(src, "/lib/tool.py", 6)
+    assert remote == "/lib/tool.mpy" and path.suffix == ".mpy"
+
+
+def test_no_mpy_cross_means_source(tmp_path):
+    src = tmp_path / "util.py"
+    src.write_text("X = 1\n")
+    with patch.object(monocle_cli, "MPY_CROSS", ""):
+        assert monocle_cli.compile_mpy(src, "util.py", 6) is None
@@ -0,0 +1,296 @@
+"""Unit tests for monocle_client.py."""
+import asyncio
+import json
+
+import pytest
+
+import monocle_client
+from monocle_client import MonocleClient, MonocleError
+
+
+async def _client(link, **options):
+    client = MonocleClient(link=link, **options)
+    await client.connect()
+    return client
+
+
+@pytest.mark.asyncio
+async def test_requests_put_id_send_time_and_device_first(scripted_link):
+    """The relay times and routes requests from the frame head, so id, sent_at and device lead."""
+    link = scripted_link()
+    client = await _client(link)
+    call = await client.call({"type": "repl", "code": "1"})
+    assert link.sent[0].startswith('{"id": %d, "sent_at": ' % call.id)
+    assert list(json.loads(link.sent[0])) == ["id", "sent_at", "type", "code"]
+    client.device = "left"
+    await client.call({"type": "repl", "code": "1"})
+    assert list(json.loads(link.sent[1])) == ["id", "sent_at", "device", "type", "code"]
+    await client.close()
+
+
+@pytest.mark.asyncio
+async def test_priority_and_device_keep_requests_json(scripted_link):
+    client = await _client(scripted_link(), priority=5)
+    client.features = {"binary"}
+    assert not client.binary_uploads()
+    await client.call({"type": "repl", "code": "1"})
+    await client.call({"type": "interrupt"})
+    repl, interrupt = (json.loads(m) for m in client.link.sent)
+    assert repl["priority"] == 5
+    assert "priority" not in interrupt
+    client.priority = None
+    assert client.binary_uploads()
+    client.device = "left"
+    assert not client.binary_uploads()
+    await client.close()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_each_get_their_own_replies(scripted_link):
+    """Replies are matched to calls by id, whatever order they arrive in."""
+    link = scripted_link()
+    client = await _client(link)
+    first, second = [asyncio.ensure_future(client.repl(code)) for code in ("1", "2")]
+    await asyncio.sleep(0)
+    link.push({"type": "repl_response", "id": 2, "data": "two"})
+    link.push({"type": "repl_response", "id": 99, "data": "stale"})
+    link.push({"type": "repl_response", "id": 1, "data": "one"})
+    assert await asyncio.gather(first, second) == ["one", "two"]
+    assert client._calls == {}
+    await client.close()
+
+
+@pytest.mark.asyncio
+async def test_in_flight_limit_holds_requests_until_one_finishes(scripted_link):
+    link = scripted_link(lambda frame: [{"type": "interrupted"}] if frame["type"] == "interrupt" else [])
+    client = await _client(link, max_in_flight=2)
+    calls = [asyncio.ensure_future(client.repl(str(i))) for i in range(3)]
+    await asyncio.sleep(0.01)
+    assert [json.loads(m)["code"] for m in link.sent] == ["0", "1"]
+    link.push({"type": "repl_response", "id": 1, "data": "0"})
+    await asyncio.sleep(0.01)
+    assert [json.loads(m)["code"] for m in link.sent] == ["0", "1", "2"]
+    assert (await client.interrupt())["type"] == "interrupted"  # never waits for a slot
+    for rid in (2, 3):
+        link.push({"type": "repl_response", "id": rid, "data": "x"})
+    await asyncio.gather(*calls)
+    await client.close()
+
+
+def test_start_timeout_follows_reported_rto():
+    """The first-reply timeout is derived from the bridge's RTO once known."""
+    client = MonocleClient(link=object())
+    assert client.start_timeout() == monocle_client.DEFAULT_START_TIMEOUT
+    client._dispatch({"type": "repl_done", "rtt_ms": 40, "rto_ms": 600})
+    assert client.start_timeout() == pytest.approx(3.4)
+    client._dispatch({"type": "repl_done", "rtt_ms": 10, "rto_ms": 20})
+    assert client.start_timeout() == pytest.approx(2.0)
+    client.timeout = 7
+    assert client.start_timeout() == 7
+
+
+@pytest.mark.asyncio
+async def test_stream_waits_without_cap_once_started(scripted_link):
+    """After repl_started, a slow run is not cut off by the start timeout."""
+    link = scripted_link(lambda frame: [{"type": "repl_started"}] if frame.get("stream") else [])
+    client = await _client(link, timeout=0.1)
+
+    async def device():
+        await asyncio.sleep(0.3)
+        link.push({"type": "repl_chunk", "id": 1, "data": "done\r\n"})
+        link.push({"type": "repl_done", "id": 1, "ok": True})
+
+    task = asyncio.create_task(device())
+    assert [text async for text in client.stream("slow()")] == ["done\r\n"]
+    await task
+    with pytest.raises(asyncio.TimeoutError):
+        await client.repl("never answered")
+    assert client._calls == {}
+    await client.close()
+
+
+@pytest.mark.asyncio
+async def test_stream_raises_after_the_output_of_failed_code(scripted_link):
+    link = scripted_link(lambda frame: [
+        {"type": "repl_chunk", "data": "Traceback\r\n"},
+        {"type": "repl_done", "ok": False},
+    ])
+    client = await _client(link)
+    output = []
+    with pytest.raises(MonocleError) as exc:
+        async for text in client.stream("1/0"):
+            output.append(text)
+    assert output == ["Traceback\r\n"]
+    assert exc.value.reply["type"] == "repl_done"
+    await client.close()
+
+
+@pytest.mark.asyncio
+async def test_large_code_goes_as_one_binary_frame(scripted_link):
+    link = scripted_link(lambda frame: [{"type": "repl_done", "ok": True}])
+    client = await _client(link)
+    client.features = {"binary"}
+    code = "x = 1\n" * 200
+    assert [text async for text in client.stream(code)] == []
+    kind, flags, _, _, rid, _ = monocle_client.FRAME_HEADER.unpack_from(link.sent[0])
+    assert (kind, flags, rid) == (monocle_client.FRAME_REPL_CODE, monocle_client.FLAG_STREAM, 1)
+    assert link.sent[0][monocle_client.FRAME_HEADER.size:].decode() == code
+    await client.close()
+
+
+@pytest.mark.asyncio
+async def test_bridge_gone_fails_the_calls_waiting_on_it(scripted_link):
+    link = scripted_link()
+    client = await _client(link)
+    mine = asyncio.ensure_future(client.repl("1"))
+    other = asyncio.ensure_future(client.batch(["2"]))
+    await asyncio.sleep(0)
+    link.push({"type": "bridge_away"})
+    link.push({"type": "bridge_gone"})
+    with pytest.raises(MonocleError, match="bridge disconnected"):
+        await mine
+    with pytest.raises(MonocleError) as exc:
+        await other
+    assert exc.value.results == []
+    assert client._calls == {}
+    await client.close()
+
+
+@pytest.mark.asyncio
+async def test_closed_link_fails_calls_in_flight(scripted_link):
+    link = scripted_link()
+    client = await _client(link)
+    pending = asyncio.ensure_future(client.repl("1"))
+    await asyncio.sleep(0)
+    await link.close()
+    with pytest.raises(MonocleError, match="connection to the relay closed"):
+        await pending
+
+
+@pytest.mark.asyncio
+async def test_unreadable_frame_fails_calls_in_flight(scripted_link):
+    """A frame the reader cannot decode ends the stream of a call that had started, not hangs it."""
+    link = scripted_link(lambda frame: [{"type": "repl_started"}])
+    client = await _client(link)
+    chunks = []
+
+    async def stream():
+        async for text in client.stream("1"):
+            chunks.append(text)
+
+    pending = asyncio.ensure_future(stream())
+    await asyncio.sleep(0.01)
+    link.inbox.put_nowait(b"\x01")  # shorter than a binary frame header
+    with pytest.raises(MonocleError):
+        await asyncio.wait_for(pending, 1)
+    assert client._calls == {}
+    await client.close()
+
+
+@pytest.mark.asyncio
+async def test_pull_writes_data_and_reports_progress(scripted_link):
+    import io
+
+    link = scripted_link(lambda frame: [
+        {"type": "file_progress", "done": 2, "total": 4},
+        {"type": "file_data", "data": "AAE="},
+        {"type": "file_data", "data": "AgM="},
+        {"type": "file_done", "ok": True, "size": 4},
+    ])
+    client = await _client(link)
+    out, progress = io.BytesIO(), []
+    reply = await client.pull("/log.bin", out, progress=progress.append)
+    assert out.getvalue() == b"\x00\x01\x02\x03"
+    assert reply["size"] == 4 and progress == [{"type": "file_progress", "id": 1, "done": 2, "total": 4}]
+    link.script = lambda frame: [{"type": "file_done", "ok": False, "error": "ENOENT"}]
+    with pytest.raises(MonocleError, match="ENOENT"):
+        await client.rm("/nope")
+    await client.close()
+
+
+def test_decode_frame_handles_json_and_binary():
+    """decode_frame turns binary repl chunks into the same dicts as JSON ones."""
+    assert monocle_client.decode_frame('{"type": "repl_done", "ok": true}')["ok"] is True
+    frame = monocle_client.FRAME_HEADER.pack(monocle_client.FRAME_REPL_CHUNK, 0, 0, 3, 8, 2) + "é\r\n".encode()
+    assert monocle_client.decode_frame(frame) == {
+        "type": "repl_chunk", "client": 3, "id": 8, "seq": 2, "data": "é\r\n",
+    }
+    frame = monocle_client.FRAME_HEADER.pack(monocle_client.FRAME_FILE_DATA, 0, 0, 3, 9, 0) + b"\x00\xff"
+    assert monocle_client.decode_frame(frame) == {
+        "type": "file_data", "client": 3, "id": 9, "seq": 0, "data": b"\x00\xff",
+    }
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("ws_client", ["websockets", "builtin"])
+async def test_client_against_relay_and_simulated_bridge(ws_client):
+    """The library end to end: concurrent repl, stream, batch and files over one connection."""
+    import websockets
+
+    import server
+    from simulator import SimulatedBridge
+
+    ws_server = await websockets.serve(server.relay, "127.0.0.1", 0)
+    url = f"ws://127.0.0.1:{ws_server.sockets[0].getsockname()[1]}"
+    try:
+        async with SimulatedBridge(url) as bridge:
+            bridge.connected = True
+            async with MonocleClient(url, ws_client=ws_client) as client:
+                assert await asyncio.gather(*(client.repl(f"{i}*2") for i in range(5))) == ["0", "2", "4", "6", "8"]
+                assert "".join([t async for t in client.stream("for i in range(3): print(i)")]) == "0\r\n1\r\n2\r\n"
+                assert await client.batch(["a = 5", "a + 1"]) == ["", "6"]
+                await client.push("/x.txt", b"hello")
+                assert [e["name"] for e in await client.ls("/")] == ["x.txt"]
+                assert len(client.link.log) > 0
+                assert client.link.ws.__module__.startswith(ws_client if ws_client == "websockets" else "monocle_ws")
+    finally:
+        ws_server.close()
+        await ws_server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_record_writes_data_frames_and_json_chunks_to_out(scripted_link):
+    import io
+
+    link = scripted_link(lambda frame: [
+        {"type": "data_started"},
+        {"type": "data_chunk", "data": "AAE="},
+        {"type": "data_done", "ok": True, "source": "microphone", "size": 4},
+    ])
+    client = await _client(link)
+    link.push({"type": "data_chunk", "id": 99, "data": "AgM="})  # no such call: ignored
+    out = io.BytesIO()
+    reply = await client.record(0.5, out, sample_rate=16000)
+    assert out.getvalue() == b"\x00\x01" and reply["size"] == 4
+    frame = json.loads(link.sent[0])
+    assert (frame["type"], frame["source"], frame["seconds"], frame["sample_rate"]) == (
+        "data_capture", "microphone", 0.5, 16000)
+    data = monocle_client.FRAME_HEADER.pack(monocle_client.FRAME_DATA, 0, 0, 3, 7, 1) + b"\xff\xd8"
+    assert monocle_client.decode_frame(data)["type"] == "data_chunk"
+    await client.close()
+
+
+@pytest.mark.asyncio
+async def test_watch_yields_changes_and_unwatches_when_left(scripted_link):
+    def relay(frame):
+        if frame["type"] == "unwatch":
+            link.push({"type": "watch_done", "id": frame["ids"][0], "ok": True})
+            return [{"type": "unwatched", "count": 1}]
+        return [{"type": "watch_started", "watchers": 1},
+                {"type": "watch_value", "data": "90", "ok": True, "at": 1},
+                {"type": "watch_value", "data": "89", "ok": True, "at": 2}]
+
+    link = scripted_link(relay)
+    client = await _client(link)
+    values = client.watch("battery()", interval=5)
+    assert [(await values.__anext__())["data"] for _ in range(2)] == ["90", "89"]
+    await values.aclose()
+    watch, unwatch = (json.loads(m) for m in link.sent)
+    assert (watch["expr"], watch["interval"]) == ("battery()", 5)
+    assert unwatch["type"] == "unwatch" and unwatch["ids"] == [watch["id"]]
+    link.script = lambda frame: [{"type": "watch_done", "ok": False, "error": "no bridge connected"}]
+    with pytest.raises(MonocleError, match="no bridge connected"):
+        async for _ in client.watch("1"):
+            pass
+    assert client._calls == {}
+    await client.close()
@@ -0,0 +1,87 @@
+"""Unit tests for monocle_display.py."""
+import asyncio
+import json
+
+import pytest
+
+import monocle_display
+from monocle_client import MonocleClient, MonocleError
+from monocle_display import Display, parse_frame, primitive_code, rasterize, read_image
+
+
+def test_delta_code_sends_only_what_changed():
+    display = Display(client=None)
+    first = display.delta_code({"title": ("Text", "HUD", 0, 0, 0xFFFFFF), "box": ("Rectangle", 0, 0, 9, 9, 255)})
+    assert first.startswith(monocle_display.RUNTIME)
+    assert first.endswith("_F(None,{0:_T('HUD',0,0,16777215),1:_R(0,0,9,9,255)})")
+    assert display.delta_code({"title": ("Text", "HUD", 0, 0, 0xFFFFFF), "box": ("Rectangle", 0, 0, 9, 9, 255)}) is None
+    assert display.delta_code({"title": ["Text", "HUD", 0, 0, 0xFFFFFF], "n": ["Text", "1", 0, 50, 255]}) == (
+        "_F([1],{2:_T('1',0,50,255)})")
+    display.reset()
+    assert display.delta_code({"n": ("Text", "1", 0, 50, 255)}).endswith("_F(None,{0:_T('1',0,50,255)})")
+
+
+def test_primitive_code_names_constants_and_rejects_bad_names():
+    assert primitive_code(("Text", "hi", 320, 200, 0xFF, {"justify": "MIDDLE_CENTER"})) == (
+        "_T('hi',320,200,255,justify=display.MIDDLE_CENTER)")
+    assert primitive_code(("Polygon", [0, 0, 9, 9, 0, 9], 0xFF)) == "_G([0, 0, 9, 9, 0, 9],255)"
+    assert primitive_code(("Sprite", 1, {"label": "x"})) == "display.Sprite(1,label='x')"
+    with pytest.raises(ValueError):
+        primitive_code(("os.remove", "/main.py"))
+    with pytest.raises(ValueError):
+        primitive_code(("Text", "hi", {"x=__import__('os').remove('/main.py'),y": 1}))
+    with pytest.raises(ValueError):
+        parse_frame({"a": "Text"})
+    assert parse_frame([["Fill", 0]]) == {"0": ("Fill", 0)}
+
+
+def test_rasterize_merges_runs_into_rectangles():
+    """A 4x2 image, scaled to 640x320 and centred: red top-left quarter, white bottom row, no black."""
+    red, white, black = [255, 0, 0], [255, 255, 255], [0, 0, 0]
+    pixels = bytes(red * 2 + black * 2 + white * 4)
+    frame = rasterize(4, 2, pixels, cell=160)
+    assert sorted(frame.values()) == [
+        ("Rectangle", 0, 40, 319, 199, 0xFF0000),
+        ("Rectangle", 0, 200, 639, 359, 0xFFFFFF),
+    ]
+    # Colors are reduced to a few levels per channel, so near colors merge
+    frame = rasterize(2, 1, bytes([250, 10, 0, 255, 0, 5]), cell=320)
+    assert list(frame.values()) == [("Rectangle", 0, 40, 639, 359, 0xFF0000)]
+
+
+def test_read_image_reads_pnm(tmp_path):
+    (tmp_path / "a.ppm").write_bytes(b"P6\n# comment\n2 1\n255\n" + bytes([1, 2, 3, 4, 5, 6]))
+    assert read_image(tmp_path / "a.ppm") == (2, 1, bytes([1, 2, 3, 4, 5, 6]))
+    (tmp_path / "b.pgm").write_bytes(b"P2 2 1 15 0 15")
+    assert read_image(tmp_path / "b.pgm") == (2, 1, bytes([0] * 3 + [255] * 3))
+    (tmp_path / "c.pbm").write_bytes(b"P4 3 1\n" + bytes([0b01000000]))
+    assert read_image(tmp_path / "c.pbm") == (3, 1, bytes([255] * 3 + [0] * 3 + [255] * 3))
+    (tmp_path / "d.ppm").write_bytes(b"P6 2 2 255\n" + bytes(6))
+    with pytest.raises(ValueError, match="truncated"):
+        read_image(tmp_path / "d.ppm")
+
+
+@pytest.mark.asyncio
+async def test_show_keeps_frames_in_flight_and_resends_whole_after_a_failure(scripted_link):
+    link = scripted_link()
+    client = MonocleClient(link=link)
+    await client.connect()
+    display = Display(client, max_in_flight=2)
+    assert await display.show({"a": ("Text", "1", 0, 0, 255)})
+    assert await display.show({"a": ("Text", "2", 0, 0, 255)})
+    assert not await display.show({"a": ("Text", "2", 0, 0, 255)})
+    third = asyncio.ensure_future(display.show({"a": ("Text", "3", 0, 0, 255)}))
+    await asyncio.sleep(0.01)
+    assert not third.done() and len(link.sent) == 2
+    link.push({"type": "repl_response", "id": 1, "data": ""})
+    await third
+    link.push({"type": "repl_response", "id": 2, "data": "Traceback (most recent call last):\r\n"
+                                                         "NameError: name '_F' isn't defined"})
+    link.push({"type": "repl_response", "id": 3, "data": ""})
+    with pytest.raises(MonocleError, match="NameError"):
+        await display.flush()
+    await display.show({"a": ("Text", "4", 0, 0, 255)})
+    code = json.loads(link.sent[-1])["code"]
+    assert code.startswith(monocle_display.RUNTIME) and code.endswith("_F(None,{0:_T('4',0,0,255)})")
+    assert display.frames == 4
+    await client.close()
@@ -0,0 +1,84 @@
+"""Tests for monocle_ws.py, the built-in WebSocket client, against a websockets server."""
+import asyncio
+import os
+
+import pytest
+import websockets
+
+import monocle_ws
+
+
+@pytest.fixture
+async def echo_url():
+    """A websockets server that echoes messages; "close" closes with 4000, "ping" pings first."""
+    async def echo(ws):
+        async for message in ws:
+            if message == "close":
+                await ws.close(4000, "bye")
+            elif message == "ping":
+                await asyncio.wait_for(await ws.ping(), 2)  # waits for the pong
+                await ws.send("pong received")
+            elif message == "fragments":
+                await ws.send(iter(["frag", "ment", "ed"]))
+            else:
+                await ws.send(message)
+
+    server = await websockets.serve(echo, "127.0.0.1", 0, max_size=None)
+    yield f"ws://127.0.0.1:{server.sockets[0].getsockname()[1]}/path?x=1"
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_messages_round_trip_in_both_kinds_and_sizes(echo_url):
+    ws = await monocle_ws.connect(echo_url)
+    big = os.urandom(200_000)
+    for message in ("hi", "é" * 100, b"", b"\x00\x01", big):
+        await ws.send(message)
+        assert await ws.recv() == message
+    await ws.send("fragments")
+    assert await ws.recv() == "fragmented"
+    await ws.send("ping")
+    assert await ws.recv() == "pong received"
+    await ws.close()
+    assert ws.close_code == 1000
+    with pytest.raises(monocle_ws.ConnectionClosed):
+        await ws.send("after close")
+
+
+@pytest.mark.asyncio
+async def test_server_close_ends_iteration_with_its_code(echo_url):
+    ws = await monocle_ws.connect(echo_url)
+    await ws.send("close")
+    assert [message async for message in ws] == []
+    assert ws.close_code == 4000
+    with pytest.raises(monocle_ws.ConnectionClosed, match="4000 bye"):
+        await ws.recv()
+
+
+@pytest.mark.asyncio
+async def test_rejected_handshake_and_lost_connection():
+    async def not_websocket(reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+        await writer.drain()
+        writer.close()
+
+    http = await asyncio.start_server(not_websocket, "127.0.0.1", 0)
+    port = http.sockets[0].getsockname()[1]
+    with pytest.raises(monocle_ws.InvalidStatus) as exc:
+        await monocle_ws.connect(f"ws://127.0.0.1:{port}")
+    assert exc.value.status == 404
+    http.close()
+    await http.wait_closed()
+    with pytest.raises(monocle_ws.WebSocketError):
+        await monocle_ws.connect("wss://127.0.0.1:1")
+
+
+@pytest.mark.asyncio
+async def test_aborted_connection_raises_connection_closed(echo_url):
+    ws = await monocle_ws.connect(echo_url)
+    ws.transport.abort()
+    with pytest.raises(monocle_ws.ConnectionClosed) as exc:
+        await ws.recv()
+    assert exc.value.code == 1006
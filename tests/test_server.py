@@ -1,11 +1,13 @@
 """Unit and integration tests for server.py."""
 import asyncio
 import json
+import time
 from pathlib import Path
 from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 import websockets
+from websockets.frames import Frame, Opcode
 
 # Import after path setup
 import sys
@@ -13,6 +15,13 @@ sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 import server
 
 
+def _add_bridge(ws, bridge_id=None, features=(), **link):
+    """Register a bridge as if its page had connected."""
+    bridge = server.bridges[bridge_id] = server.Bridge(bridge_id, ws, features)
+    bridge.link.update(link)
+    return bridge
+
+
 @pytest.mark.asyncio
 async def test_relay_registers_bridge():
     """Bridge client receives registered confirmation."""
@@ -80,8 +89,7 @@ async def test_relay_forwards_to_other_client():
     mock_ws.open = True
     mock_ws.send = AsyncMock()
 
-    server.bridge_ws = mock_ws
-    server.cli_ws = other_ws
+    server.cli_clients[1] = other_ws
 
     async def mock_iter():
         yield json.dumps({"role": "bridge"})
@@ -100,44 +108,492 @@ async def test_relay_forwards_to_other_client():
 
     # First call: registered. Second: forward to other (other_ws.send)
     assert other_ws.send.call_count >= 1
-    forwarded = json.loads(other_ws.send.call_args_list[-1][0][0])
+    forwarded = json.loads(other_ws.send.call_args_list[0][0][0])
     assert forwarded["type"] == "repl_response"
     assert forwarded["data"] == "42"
 
 
 @pytest.mark.asyncio
-async def test_http_handler_serves_bridge_html():
-    """HTTP handler returns bridge.html for / and /bridge.html."""
-    reader = AsyncMock()
+async def test_relay_tags_cli_frames_with_client_id():
+    """Frames from a CLI reach the bridge tagged with that CLI's client id."""
+    bridge = AsyncMock()
+    bridge.open = True
+    _add_bridge(bridge)
+
+    mock_ws = AsyncMock()
+    mock_ws.open = True
+
+    async def mock_iter():
+        yield json.dumps({"role": "cli"})
+        yield json.dumps({"type": "repl", "id": 7, "code": "1+1"})
+
+    mock_ws.__aiter__ = lambda self: mock_iter()
+
+    await server.relay(mock_ws, "/")
+
+    registered = json.loads(mock_ws.send.call_args_list[0][0][0])
+    forwarded = json.loads(bridge.send.call_args[0][0])
+    assert forwarded["id"] == 7
+    assert forwarded["client"] == registered["client"]
+    assert server.cli_clients == {}
+
+
+@pytest.mark.asyncio
+async def test_relay_routes_bridge_replies_by_client():
+    """Bridge replies go only to the CLI named in ``client``; untagged ones go to all."""
+    cli_a = AsyncMock()
+    cli_a.open = True
+    cli_b = AsyncMock()
+    cli_b.open = True
+    server.cli_clients.update({1: cli_a, 2: cli_b})
+
+    mock_ws = AsyncMock()
+    mock_ws.open = True
+
+    async def mock_iter():
+        yield json.dumps({"role": "bridge"})
+        yield json.dumps({"type": "repl_response", "id": 1, "client": 2, "data": "2"})
+        yield json.dumps({"type": "connected", "ok": True})
+
+    mock_ws.__aiter__ = lambda self: mock_iter()
+
+    await server.relay(mock_ws, "/")
+
+    a_frames = [json.loads(c[0][0]) for c in cli_a.send.call_args_list]
+    b_frames = [json.loads(c[0][0]) for c in cli_b.send.call_args_list]
+    assert [f["type"] for f in a_frames] == ["connected", "bridge_gone"]
+    assert [f["type"] for f in b_frames] == ["repl_response", "connected", "bridge_gone"]
+
+
+@pytest.mark.asyncio
+async def test_relay_tells_clis_when_bridge_goes_away():
+    """CLIs get bridge_gone when the bridge disconnects, so they stop waiting."""
+    cli = AsyncMock()
+    cli.open = True
+    server.cli_clients[1] = cli
+
+    mock_ws = AsyncMock()
+    mock_ws.open = True
+
+    async def mock_iter():
+        yield json.dumps({"role": "bridge"})
+
+    mock_ws.__aiter__ = lambda self: mock_iter()
+
+    await server.relay(mock_ws, "/")
+
+    assert json.loads(cli.send.call_args[0][0]) == {"type": "bridge_gone"}
+
+
+def test_tag_client_appends_last_key():
+    """The client tag is appended to JSON frames so it overrides a spoofed one."""
+    tagged = server._tag_client('{"type": "repl", "client": 99}', 3)
+    assert json.loads(tagged) == {"type": "repl", "client": 3}
+    assert json.loads(server._tag_client("{}", 4)) == {"client": 4}
+
+
+def test_tag_client_stamps_binary_header():
+    """Binary frames get the client id written into the fixed header."""
+    frame = server.FRAME_HEADER.pack(2, 1, 0, 0, 9, 0) + b"payload"
+    tagged = server._tag_client(frame, 5)
+    assert server.FRAME_HEADER.unpack_from(tagged) == (2, 1, 0, 5, 9, 0)
+    assert tagged.endswith(b"payload")
+
+
+def test_frame_client_reads_prefix_binary_and_fallback():
+    """Routing target comes from the leading tag, the binary header, or a full parse."""
+    assert server._frame_client('{"client":12,"id":1,"type":"repl_done"}') == 12
+    assert server._frame_client(server.FRAME_HEADER.pack(1, 0, 0, 7, 1, 0) + b"x") == 7
+    assert server._frame_client(server.FRAME_HEADER.pack(1, 0, 0, 0, 1, 0)) is None
+    assert server._frame_client('{"type": "connected", "client": 2}') == 2
+    assert server._frame_client('{"type": "connected", "ok": true}') is None
+
+
+@pytest.mark.asyncio
+async def test_relay_does_not_parse_after_registration():
+    """Once registered, frames are forwarded without json.loads."""
+    cli = AsyncMock()
+    cli.open = True
+    server.cli_clients[1] = cli
+
+    mock_ws = AsyncMock()
+    mock_ws.open = True
+    frames = ['{"client":1,"id":%d,"type":"repl_chunk","data":"x"}' % i for i in range(5)]
+
+    async def mock_iter():
+        yield json.dumps({"role": "bridge", "features": ["binary"]})
+        for frame in frames:
+            yield frame
+
+    mock_ws.__aiter__ = lambda self: mock_iter()
+
+    with patch.object(server.json, "loads", wraps=json.loads) as loads:
+        await server.relay(mock_ws, "/")
+    assert loads.call_count == 1
+    assert [c[0][0] for c in cli.send.call_args_list[:5]] == frames
+
+
+@pytest.mark.asyncio
+async def test_relay_reports_bridge_features_to_cli():
+    """A CLI's registration reply lists the features of the connected bridge."""
+    _add_bridge(AsyncMock(), features=["binary"])
+
+    mock_ws = AsyncMock()
+    mock_ws.open = True
+
+    async def mock_iter():
+        yield json.dumps({"role": "cli"})
+
+    mock_ws.__aiter__ = lambda self: mock_iter()
+
+    await server.relay(mock_ws, "/")
+
+    assert json.loads(mock_ws.send.call_args[0][0])["features"] == ["binary"]
+
+
+@pytest.mark.asyncio
+async def test_relay_consumes_bridge_metrics_reports():
+    """bridge_metrics frames feed /metrics and are not forwarded to CLIs."""
+    cli = AsyncMock()
+    cli.open = True
+    server.cli_clients[1] = cli
+
+    mock_ws = AsyncMock()
+    mock_ws.open = True
+
+    async def mock_iter():
+        yield json.dumps({"role": "bridge"})
+        yield '{"type":"bridge_metrics","queued":2,"write_ms":[1.5,2],"notify_ms":[20],"ble_connects":2}'
+        queued.append(server.metrics.bridge_queue)
+
+    mock_ws.__aiter__ = lambda self: mock_iter()
+    queued = []
+
+    await server.relay(mock_ws, "/")
+
+    assert [json.loads(c[0][0])["type"] for c in cli.send.call_args_list] == ["bridge_gone"]
+    assert queued == [2]
+    assert server.metrics.bridge_queue == 0  # a departed bridge queues nothing
+    assert server.metrics.ble.series["write"]["count"] == 2
+    assert server.metrics.ble.series["notify"]["count"] == 1
+    assert server.metrics.reconnects["ble"] == 1
+
+
+@pytest.mark.asyncio
+async def test_relay_caches_link_state_until_bridge_leaves():
+    """link_state frames update the relay's cache and are not forwarded to CLIs."""
+    cli = AsyncMock()
+    cli.open = True
+    server.cli_clients[1] = cli
+    seen = []
+
+    mock_ws = AsyncMock()
+    mock_ws.open = True
+
+    async def mock_iter():
+        yield json.dumps({"role": "bridge"})
+        yield '{"type":"link_state","connected":true,"device":"monocle"}'
+        seen.append(dict(server.bridges[None].link))
+
+    mock_ws.__aiter__ = lambda self: mock_iter()
+
+    await server.relay(mock_ws, "/")
+
+    assert seen == [{"connected": True, "device": "monocle"}]
+    assert [json.loads(c[0][0])["type"] for c in cli.send.call_args_list] == ["bridge_gone"]
+    assert server.bridges == {}
+
+
+def test_relay_answers_status_and_connect_while_link_is_up():
+    bridge = _add_bridge(AsyncMock())
+    assert server._answer_locally(3, '{"id": 1, "type": "connect"}') is None
+    status = json.loads(server._answer_locally(3, '{"id": 2, "type": "status"}'))
+    assert status == {"client": 3, "id": 2, "type": "status", "bridge": True, "connected": False, "device": None}
+    bridge.link.update(connected=True, device="monocle")
+    cached = json.loads(server._answer_locally(3, '{"id": 4, "type": "connect"}'))
+    assert cached["type"] == "connected" and cached["ok"] and cached["cached"]
+    assert server._answer_locally(3, '{"id": 5, "type": "connect", "fresh": true}') is None
+    assert server._answer_locally(3, '{"id": 6, "type": "repl", "code": "1"}') is None
+
+
+@pytest.mark.asyncio
+async def test_watch_requests_share_a_poll_and_end_with_their_bridge():
+    bridge_ws, cli = AsyncMock(), AsyncMock()
+    bridge = _add_bridge(bridge_ws, "a", connected=True)
+    server.cli_clients[3] = server.cli_clients[4] = cli
+    watch = '{"id": 1, "type": "watch", "expr": "battery()", "interval": 5}'
+    assert await server._watch_request(3, watch) and await server._watch_request(4, watch)
+    assert await server._watch_request(3, '{"id": 2, "type": "watch", "expr": " "}')
+    assert not await server._watch_request(3, '{"id": 3, "type": "repl", "code": "\\"type\\": \\"watch\\""}')
+    await asyncio.sleep(0.05)
+    (poll,) = server.polls.values()
+    assert poll.watchers == {(3, 1), (4, 1)}
+    (query,) = [json.loads(c[0][0]) for c in bridge_ws.send.call_args_list]
+    assert (query["type"], query["code"], query["client"]) == ("repl", "battery()", server.POLL_CLIENT)
+    assert (server.POLL_CLIENT, query["id"]) in bridge.inflight
+    server._poll_reply(json.dumps({"client": 0, "id": query["id"], "type": "repl_response", "data": "87"}))
+    await asyncio.sleep(0.05)
+    assert "monocle_watch_polls 1" in server.metrics.render() and "monocle_watchers 2" in server.metrics.render()
+    await server._bridge_gone(bridge)
+    await asyncio.sleep(0.05)
+    frames = [json.loads(c[0][0]) for c in cli.send.call_args_list]
+    assert [(f["type"], f.get("id")) for f in frames] == [
+        ("watch_started", 1), ("watch_started", 1), ("watch_done", 2), ("watch_value", 1), ("watch_value", 1),
+        ("watch_done", 1), ("watch_done", 1), ("bridge_gone", None), ("bridge_gone", None)]
+    assert frames[1]["watchers"] == 2 and frames[2]["error"] == "watch needs an expression"
+    assert frames[3]["data"] == "87" and frames[5]["error"] == "bridge disconnected"
+    assert server.polls == {} and poll.task.cancelled()
+
+
+@pytest.mark.asyncio
+async def test_unanswered_poll_does_not_leave_its_bridge_busy():
+    bridge_ws = AsyncMock()
+    bridge = _add_bridge(bridge_ws, "a", connected=True)
+    server.cli_clients[3] = AsyncMock()
+    with patch.object(server, "WATCH_POLL_TIMEOUT", 0.05):
+        assert await server._watch_request(3, '{"id": 1, "type": "watch", "expr": "battery()", "interval": 5}')
+        await asyncio.sleep(0.02)
+        assert len(bridge.inflight) == 1
+        await asyncio.sleep(0.1)
+    assert bridge_ws.send.call_count == 1 and bridge.inflight == set() and server._poll_replies == {}
+    assert bridge.summary()["busy"] == 0
+    await server._bridge_gone(bridge)
+
+
+def test_route_pins_cli_to_least_busy_bridge_or_named_device():
+    busy = _add_bridge(AsyncMock(), "a", connected=True)
+    idle = _add_bridge(AsyncMock(), "b", connected=True, device="glasses")
+    _add_bridge(AsyncMock(), "c")  # Monocle not connected
+    busy.inflight.add((9, 1))
+    assert server._route(1) is idle
+    busy.inflight.clear()
+    assert server._route(1) is idle  # pinned
+    assert server._route(2) is busy
+    assert server._route(2, "glasses") is idle and server._route(2, "c").id == "c"
+    assert server._route(2, "nope") is None
+    assert server._request_device('{"id": 1, "sent_at": 1, "device": "b", "type": "repl"}') == "b"
+    assert server._request_device('{"id": 1, "type": "repl", "code": "x = \\"device\\": \\"b\\""}') is None
+
+
+def test_cli_features_are_those_all_bridges_share():
+    _add_bridge(AsyncMock(), "a", features=["binary", "zlib"])
+    assert server._common_features() == ["binary", "zlib"]
+    _add_bridge(AsyncMock(), "b", features=["binary"])
+    assert server._common_features() == ["binary"]
+
+
+def test_metrics_time_each_hop_from_frame_heads():
+    """A request is timed from the CLI's sent_at to the bridge's final reply timing."""
+    metrics = server.RelayMetrics()
+    now = server._now_ms()
+    key = metrics.request_received(4, json.dumps({"id": 7, "sent_at": now - 5, "type": "repl", "code": "1"}))
+    metrics.request_forwarded(key)
+    assert key == (4, 7)
+    assert len(metrics.inflight) == 1
+
+    chunk = '{"client":4,"id":7,"type":"repl_chunk","data":"x"}'
+    metrics.bridge_frame(chunk)
+    assert len(metrics.inflight) == 1
+    timing = {"recv": round(now), "start": round(now) + 10, "done": round(now) + 30}
+    final = json.dumps({"client": 4, "id": 7, "type": "repl_done", "ok": True, "timing": timing},
+                       separators=(",", ":"))
+    assert metrics.bridge_frame(final) is False
+
+    assert metrics.inflight == {}
+    hops = metrics.hops.series
+    assert set(hops) == {"cli_to_relay", "relay_to_bridge", "bridge_queue", "device", "bridge_to_relay", "relay"}
+    assert hops["device"]["sum"] == pytest.approx(0.02)
+    assert hops["bridge_queue"]["sum"] == pytest.approx(0.01)
+    assert metrics.frames == {"cli_to_bridge": 1, "bridge_to_cli": 2}
+
+
+def test_metrics_render_prometheus_text():
+    metrics = server.RelayMetrics()
+    metrics.hops.observe("device", 0.02)
+    text = metrics.render()
+    assert "# TYPE monocle_requests_in_flight gauge" in text
+    assert 'monocle_relayed_bytes_total{direction="cli_to_bridge"} 0' in text
+    assert 'monocle_hop_latency_seconds_bucket{hop="device",le="0.01"} 0' in text
+    assert 'monocle_hop_latency_seconds_bucket{hop="device",le="0.025"} 1' in text
+    assert 'monocle_hop_latency_seconds_count{hop="device"} 1' in text
+
+
+def _stalled_ws():
+    """Websocket mock whose send never completes until ``release`` is set."""
+    ws = MagicMock()
+    ws.open = True
+    ws.release = asyncio.Event()
+    ws.sent = []
+
+    async def send(message):
+        await ws.release.wait()
+        ws.sent.append(message)
+
+    ws.send = send
+    return ws
+
+
+@pytest.mark.asyncio
+async def test_outbox_block_waits_for_room_and_records_high_water():
+    ws = _stalled_ws()
+    box = server.Outbox(ws, "bridge", "block", max_frames=2)
+    for i in range(3):  # one in the writer, two queued
+        await box.put(f"m{i}")
+    blocked = asyncio.create_task(box.put("m3"))
+    await asyncio.sleep(0.01)
+    assert not blocked.done()
+    ws.release.set()
+    await blocked
+    await box.flush()
+    await box.close()
+    assert ws.sent == ["m0", "m1", "m2", "m3"]
+    assert server.metrics.outbox["bridge"]["high_water"] == 2
+
+
+@pytest.mark.asyncio
+async def test_outbox_full_cli_queue_disconnects_instead_of_blocking():
+    """Under block, a CLI that stopped reading is dropped; its queued frames are kept for a resume."""
+    ws = _stalled_ws()
+    box = server.Outbox(ws, "cli", "block", max_frames=2)
+    for i in range(4):
+        await asyncio.wait_for(box.put(f"m{i}"), 1)
+    ws.transport.abort.assert_called_once()
+    assert box.broken and list(box.frames) == ["m1", "m2", "m3"]
+    assert server.metrics.outbox["cli"]["disconnected"] == 1
+    assert box.take() == ["m1", "m2", "m3"]
+
+
+@pytest.mark.asyncio
+async def test_outbox_urgent_frame_skips_other_clients_and_full_queue():
+    ws = _stalled_ws()
+    box = server.Outbox(ws, "bridge", "block", max_frames=2)
+    await box.put("head")  # taken by the writer
+    await asyncio.sleep(0)
+    await box.put('{"id": 1, "type": "repl", "client":2}')
+    await box.put('{"id": 1, "type": "repl", "client":1}')
+    interrupt = server._tag_client('{"id": 2, "type": "interrupt"}', 2)
+    await asyncio.wait_for(box.put(interrupt, urgent=True), 1)
+    ws.release.set()
+    await box.flush()
+    await box.close()
+    # Ahead of client 1's frame, behind client 2's own earlier one
+    assert ws.sent == ["head", '{"id": 1, "type": "repl", "client":2}', interrupt,
+                       '{"id": 1, "type": "repl", "client":1}']
+
+
+@pytest.mark.asyncio
+async def test_outbox_drop_oldest_bounds_queue():
+    ws = _stalled_ws()
+    box = server.Outbox(ws, "cli", "drop_oldest", max_frames=2)
+    await box.put("m0")
+    await asyncio.sleep(0)  # the writer takes m0 and stalls on it
+    for i in range(1, 6):
+        await box.put(f"m{i}")
+    assert list(box.frames) == ["m4", "m5"]
+    assert server.metrics.outbox["cli"]["dropped"] == 3
+    ws.release.set()
+    await box.close()
+    assert ws.sent == ["m0", "m4", "m5"]
+
+
+@pytest.mark.asyncio
+async def test_outbox_byte_limit_lets_one_large_frame_through():
+    ws = _stalled_ws()
+    box = server.Outbox(ws, "cli", "drop_oldest", max_frames=100, max_bytes=10)
+    await box.put("x")
+    await asyncio.sleep(0)
+    await box.put("y" * 50)
+    await box.put("z")
+    assert list(box.frames) == ["z"]
+    ws.release.set()
+    await box.close()
+
+
+@pytest.mark.asyncio
+async def test_outbox_merge_replaces_superseded_status_frames():
+    ws = _stalled_ws()
+    box = server.Outbox(ws, "cli", "merge")
+    await box.put("first")
+    await asyncio.sleep(0)
+    await box.put('{"client":1,"id":null,"type":"connected","ok":false}')
+    await box.put('{"client":1,"id":2,"type":"repl_chunk","data":"a"}')
+    await box.put('{"client":1,"id":null,"type":"connected","ok":true}')
+    await box.put('{"client":1,"id":2,"type":"repl_chunk","data":"b"}')
+    assert [(f["type"], f.get("ok"), f.get("data")) for f in map(json.loads, box.frames)] == [
+        ("connected", True, None), ("repl_chunk", None, "a"), ("repl_chunk", None, "b"),
+    ]
+    assert server.metrics.outbox["cli"]["merged"] == 1
+    ws.release.set()
+    await box.close()
+
+
+@pytest.mark.asyncio
+async def test_relay_slow_cli_does_not_stall_other_clis():
+    """With the default policy, a CLI that stopped reading is dropped and the relay keeps going."""
+    slow = _stalled_ws()
+    fast = AsyncMock()
+    fast.open = True
+    server.cli_clients.update({1: slow, 2: fast})
+
+    mock_ws = AsyncMock()
+    mock_ws.open = True
+
+    async def mock_iter():
+        yield json.dumps({"role": "bridge"})
+        for i in range(2 * server.OUTBOX_FRAMES):
+            yield '{"client":1,"id":1,"type":"repl_chunk","data":"%d"}' % i
+        yield '{"client":2,"id":1,"type":"repl_done","ok":true}'
+
+    mock_ws.__aiter__ = lambda self: mock_iter()
+
+    await asyncio.wait_for(server.relay(mock_ws, "/"), timeout=2)
+    await server.outboxes[fast].flush()
+
+    assert json.loads(fast.send.call_args_list[0][0][0])["type"] == "repl_done"
+    slow.transport.abort.assert_called_once()
+    assert 'monocle_outbox_disconnects_total{role="cli"} 1' in server.metrics.render()
+    slow.release.set()
+
+
+def _http_reader(data):
+    """StreamReader holding ``data`` followed by EOF (client done sending)."""
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    return reader
+
+
+def _http_writer():
     writer = MagicMock()
     writer.write = MagicMock()
     writer.drain = AsyncMock()
     writer.close = MagicMock()
+    return writer
+
 
-    for path in ["/", "/bridge.html"]:
-        reader.read = AsyncMock(return_value=f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
-        writer.reset_mock()
-        writer.write = MagicMock()
-        writer.drain = AsyncMock()
-        writer.close = MagicMock()
+@pytest.mark.asyncio
+async def test_http_handler_serves_bridge_html():
+    """HTTP handler returns bridge.html for / and /bridge.html."""
+    for path in ["/", "/bridge.html", "/?mtu=185"]:
+        reader = _http_reader(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+        writer = _http_writer()
 
         await server.http_handler(reader, writer)
 
-        assert b"HTTP/1.1 200 OK" in writer.write.call_args_list[0][0][0]
-        assert b"Content-Type: text/html" in writer.write.call_args_list[0][0][0]
-        assert b"Monocle Bridge" in writer.write.call_args_list[1][0][0]
+        head = writer.write.call_args_list[0][0][0]
+        body = writer.write.call_args_list[1][0][0]
+        assert b"HTTP/1.1 200 OK" in head
+        assert b"Content-Type: text/html" in head
+        assert b"Content-Length: %d" % len(body) in head
+        assert b"Monocle Bridge" in body
         writer.close.assert_called_once()
 
 
 @pytest.mark.asyncio
 async def test_http_handler_404_for_unknown_path():
     """HTTP handler returns 404 for unknown paths."""
-    reader = AsyncMock()
-    reader.read = AsyncMock(return_value=b"GET /nonexistent HTTP/1.1\r\nHost: localhost\r\n\r\n")
-    writer = MagicMock()
-    writer.write = MagicMock()
-    writer.drain = AsyncMock()
-    writer.close = MagicMock()
+    reader = _http_reader(b"GET /nonexistent HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    writer = _http_writer()
 
     await server.http_handler(reader, writer)
 
@@ -145,26 +601,87 @@ async def test_http_handler_404_for_unknown_path():
     writer.close.assert_called_once()
 
 
+@pytest.mark.asyncio
+async def test_http_handler_serves_metrics():
+    """/metrics returns the relay's counters in Prometheus text format."""
+    reader = _http_reader(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    writer = _http_writer()
+
+    await server.http_handler(reader, writer)
+
+    head = writer.write.call_args_list[0][0][0]
+    body = writer.write.call_args_list[1][0][0]
+    assert b"Content-Type: text/plain; version=0.0.4" in head
+    assert b"Content-Length: %d" % len(body) in head
+    assert b"monocle_requests_in_flight 0" in body
+
+
 @pytest.mark.asyncio
 async def test_http_handler_malformed_request():
     """HTTP handler handles malformed request without crashing."""
-    reader = AsyncMock()
-    reader.read = AsyncMock(return_value=b"garbage\r\n")
-    writer = MagicMock()
-    writer.write = MagicMock()
-    writer.drain = AsyncMock()
-    writer.close = MagicMock()
+    reader = _http_reader(b"garbage\r\n")
+    writer = _http_writer()
+
+    await server.http_handler(reader, writer)
+
+    # Should not raise; an incomplete request gets a 400
+    assert b"400 Bad Request" in writer.write.call_args[0][0]
+    writer.close.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_http_handler_keep_alive_serves_several_requests():
+    """Several requests on one connection each get a response before it closes."""
+    req = b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n"
+    reader = _http_reader(req + req + b"GET / HTTP/1.1\r\nConnection: close\r\n\r\n")
+    writer = _http_writer()
 
     await server.http_handler(reader, writer)
 
-    # Should not raise; path extraction may get "garbage" or "/"
-    writer.write.assert_called()
+    heads = [c[0][0] for c in writer.write.call_args_list if c[0][0].startswith(b"HTTP/1.1")]
+    assert len(heads) == 3
+    assert b"Connection: keep-alive" in heads[0]
+    assert b"Connection: close" in heads[2]
     writer.close.assert_called_once()
 
 
+@pytest.mark.asyncio
+async def test_http_handler_etag_and_gzip():
+    """Matching If-None-Match gets 304; Accept-Encoding gzip gets the compressed page."""
+    import gzip
+
+    writer = _http_writer()
+    await server.http_handler(_http_reader(b"GET / HTTP/1.1\r\nAccept-Encoding: gzip, br\r\n\r\n"), writer)
+    head, body = writer.write.call_args_list[0][0][0], writer.write.call_args_list[1][0][0]
+    assert b"Content-Encoding: gzip" in head
+    assert b"Monocle Bridge" in gzip.decompress(body)
+    etag = [line for line in head.split(b"\r\n") if line.startswith(b"ETag: ")][0][6:]
+
+    writer = _http_writer()
+    await server.http_handler(_http_reader(b"GET / HTTP/1.1\r\nIf-None-Match: " + etag + b"\r\n\r\n"), writer)
+    assert writer.write.call_count == 1
+    assert b"304 Not Modified" in writer.write.call_args[0][0]
+
+
+def test_load_asset_reloads_only_when_mtime_changes(tmp_path):
+    """Assets are read once and re-read after the file's mtime changes."""
+    import os
+
+    page = tmp_path / "bridge.html"
+    page.write_text("one")
+    with patch.object(server, "BRIDGE_DIR", tmp_path), patch.dict(server._static_cache, clear=True):
+        first = server._load_asset("bridge.html")
+        assert server._load_asset("bridge.html") is first
+        page.write_text("two")
+        os.utime(page, ns=(first["mtime"] + 10**9, first["mtime"] + 10**9))
+        second = server._load_asset("bridge.html")
+    assert second["body"] == b"two"
+    assert second["etag"] != first["etag"]
+
+
 @pytest.mark.asyncio
 async def test_relay_cleans_up_on_disconnect():
-    """Relay clears bridge_ws when bridge disconnects."""
+    """Relay forgets the bridge when it disconnects."""
     mock_ws = AsyncMock()
     mock_ws.open = True
     mock_ws.send = AsyncMock()
@@ -177,7 +694,7 @@ async def test_relay_cleans_up_on_disconnect():
 
     await server.relay(mock_ws, "/")
 
-    assert server.bridge_ws is None
+    assert server.bridges == {}
 
 
 @pytest.mark.asyncio
@@ -195,4 +712,118 @@ async def test_relay_handles_generic_exception():
 
     await server.relay(mock_ws, "/")
 
-    assert server.bridge_ws is None
+    assert server.bridges == {}
+
+
+def test_session_replays_missed_and_held_frames():
+    """Replay is what the peer missed plus what was held for it, or None once part of it is gone."""
+    with patch.object(server, "REPLAY_FRAMES", 3):
+        session = server.Session("cli", 1)
+        for frame in ("a", "b", "c", "d"):
+            session.record(frame)
+        assert session.hold("e")
+        assert session.replay(0) is None  # "a" is no longer kept
+        assert session.replay(2) == ["c", "d", "e"]
+        assert session.sent == 2 and not session.held
+        assert [session.hold(frame) for frame in "fghi"] == [True, True, True, False]
+
+
+@pytest.mark.asyncio
+async def test_relay_starts_fresh_session_when_resume_is_impossible():
+    ws_server = await websockets.serve(server.relay, "127.0.0.1", 0)
+    try:
+        client = await websockets.connect(f"ws://127.0.0.1:{ws_server.sockets[0].getsockname()[1]}")
+        await client.send(json.dumps({"role": "cli", "session": "gone", "received": 3}))
+        reg = json.loads(await client.recv())
+        assert reg["resumed"] is False and reg["session"] in server.sessions
+        await client.close()
+        await asyncio.sleep(0.05)
+        assert not server.sessions  # closed on purpose: nothing kept
+    finally:
+        ws_server.close()
+        await ws_server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_relay_answers_malformed_cli_frames_itself():
+    """Frames that are not JSON objects (or whole binary headers) never reach the bridge page."""
+    ws_server = await websockets.serve(server.relay, "127.0.0.1", 0)
+    url = f"ws://127.0.0.1:{ws_server.sockets[0].getsockname()[1]}"
+    try:
+        bridge = await websockets.connect(url)
+        await bridge.send(json.dumps({"role": "bridge"}))
+        await bridge.recv()
+        cli = await websockets.connect(url)
+        await cli.send(json.dumps({"role": "cli"}))
+        client_id = json.loads(await cli.recv())["client"]
+        for frame in ("[]", '"repl"', '{"id": 1, "type": "repl"', b"\x02\x00"):
+            await cli.send(frame)
+            assert json.loads(await cli.recv()) == {"client": client_id, "type": "error", "error": "malformed frame"}
+        await cli.send('{"id": 2, "type": "repl", "code": "1"}')
+        assert json.loads(await bridge.recv()) == {"id": 2, "type": "repl", "code": "1", "client": client_id}
+        await cli.close()
+        await bridge.close()
+    finally:
+        ws_server.close()
+        await ws_server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_ws_compression_skips_small_messages():
+    """Large messages are deflated, small ones go out as they are; both arrive intact."""
+    seen = []
+
+    async def handler(ws):
+        seen.append(ws.protocol.extensions)
+        async for message in ws:
+            await ws.send(message)
+
+    ws_server = await websockets.serve(handler, "127.0.0.1", 0, **server.ws_compression())
+    try:
+        client = await websockets.connect(f"ws://127.0.0.1:{ws_server.sockets[0].getsockname()[1]}")
+        for message in ("x" * 10, "y" * 10000):
+            await client.send(message)
+            assert await client.recv() == message
+        await client.close()
+    finally:
+        ws_server.close()
+        await ws_server.wait_closed()
+    [ext] = seen[0]
+    assert isinstance(ext, server.ThresholdDeflate)
+    small = ext.encode(Frame(Opcode.TEXT, b"x" * 10))
+    large = ext.encode(Frame(Opcode.TEXT, b"y" * 10000))
+    assert not small.rsv1 and small.data == b"x" * 10
+    assert large.rsv1 and len(large.data) < 100
+    data = server.FRAME_HEADER.pack(server.FRAME_DATA, 0, 0, 1, 1, 0) + b"z" * 10000
+    assert not ext.encode(Frame(Opcode.BINARY, data)).rsv1  # raw data channel bytes go as they are
+    with patch.object(server, "WS_COMPRESS_MIN", 0):
+        assert ext.encode(Frame(Opcode.BINARY, b"")).rsv1  # an empty binary frame has no kind byte
+
+
+def test_ws_compression_none_disables_deflate():
+    with patch.object(server, "WS_COMPRESSION", "none"):
+        assert server.ws_compression() == {"compression": None}
+
+
+@pytest.mark.asyncio
+async def test_capture_close_waits_for_the_write_in_flight(tmp_path):
+    """Closing mid-flush keeps batches in order and never writes to a closed file."""
+    path = tmp_path / "session.cap"
+    capture = server.TrafficCapture(path)
+    write = capture._write
+    started = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    def slow_write(data):
+        loop.call_soon_threadsafe(started.set)
+        time.sleep(0.05)
+        write(data)
+
+    capture._write = slow_write
+    ws = object()
+    capture.record(ws, "cli", "first")
+    capture._full.set()
+    await started.wait()
+    capture.record(ws, "cli", "second")
+    await capture.close()
+    assert [frame for _, _, _, frame in server.read_capture(path)] == ["first", "second"]
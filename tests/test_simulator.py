@@ -0,0 +1,904 @@
+"""Tests for simulator.py, bench.py and replay.py - simulated Monocle and bridge behind the real relay."""
+import asyncio
+import base64
+import importlib.util
+import json
+import struct
+import sys
+import wave
+import zlib
+from io import StringIO
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+import websockets
+
+import bench
+import monocle_client
+import replay
+import server
+from monocle_client import MonocleClient
+from monocle_display import Display
+import simulator
+from simulator import SimulatedBridge, SimulatedMonocle
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+spec = importlib.util.spec_from_file_location("monocle_cli", PROJECT_ROOT / "monocle-cli.py")
+monocle_cli = sys.modules.get("monocle_cli") or importlib.util.module_from_spec(spec)
+if "monocle_cli" not in sys.modules:
+    sys.modules["monocle_cli"] = monocle_cli
+    spec.loader.exec_module(monocle_cli)
+
+
+async def _device():
+    device = SimulatedMonocle(mtu=23)
+    received = bytearray()
+    device.listeners.append(received.extend)
+    await device.start()
+    return device, received
+
+
+async def _until(received, marker):
+    while marker not in received:
+        await asyncio.sleep(0.001)
+
+
+@pytest.mark.asyncio
+async def test_device_friendly_repl_echoes_and_prompts():
+    """Friendly REPL echoes the line, prints the result and a new prompt."""
+    device, received = await _device()
+    try:
+        await device.write(b"6*7\r\n")
+        await _until(received, b">>> ")
+        assert bytes(received) == b"6*7\r\n42\r\n>>> "
+    finally:
+        await device.close()
+
+
+@pytest.mark.asyncio
+async def test_device_friendly_repl_auto_indents_continuation_lines():
+    """Like MicroPython, a continuation line starts with the block's indentation already typed."""
+    device, received = await _device()
+    try:
+        await device.write(b"if True:\r\n")
+        await _until(received, b"... ")
+        await device.write(b"x = 1\r\n\r\n")
+        await _until(received, b">>> ")
+        assert bytes(received) == b"if True:\r\n...     x = 1\r\n...     \r\n>>> "
+        assert device.namespace["x"] == 1
+    finally:
+        await device.close()
+
+
+@pytest.mark.asyncio
+async def test_device_raw_paste_grants_window_and_runs_code():
+    """Raw-paste mode announces its window, acks consumed bytes and runs on Ctrl-D."""
+    device, received = await _device()
+    device.paste_window = 8
+    try:
+        await device.write(b"\x01")
+        await device.write(b"\x05A\x01")
+        await _until(received, b"R\x01")
+        assert received.endswith(b"R\x01" + struct.pack("<H", 8))
+        received.clear()
+        await device.write(b"print(1)")  # exactly one window
+        await _until(received, b"\x01")
+        await device.write(b"\x04")
+        await _until(received, b"\x04>")
+        assert bytes(received) == b"\x01\x041\r\n\x04\x04>"
+    finally:
+        await device.close()
+
+
+@pytest.mark.asyncio
+async def test_device_rejects_writes_larger_than_mtu_payload():
+    device = SimulatedMonocle(mtu=23)
+    with pytest.raises(ValueError):
+        await device.write(b"x" * 21)
+
+
+@pytest.fixture
+async def relay_url():
+    ws_server = await websockets.serve(server.relay, "127.0.0.1", 0)
+    yield f"ws://127.0.0.1:{ws_server.sockets[0].getsockname()[1]}"
+    ws_server.close()
+    await ws_server.wait_closed()
+
+
+async def _registered_cli(url):
+    ws = await websockets.connect(url)
+    await ws.send(json.dumps({"role": "cli"}))
+    reg = json.loads(await ws.recv())
+    return ws, reg
+
+
+async def _client(relay_url, features=None):
+    """Connected MonocleClient; ``features`` overrides what the bridge announced."""
+    client = MonocleClient(relay_url)
+    await client.connect()
+    if features is not None:
+        client.features = set(features)
+    return client
+
+
+@pytest.mark.asyncio
+async def test_cli_runs_code_through_relay_and_simulated_bridge(relay_url):
+    """run_repl and run_batch against the real relay and a simulated device."""
+    async with SimulatedBridge(relay_url) as bridge:
+        bridge.connected = True
+        client = await _client(relay_url)
+        assert client.features == {"binary"}
+        out = StringIO()
+        try:
+            with patch("sys.stdout", out):
+                assert await monocle_cli.run_repl(client, "for i in range(3): print(i)") == 0
+                assert await monocle_cli.run_repl(client, "def f(x):\n    return x * 2\nprint(f(21))\n" + "#\n" * 300) == 0
+                assert await monocle_cli.run_repl(client, "1/0") == 1
+                await monocle_cli.run_batch(client, ["a = 5", "a + 1"])
+                nested = "def f(n):\n    for i in range(n):\n        if i:\n            print(i)\n    return n"
+                await monocle_cli.run_batch(client, ["b = 2", nested, "f(b)", "b + 1"])
+        finally:
+            await client.close()
+    text = out.getvalue()
+    assert text.startswith("0\n1\n2\n42\n")
+    assert "ZeroDivisionError" in text
+    assert text.rstrip().endswith("6\n1\n2\n3")
+
+
+@pytest.mark.asyncio
+async def test_code_may_run_longer_than_the_start_timeout(relay_url):
+    """repl_started ends the wait for a first reply, so buffered repl and batch do not cut off slow code."""
+    async with SimulatedBridge(relay_url) as bridge:
+        bridge.connected = True
+        client = MonocleClient(relay_url, timeout=0.2)
+        try:
+            assert await client.repl("import time\ntime.sleep(0.5)\nprint('done')") == "done"
+            assert await client.batch(["import time\ntime.sleep(0.5)", "print(2)"]) == ["", "2"]
+        finally:
+            await client.close()
+
+
+@pytest.mark.asyncio
+async def test_simulated_bridge_reports_not_connected(relay_url):
+    async with SimulatedBridge(relay_url):
+        ws, _ = await _registered_cli(relay_url)
+        await ws.send(json.dumps({"type": "repl", "id": 1, "code": "1"}))
+        resp = json.loads(await asyncio.wait_for(ws.recv(), timeout=2))
+        await ws.close()
+    assert resp["type"] == "repl_response"
+    assert resp["data"] == "ERROR: Not connected to Monocle"
+
+
+@pytest.mark.asyncio
+async def test_bench_runs_all_scenarios():
+    """Smoke run of every benchmark scenario with no simulated BLE delay."""
+    args = bench.parse_args(["--requests", "4", "--clients", "2", "--stream-bytes", "500",
+                             "--batch", "3", "--file-bytes", "3000", "--cli-runs", "1", "--latency", "0", "--notify-interval", "0"])
+    results = await bench.run_bench(args)
+    assert set(results) == {*bench.SCENARIOS, "device", "hops_mean_ms"}
+    assert results["hops_mean_ms"]["device"] >= 0
+    assert results["latency"]["requests"] == 4
+    assert results["concurrent"]["requests"] == 4
+    assert results["stream"]["bytes"] >= 500
+    assert results["batch"]["snippets"] == 3
+    assert results["file"]["bytes"] == 3000
+    assert results["capture"]["bytes"] == len(SimulatedMonocle().camera_image)
+    assert results["cli"]["runs"] == 1 and results["cli"]["websockets_p50_ms"] > 0
+    assert results["startup"]["imports_p50_ms"] > 0 and not results["startup"]["loads_websockets"]
+
+
+@pytest.mark.asyncio
+async def test_captured_session_replays_against_a_simulated_bridge(relay_url, tmp_path):
+    """A session recorded with MONOCLE_CAPTURE plays back through a fresh relay, as fast as its replies allow."""
+    path = tmp_path / "session.cap"
+    server.capture = server.TrafficCapture(path)
+    async with SimulatedBridge(relay_url, device_id="left") as bridge:
+        bridge.connected = True
+        client = await _client(relay_url)
+        try:
+            assert await asyncio.gather(*(client.repl(f"{i}*2") for i in range(5))) == ["0", "2", "4", "6", "8"]
+            await client.push("a.txt", b"x" * 3000)
+            assert await client.repl("len(open('a.txt').read())") == "3000"
+        finally:
+            await client.close()
+        await asyncio.sleep(0.05)
+    await server.capture.close()
+    records = list(server.read_capture(path))
+    cli = [r for r in records if r[2] & server.CAPTURE_CLI]
+    assert json.loads(cli[0][3])["role"] == "cli" and cli[-1][2] & server.CAPTURE_CLOSED
+    assert any(r[2] & server.CAPTURE_BINARY for r in cli)  # the push went as binary frames
+    assert [r[0] for r in records] == sorted(r[0] for r in records)
+    with open(path, "ab") as f:
+        f.write(server.CAPTURE_RECORD.pack(0, 0, 1, 100) + b"cut short")
+    assert len(list(server.read_capture(path))) == len(records)
+
+    server.capture = None
+    server.bridges.clear()
+    results = await replay.run_replay(replay.parse_args([str(path), "--latency", "0", "--notify-interval", "0"]))
+    assert results["devices"] == 1 and results["clients"] == 1
+    assert results["sent"] == results["captured"]["requests"] == results["replayed"]["requests"] == 7
+    assert results["missing"] == 0
+
+
+def test_percentile_nearest_rank():
+    samples = list(range(1, 101))
+    assert bench.percentile(samples, 50) == 50
+    assert bench.percentile(samples, 99) == 99
+    assert bench.percentile([7], 99) == 7
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("features", [{"binary"}, set()])
+async def test_cli_push_pull_ls_rm_through_relay(relay_url, tmp_path, features):
+    """push, ls, pull and rm against the simulated device, binary and JSON."""
+    local = tmp_path / "main.py"
+    local.write_bytes(bytes(range(256)) * 20 + b"\x03\x04 tail")
+    async with SimulatedBridge(relay_url, SimulatedMonocle(mtu=64)) as bridge:
+        bridge.connected = True
+        client = await _client(relay_url, features)
+        out = StringIO()
+        try:
+            with patch("sys.stdout", out):
+                assert await monocle_cli.push_file(client, str(local), "/main.py") == 0
+                assert (bridge.device.root / "main.py").read_bytes() == local.read_bytes()
+                assert not (bridge.device.root / "main.py.part").exists()
+                assert await monocle_cli.list_files(client, "/") == 0
+                copy = tmp_path / "copy.py"
+                assert await monocle_cli.pull_file(client, "/main.py", str(copy)) == 0
+                assert copy.read_bytes() == local.read_bytes()
+                assert await monocle_cli.remove_file(client, "/main.py") == 0
+                assert await monocle_cli.remove_file(client, "/main.py") == 1
+        finally:
+            await client.close()
+    text = out.getvalue()
+    assert f"{local} -> /main.py: {local.stat().st_size} bytes in" in text
+    assert f"{local.stat().st_size}  main.py" in text
+    assert "ENOENT" in text or "No such file" in text
+
+
+@pytest.mark.asyncio
+async def test_push_resumes_from_part_file_and_retries_corrupt_frame(relay_url, tmp_path):
+    """A matching .part prefix is kept; a corrupted frame is re-sent from the good offset."""
+    data = b"0123456789abcdef" * 200
+    local = tmp_path / "big.bin"
+    local.write_bytes(data)
+    device = SimulatedMonocle(mtu=64)
+    (device.root / "big.bin.part").write_bytes(data[:1000])
+    corrupted = []
+
+    def corrupt_once(packet):
+        # Flip a byte of the first file frame past the resumed prefix
+        if not corrupted and packet[:4] == struct.pack("<I", 2020):
+            corrupted.append(packet)
+            return packet[:-1] + bytes([packet[-1] ^ 0xFF])
+        return packet
+
+    device.on_write = corrupt_once
+    async with SimulatedBridge(relay_url, device) as bridge:
+        bridge.connected = True
+        ws, _ = await _registered_cli(relay_url)
+        await ws.send(json.dumps({"id": 1, "type": "file_push", "path": "big.bin",
+                                  "data": base64.b64encode(data).decode()}))
+        while (resp := json.loads(await asyncio.wait_for(ws.recv(), timeout=10)))["type"] != "file_done":
+            assert resp["type"] == "file_progress"
+        await ws.close()
+        assert (device.root / "big.bin").read_bytes() == data
+    assert corrupted
+    assert resp["ok"] and resp["size"] == len(data)
+    assert resp["resumed_from"] == 1000
+
+
+@pytest.mark.asyncio
+async def test_pull_resumes_from_local_part(relay_url, tmp_path):
+    data = bytes(range(200)) * 10
+    device = SimulatedMonocle()
+    (device.root / "log.bin").write_bytes(data)
+    local = tmp_path / "log.bin"
+    (tmp_path / "log.bin.part").write_bytes(data[:700])
+    async with SimulatedBridge(relay_url, device) as bridge:
+        bridge.connected = True
+        client = await _client(relay_url)
+        out = StringIO()
+        try:
+            with patch("sys.stdout", out):
+                assert await monocle_cli.pull_file(client, "log.bin", str(local)) == 0
+        finally:
+            await client.close()
+    assert local.read_bytes() == data
+    assert "resumed at byte 700" in out.getvalue()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("firmware", ["inflate", "deflate"])
+async def test_large_push_and_pull_cross_ble_deflated(relay_url, tmp_path, firmware):
+    """Pushes are inflated on any device with zlib; pulls are deflated only by one that can compress."""
+    data = b"".join(b"print('line %d of a module')\n" % i for i in range(400))
+    local = tmp_path / "mod.py"
+    local.write_bytes(data)
+    device = SimulatedMonocle(zlib=firmware)
+    async with SimulatedBridge(relay_url, device) as bridge:
+        bridge.connected = True
+        ws, _ = await _registered_cli(relay_url)
+        await ws.send(json.dumps({"id": 1, "type": "file_push", "path": "lib/mod.py",
+                                  "data": base64.b64encode(data).decode()}))
+        while (push := json.loads(await asyncio.wait_for(ws.recv(), timeout=10)))["type"] != "file_done":
+            pass
+        await ws.send(json.dumps({"id": 2, "type": "file_pull", "path": "lib/mod.py"}))
+        pulled = b""
+        while (pull := json.loads(await asyncio.wait_for(ws.recv(), timeout=10)))["type"] != "file_done":
+            if pull["type"] == "file_data":
+                pulled += base64.b64decode(pull["data"])
+        await ws.close()
+        assert (device.root / "lib" / "mod.py").read_bytes() == data
+        assert not list((device.root / "lib").glob("*part")) and not list((device.root / "lib").glob("*.tmp"))
+    assert push["ok"] and push["size"] == len(data)
+    assert push["ble_bytes"] < len(data) // 3
+    assert pulled == data and pull["ok"]
+    if firmware == "deflate":
+        assert pull["ble_bytes"] < len(data) // 3
+    else:
+        assert "ble_bytes" not in pull
+    assert device.bytes_in < len(data)  # helpers included; a plain push alone needs more
+
+
+@pytest.mark.asyncio
+async def test_large_code_runs_through_deflated_loader(relay_url):
+    code = "total = 0\n" + "".join(f"total += {i}  # running sum, step {i}\n" for i in range(200)) + "print(total)\n"
+    device = SimulatedMonocle(zlib="inflate")
+    async with SimulatedBridge(relay_url, device) as bridge:
+        bridge.connected = True
+        ws, _ = await _registered_cli(relay_url)
+        await ws.send(json.dumps({"id": 1, "type": "repl", "code": code}))
+        resp = await _recv_reply(ws)
+        await ws.send(json.dumps({"id": 2, "type": "repl", "code": "print(total + 1)"}))
+        again = await _recv_reply(ws)
+        await ws.close()
+    assert resp["data"] == str(sum(range(200)))
+    assert again["data"] == str(sum(range(200)) + 1)  # the loader ran the code in the session's globals
+    assert bridge.device_zlib == 1
+    assert device.bytes_in < len(code) // 2
+
+
+@pytest.mark.asyncio
+async def test_compression_off_or_unsupported_sends_payload_as_is(relay_url):
+    data = b"x = 1\n" * 500
+    for device, compress in ((SimulatedMonocle(zlib="deflate"), False), (SimulatedMonocle(), True)):
+        async with SimulatedBridge(relay_url, device, compress=compress) as bridge:
+            bridge.connected = True
+            ws, _ = await _registered_cli(relay_url)
+            await ws.send(json.dumps({"id": 1, "type": "file_push", "path": "a.py",
+                                      "data": base64.b64encode(data).decode()}))
+            while (resp := json.loads(await asyncio.wait_for(ws.recv(), timeout=10)))["type"] != "file_done":
+                pass
+            await ws.close()
+            assert (device.root / "a.py").read_bytes() == data
+        assert resp["ok"] and "ble_bytes" not in resp
+        assert device.bytes_in > len(data)
+        assert bridge.device_zlib == (None if not compress else 0)
+
+
+@pytest.mark.asyncio
+async def test_file_request_without_device_fails(relay_url):
+    async with SimulatedBridge(relay_url):
+        ws, _ = await _registered_cli(relay_url)
+        await ws.send(json.dumps({"id": 1, "type": "file_ls", "path": "/"}))
+        resp = json.loads(await asyncio.wait_for(ws.recv(), timeout=2))
+        await ws.close()
+    assert resp["type"] == "file_list"
+    assert resp["ok"] is False and resp["error"] == "Not connected to Monocle"
+
+
+@pytest.mark.asyncio
+async def test_sync_sends_only_changed_files_and_removes_deleted(relay_url, tmp_path):
+    """sync pushes new and changed files, removes files it deployed that are gone, keeps others."""
+    project = tmp_path / "app"
+    (project / "lib").mkdir(parents=True)
+    (project / "main.py").write_text("import lib.util\n")
+    (project / "lib" / "util.py").write_text("X = 1\n")
+    (project / "old.py").write_text("pass\n")
+    device = SimulatedMonocle()
+    (device.root / "keep.txt").write_text("not ours")
+    async with SimulatedBridge(relay_url, device) as bridge:
+        bridge.connected = True
+        client = await _client(relay_url)
+        out = StringIO()
+        try:
+            with patch("sys.stdout", out):
+                assert await monocle_cli.sync_dir(client, str(project), "/") == 0
+                assert (device.root / "lib" / "util.py").read_text() == "X = 1\n"
+                writes = device.writes
+                assert await monocle_cli.sync_dir(client, str(project), "/") == 0
+                nothing_to_do = device.writes - writes
+                (project / "lib" / "util.py").write_text("X = 2\n")
+                (project / "old.py").unlink()
+                assert await monocle_cli.sync_dir(client, str(project), "/") == 0
+                assert (device.root / "lib" / "util.py").read_text() == "X = 2\n"
+                assert not (device.root / "old.py").exists()
+                assert (device.root / "keep.txt").exists()
+                # A change made on the device behind sync's back is noticed and undone
+                (device.root / "main.py").write_text("broken")
+                assert await monocle_cli.sync_dir(client, str(project), "/") == 0
+                assert (device.root / "main.py").read_text() == "import lib.util\n"
+        finally:
+            await client.close()
+    lines = [line for line in out.getvalue().splitlines() if line.startswith("sync:")]
+    assert lines == [
+        "sync: 3 sent, 0 removed, 0 unchanged",
+        "sync: 0 sent, 0 removed, 3 unchanged",
+        "sync: 1 sent, 1 removed, 1 unchanged",
+        "sync: 1 sent, 0 removed, 1 unchanged",
+    ]
+    assert nothing_to_do < writes / 4
+
+
+def test_manifest_digest_matches_device_walk_order():
+    """A directory's files come before a sibling whose name extends the directory's, as in the device's walk."""
+    files = {"a.py": [1, 2], "a/x.py": [3, 4]}
+    expected = zlib.crc32(b"1 2 a.py\n", zlib.crc32(b"3 4 a/x.py\n"))
+    assert monocle_cli.manifest_digest(files) == expected
+
+
+@pytest.mark.asyncio
+async def test_sync_uploads_bytecode_when_device_version_matches(relay_url, tmp_path):
+    """Modules go up as .mpy (replacing a deployed .py); main.py stays source."""
+    exe = tmp_path / "mpy-cross"
+    exe.write_text(f"#!{sys.executable}\nimport sys\n"
+                   "if sys.argv[1] == '--version':\n    print('mpy-cross emitting mpy v6.1'); sys.exit()\n"
+                   "open(sys.argv[sys.argv.index('-o') + 1], 'wb').write(b'M\\x06' + open(sys.argv[-1], 'rb').read())\n")
+    exe.chmod(0o755)
+    project = tmp_path / "app"
+    project.mkdir()
+    (project / "main.py").write_text("import util\n")
+    (project / "util.py").write_text("X = 1\n")
+    device = SimulatedMonocle()
+    async with SimulatedBridge(relay_url, device) as bridge:
+        bridge.connected = True
+        client = await _client(relay_url)
+        out = StringIO()
+        try:
+            with patch("sys.stdout", out), \
+                    patch.object(monocle_cli, "MPY_CACHE_DIR", tmp_path / "cache"), \
+                    patch.dict(monocle_cli._mpy_cross_versions, clear=True):
+                with patch.object(monocle_cli, "MPY_CROSS", ""):
+                    assert await monocle_cli.sync_dir(client, str(project), "/") == 0
+                assert sorted(p.name for p in device.root.iterdir()) == ["main.py", "util.py"]
+                device.mpy = 6 | 1 << 8
+                with patch.object(monocle_cli, "MPY_CROSS", str(exe)):
+                    assert await monocle_cli.sync_dir(client, str(project), "/") == 0
+                    assert await monocle_cli.sync_dir(client, str(project), "/") == 0
+                assert (device.root / "util.mpy").read_bytes() == b"M\x06X = 1\n"
+                assert sorted(p.name for p in device.root.iterdir()) == ["main.py", "util.mpy"]
+        finally:
+            await client.close()
+    lines = [line for line in out.getvalue().splitlines() if line.startswith("sync:")]
+    assert lines == [
+        "sync: 2 sent, 0 removed, 0 unchanged",
+        "sync: 1 sent, 1 removed, 1 unchanged",
+        "sync: 0 sent, 0 removed, 2 unchanged",
+    ]
+    assert f"{project / 'util.py'} -> /util.mpy" in out.getvalue()
+
+
+@pytest.mark.asyncio
+async def test_sync_removes_a_source_copy_it_did_not_deploy(relay_url, tmp_path):
+    """A util.py put on the device some other way would shadow the util.mpy sync sends."""
+    exe = tmp_path / "mpy-cross"
+    exe.write_text(f"#!{sys.executable}\nimport sys\n"
+                   "if sys.argv[1] == '--version':\n    print('mpy-cross emitting mpy v6.1'); sys.exit()\n"
+                   "open(sys.argv[sys.argv.index('-o') + 1], 'wb').write(b'M\\x06' + open(sys.argv[-1], 'rb').read())\n")
+    exe.chmod(0o755)
+    project = tmp_path / "app"
+    project.mkdir()
+    (project / "util.py").write_text("X = 1\n")
+    device = SimulatedMonocle()
+    device.mpy = 6 | 1 << 8
+    (device.root / "util.py").write_text("X = 0\n")
+    async with SimulatedBridge(relay_url, device) as bridge:
+        bridge.connected = True
+        client = await _client(relay_url)
+        out = StringIO()
+        try:
+            with patch("sys.stdout", out), \
+                    patch.object(monocle_cli, "MPY_CACHE_DIR", tmp_path / "cache"), \
+                    patch.dict(monocle_cli._mpy_cross_versions, clear=True), \
+                    patch.object(monocle_cli, "MPY_CROSS", str(exe)):
+                assert await monocle_cli.sync_dir(client, str(project), "/") == 0
+            assert sorted(p.name for p in device.root.iterdir()) == ["util.mpy"]
+        finally:
+            await client.close()
+    assert "sync: 1 sent, 1 removed, 0 unchanged" in out.getvalue()
+
+
+async def _recv_json(ws, timeout=10):
+    while True:
+        message = await asyncio.wait_for(ws.recv(), timeout=timeout)
+        if isinstance(message, str):
+            return json.loads(message)
+
+
+async def _recv_reply(ws, timeout=10):
+    """The next JSON frame other than repl_started (which comes before every repl reply)."""
+    while (reply := await _recv_json(ws, timeout))["type"] == "repl_started":
+        pass
+    return reply
+
+
+@pytest.mark.asyncio
+async def test_interrupt_stops_runaway_loop_and_cancels_queued(relay_url):
+    """Ctrl-C reaches the device ahead of the queue; queued requests are cancelled."""
+    async with SimulatedBridge(relay_url) as bridge:
+        bridge.connected = True
+        ws, _ = await _registered_cli(relay_url)
+        await ws.send(json.dumps({"id": 1, "type": "repl", "code": "while True:\n    pass", "stream": True}))
+        assert (await _recv_json(ws))["type"] == "repl_started"
+        await ws.send(json.dumps({"id": 2, "type": "repl", "code": "1+1"}))
+        await ws.send(json.dumps({"id": 3, "type": "interrupt"}))
+        replies = {}
+        while len(replies) < 3:
+            resp = await _recv_json(ws)
+            if resp["type"] != "repl_chunk":
+                replies[resp["id"]] = resp
+        await ws.send(json.dumps({"id": 4, "type": "repl", "code": "6*7"}))
+        after = await _recv_reply(ws)
+        await ws.close()
+    assert replies[2]["data"] == "ERROR: cancelled"
+    assert replies[3]["type"] == "interrupted"
+    assert replies[3]["running"] and replies[3]["cancelled"] == 1
+    assert replies[1]["type"] == "repl_done"
+    assert replies[1]["interrupted"] and not replies[1]["ok"]
+    assert after["data"] == "42"
+
+
+@pytest.mark.asyncio
+async def test_higher_priority_requests_run_first(relay_url):
+    async with SimulatedBridge(relay_url) as bridge:
+        bridge.connected = True
+        ws, _ = await _registered_cli(relay_url)
+        await ws.send(json.dumps({"id": 1, "type": "repl", "code": "import time\ntime.sleep(0.2)", "stream": True}))
+        assert (await _recv_json(ws))["type"] == "repl_started"
+        await ws.send(json.dumps({"id": 2, "type": "repl", "code": "'low'"}))
+        await ws.send(json.dumps({"id": 3, "type": "repl", "code": "'high'", "priority": 5}))
+        order = [(await _recv_reply(ws))["id"] for _ in range(3)]
+        await ws.close()
+    assert order == [1, 3, 2]
+
+
+@pytest.mark.asyncio
+async def test_interrupted_push_keeps_part_and_resumes(relay_url):
+    data = bytes(range(256)) * 40
+    device = SimulatedMonocle(mtu=64, latency=0.002)
+    async with SimulatedBridge(relay_url, device, compress=False) as bridge:
+        bridge.connected = True
+        ws, _ = await _registered_cli(relay_url)
+        push = {"type": "file_push", "path": "big.bin", "data": base64.b64encode(data).decode()}
+        await ws.send(json.dumps({"id": 1, **push}))
+        assert (await _recv_json(ws))["type"] == "file_progress"
+        await ws.send(json.dumps({"id": 2, "type": "interrupt"}))
+        replies = {}
+        while len(replies) < 2:
+            resp = await _recv_json(ws)
+            if resp["type"] != "file_progress":
+                replies[resp["id"]] = resp
+        assert (device.root / "big.bin.part").exists()
+        device.latency = 0
+        await ws.send(json.dumps({"id": 3, **push}))
+        while (done := await _recv_json(ws))["type"] != "file_done":
+            pass
+        await ws.close()
+        assert (device.root / "big.bin").read_bytes() == data
+    assert replies[1] == {**replies[1], "ok": False, "error": "interrupted"}
+    assert replies[2]["running"]
+    assert done["ok"] and 0 < done["resumed_from"] < len(data)
+
+
+@pytest.mark.asyncio
+async def test_interrupted_pull_is_abandoned_and_repl_resynced(relay_url):
+    device = SimulatedMonocle(mtu=64, latency=0.002, notify_interval=0.002)
+    (device.root / "big.bin").write_bytes(bytes(range(256)) * 40)
+    async with SimulatedBridge(relay_url, device, compress=False) as bridge:
+        bridge.connected = True
+        ws, _ = await _registered_cli(relay_url)
+        await ws.send(json.dumps({"id": 1, "type": "file_pull", "path": "big.bin"}))
+        while (await _recv_json(ws))["type"] != "file_data":
+            pass
+        await ws.send(json.dumps({"id": 2, "type": "interrupt"}))
+        replies = {}
+        while len(replies) < 2:
+            resp = await _recv_json(ws)
+            if resp["type"] not in ("file_data", "file_progress"):
+                replies[resp["id"]] = resp
+        await ws.send(json.dumps({"id": 3, "type": "repl", "code": "6*7"}))
+        after = await _recv_reply(ws)
+        await ws.close()
+    assert replies[1]["type"] == "file_done" and replies[1]["error"] == "interrupted"
+    assert after["data"] == "42"
+
+
+@pytest.mark.asyncio
+async def test_connect_reuses_link_and_relay_answers_from_cache(relay_url):
+    async with SimulatedBridge(relay_url) as bridge:
+        ws, _ = await _registered_cli(relay_url)
+
+        async def call(frame):
+            await ws.send(json.dumps(frame))
+            return await _recv_json(ws)
+
+        assert not (await call({"id": 1, "type": "status"}))["connected"]
+        first = await call({"id": 2, "type": "connect"})
+        again = await call({"id": 3, "type": "connect"})
+        status = await call({"id": 4, "type": "status"})
+        fresh = await call({"id": 5, "type": "connect", "fresh": True})
+        await bridge.disconnect()
+        await asyncio.sleep(0.05)
+        down = await call({"id": 6, "type": "status"})
+        await ws.close()
+    assert first["ok"] and "cached" not in first and "reused" not in first
+    assert again["ok"] and again["cached"] and "timing" not in again  # answered by the relay
+    assert status == {**status, "bridge": True, "connected": True, "device": "monocle"}
+    assert fresh["ok"] and "cached" not in fresh
+    assert down["bridge"] and not down["connected"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("ws_client", ["websockets", "builtin"])
+async def test_dropped_websockets_resume_without_losing_frames(relay_url, ws_client):
+    """Bridge and CLI connections lost mid-request reconnect, resume and replay what was missed."""
+    async with SimulatedBridge(relay_url) as bridge:
+        bridge.connected = True
+        link = monocle_cli.RelayLink(relay_url, ws_client)
+        connect = link._connect
+        attempts = []
+
+        async def first_retry_times_out():
+            attempts.append(1)
+            if len(attempts) == 2:
+                raise asyncio.TimeoutError  # not an OSError before Python 3.11
+            return await connect()
+
+        link._connect = first_retry_times_out
+        reg = await link.open()
+        assert reg["session"] and not reg["resumed"]
+        code = "import time\nfor i in range(30):\n    print(i)\n    time.sleep(0.005)"
+        await link.send(json.dumps({"id": 1, "type": "repl", "code": code, "stream": True}))
+        output = ""
+        kinds = []
+        while not kinds or kinds[-1] != "repl_done":
+            resp = json.loads(await asyncio.wait_for(link.recv(), timeout=10))
+            kinds.append(resp["type"])
+            if resp["type"] == "repl_started":
+                bridge.drop_connection()
+            elif resp["type"] == "repl_chunk":
+                output += resp["data"]
+                if resp["data"] == "5\r\n":
+                    link.ws.transport.abort()
+        await link.send(json.dumps({"id": 2, "type": "repl", "code": "6*7"}))
+        after = await _recv_reply(link)
+        await link.close()
+    assert output.replace("\r", "") == "".join(f"{i}\n" for i in range(30))
+    assert "bridge_away" in kinds and "bridge_gone" not in kinds
+    assert after["data"] == "42"
+    assert server.metrics.resumes["bridge"] >= 1 and server.metrics.resumes["cli"] >= 1
+    assert len(attempts) >= 3
+
+
+@pytest.mark.asyncio
+async def test_lost_bridge_session_expires_into_bridge_gone(relay_url):
+    with patch.object(server, "SESSION_TTL", 0.05):
+        async with SimulatedBridge(relay_url) as bridge:
+            bridge.connected = True
+            ws, _ = await _registered_cli(relay_url)
+            bridge._tasks[-1].cancel()  # never reconnects
+            bridge.drop_connection()
+            assert (await _recv_json(ws))["type"] == "bridge_away"
+            assert (await _recv_json(ws))["type"] == "bridge_gone"
+            assert not server.bridges and not server.sessions
+            await ws.close()
+
+
+@pytest.mark.asyncio
+async def test_requests_reach_the_named_device_and_its_loss_only_its_clis(relay_url):
+    """With two bridge pages, device picks one; bridge_gone goes to the CLIs using it."""
+    async with SimulatedBridge(relay_url, device_id="left") as left, \
+            SimulatedBridge(relay_url, device_id="right") as right:
+        for bridge in (left, right):
+            bridge.connected = True
+            bridge.device.namespace["who"] = bridge.device_id
+            await bridge._report_link_state()
+        ws, reg = await _registered_cli(relay_url)
+        other, _ = await _registered_cli(relay_url)
+        await ws.send(json.dumps({"id": 1, "device": "right", "type": "repl", "code": "who"}))
+        assert (await _recv_reply(ws))["data"] == "'right'"
+        await ws.send(json.dumps({"id": 2, "type": "devices"}))
+        listed = await _recv_json(ws)
+        assert [(d["id"], d["connected"]) for d in listed["devices"]] == [("left", True), ("right", True)]
+        await ws.send(json.dumps({"id": 3, "device": "middle", "type": "repl", "code": "1"}))
+        assert await _recv_json(ws) == {"client": reg["client"], "id": 3, "type": "bridge_gone",
+                                        "error": "no bridge for device middle"}
+        await other.send(json.dumps({"id": 1, "type": "repl", "code": "who"}))
+        assert (await _recv_reply(other))["data"] == "'left'"  # pinned to the first one
+
+        await left.ws.close()
+        assert await _recv_json(other) == {"type": "bridge_gone", "device": "left"}
+        await ws.send(json.dumps({"id": 4, "type": "repl", "code": "who"}))
+        assert (await _recv_reply(ws))["data"] == "'right'"  # never told: it did not use left
+        await ws.close()
+        await other.close()
+
+
+@pytest.mark.asyncio
+async def test_cli_all_runs_the_command_on_every_device(relay_url, monkeypatch, tmp_path):
+    monkeypatch.setenv("MONOCLE_WS_URL", relay_url)
+    monkeypatch.setenv("MONOCLE_CLI_SOCKET", str(tmp_path / "none.sock"))
+    async with SimulatedBridge(relay_url, device_id="left") as left, \
+            SimulatedBridge(relay_url, device_id="right") as right:
+        for bridge in (left, right):
+            bridge.connected = True
+            bridge.device.namespace["who"] = bridge.device_id
+        with patch.object(monocle_client, "WS_URL", relay_url), \
+                patch("sys.stdout", new_callable=StringIO) as out:
+            status = await monocle_cli.run_on_all(["repl", "print(who)"])
+    assert status == 0
+    assert sorted(out.getvalue().splitlines()) == ["[left] left", "[right] right"]
+
+
+@pytest.mark.asyncio
+async def test_capture_and_record_come_over_the_raw_data_channel(relay_url, tmp_path):
+    """capture and record write the device's bytes as they arrive, without passing through the REPL."""
+    async with SimulatedBridge(relay_url, SimulatedMonocle(mtu=64)) as bridge:
+        bridge.connected = True
+        image = bridge.device.camera_image
+        client = await _client(relay_url)
+        out = StringIO()
+        try:
+            with patch("sys.stdout", out):
+                repl_bytes = bridge.device.bytes_out
+                assert await monocle_cli.capture_data(client, "capture", [str(tmp_path / "still.jpg")]) == 0
+                assert bridge.device.bytes_out - repl_bytes < len(image) // 4  # helper output only
+                assert await monocle_cli.capture_data(client, "record", ["0.2", str(tmp_path / "a.wav")]) == 0
+                assert await monocle_cli.capture_data(
+                    client, "record", ["0.1", str(tmp_path / "a.pcm"), "--bits", "8", "--rate", "16000"]) == 0
+                assert await monocle_cli.capture_data(client, "record", ["--bits", "12"]) == 2
+        finally:
+            await client.close()
+        assert bridge.device.data_bytes_out == len(image) + 3200 + 1600
+    assert (tmp_path / "still.jpg").read_bytes() == image
+    with wave.open(str(tmp_path / "a.wav")) as wav:
+        assert (wav.getnchannels(), wav.getsampwidth(), wav.getframerate()) == (1, 2, 8000)
+        assert wav.readframes(wav.getnframes()) == simulator._test_tone(0.2, 8000, 16)
+    assert (tmp_path / "a.pcm").read_bytes() == simulator._test_tone(0.1, 16000, 8)
+    text = out.getvalue()
+    assert f"camera -> {tmp_path / 'still.jpg'}: {len(image)} bytes in" in text
+    assert "microphone -> " in text and "Usage: monocle-cli capture" in text
+
+
+@pytest.mark.asyncio
+async def test_data_capture_sends_json_chunks_and_reports_failures(relay_url):
+    """Without binary the bytes come as base64 data_chunk replies; unusable requests fail at once."""
+    async with SimulatedBridge(relay_url) as bridge:
+        bridge.connected = True
+        ws, _ = await _registered_cli(relay_url)
+        await ws.send(json.dumps({"id": 1, "type": "data_capture", "source": "camera"}))
+        replies = []
+        while not replies or replies[-1]["type"] != "data_done":
+            replies.append(await _recv_json(ws))
+        await ws.send(json.dumps({"id": 2, "type": "data_capture", "source": "thermometer"}))
+        unknown = await _recv_json(ws)
+        bridge.device.raw_data = False
+        await ws.send(json.dumps({"id": 3, "type": "data_capture", "source": "camera"}))
+        missing = await _recv_json(ws)
+        await ws.close()
+    image = bridge.device.camera_image
+    assert replies[0]["type"] == "data_started"
+    chunks = [r for r in replies if r["type"] == "data_chunk"]
+    assert b"".join(base64.b64decode(r["data"]) for r in chunks) == image
+    assert [r["seq"] for r in chunks] == list(range(len(chunks)))
+    assert replies[-1]["ok"] and replies[-1]["size"] == len(image) and replies[-1]["crc"] == zlib.crc32(image)
+    assert unknown["error"] == "unknown source: thermometer"
+    assert missing["error"] == "Monocle has no raw data service"
+
+
+@pytest.mark.asyncio
+async def test_interrupted_recording_stops_and_repl_resyncs(relay_url):
+    async with SimulatedBridge(relay_url, compress=False) as bridge:
+        bridge.connected = True
+        ws, _ = await _registered_cli(relay_url)
+        await ws.send(json.dumps({"id": 1, "type": "data_capture", "source": "microphone", "seconds": 30,
+                                  "binary": True}))
+        while not isinstance(await asyncio.wait_for(ws.recv(), timeout=10), bytes):
+            pass  # until the first FRAME_DATA frame
+        await ws.send(json.dumps({"id": 2, "type": "interrupt"}))
+        replies = {}
+        while len(replies) < 2:
+            resp = await _recv_json(ws)
+            if resp["type"] != "data_started":
+                replies[resp["id"]] = resp
+        await ws.send(json.dumps({"id": 3, "type": "repl", "code": "6*7"}))
+        after = await _recv_reply(ws)
+        await ws.close()
+    assert replies[1]["type"] == "data_done" and replies[1]["error"] == "interrupted"
+    assert 0 < replies[1]["size"] < 30 * 8000 * 2
+    assert after["data"] == "42"
+
+
+@pytest.mark.asyncio
+async def test_show_sends_frames_as_deltas_to_the_display(relay_url, tmp_path):
+    """show draws images and JSON frames; later frames carry only what changed."""
+    (tmp_path / "flag.ppm").write_bytes(b"P6 2 1 255\n" + bytes([255, 0, 0, 0, 0, 255]))
+    hud = {"title": ["Text", "HUD", 0, 0, 0xFFFFFF], "n": ["Text", "0", 0, 50, 0x00FF00, {"justify": "TOP_LEFT"}]}
+    (tmp_path / "hud.json").write_text(json.dumps(hud))
+    lines = [json.dumps({**hud, "n": ["Text", str(i), 0, 50, 0x00FF00]}) for i in range(1, 6)]
+    async with SimulatedBridge(relay_url) as bridge:
+        bridge.connected = True
+        client = await _client(relay_url)
+        err = StringIO()
+        try:
+            with patch("sys.stderr", err):
+                assert await monocle_cli.show_frames(client, [str(tmp_path / "flag.ppm"), "--cell", "320"]) == 0
+                assert bridge.device.screen == [("Rectangle", 0, 40, 319, 359, 0xFF0000),
+                                                ("Rectangle", 320, 40, 639, 359, 0x0000FF)]
+                assert await monocle_cli.show_frames(client, [str(tmp_path / "hud.json")]) == 0
+                assert bridge.device.screen == [("Text", "HUD", 0, 0, 0xFFFFFF),
+                                                ("Text", "0", 0, 50, 0x00FF00, {"justify": "TOP_LEFT"})]
+                with patch("sys.stdin", StringIO("\n".join(lines) + "\n")):
+                    assert await monocle_cli.show_frames(client, ["-"]) == 0
+                with patch("sys.stdout", StringIO()):
+                    assert await monocle_cli.show_frames(client, ["--cell"]) == 2
+            assert bridge.device.screen[-1] == ("Text", "5", 0, 50, 0x00FF00)
+            display = Display(client)
+            await display.show(hud)
+            await display.flush()
+            sent = bridge.device.bytes_in
+            for i in range(10):
+                await display.show({**hud, "n": ["Text", str(i), 0, 50, 0x00FF00]})
+            await display.flush()
+        finally:
+            await client.close()
+        assert bridge.device.screen[-1] == ("Text", "9", 0, 50, 0x00FF00)
+        # One changed Text per frame, not the whole scene
+        assert display.frames == 11 and (bridge.device.bytes_in - sent) / 10 < 40
+    assert "show: 1 frames in" in err.getvalue()
+
+
+@pytest.mark.asyncio
+async def test_watchers_share_one_poll_per_expression_and_interval(relay_url):
+    """Device queries follow the distinct watches, not the watchers; values go out only when they change."""
+    async with SimulatedBridge(relay_url) as bridge:
+        bridge.connected = True
+        bridge.device.namespace["level"] = 90
+        clients = [await _client(relay_url) for _ in range(4)]
+        try:
+            watches = [client.watch("level", 0.1) for client in clients[:3]]
+            first = [await w.__anext__() for w in watches]
+            assert [r["data"] for r in first] == ["90"] * 3
+            other = clients[3].watch("level * 2", 0.1)
+            assert (await other.__anext__())["data"] == "180"
+            assert len(server.polls) == 2
+            await asyncio.sleep(0.5)
+            queries = server.metrics.watch["queries"]
+            assert 6 <= queries <= 16  # two polls at 10 Hz, however many watch them
+            bridge.device.namespace["level"] = 89
+            assert [(await w.__anext__())["data"] for w in watches] == ["89"] * 3
+            assert (await other.__anext__())["data"] == "178"
+            assert server.metrics.watch["updates"] == 8
+            await watches[0].aclose()
+            await watches[1].aclose()
+            assert sum(len(p.watchers) for p in server.polls.values()) == 2
+            assert await clients[3].interrupt()
+            with pytest.raises(StopAsyncIteration):
+                await other.__anext__()
+            assert len(server.polls) == 1
+            out = StringIO()
+            bridge.device.namespace["level"] = 7
+            assert (await watches[2].__anext__())["data"] == "7"
+            with patch("sys.stdout", out):
+                assert await monocle_cli.watch_expr(clients[3], ["level", "--interval", "0.1", "--count", "1"]) == 0
+                assert await monocle_cli.watch_expr(clients[3], ["level", "--interval", "0.01"]) == 1
+            assert out.getvalue().split("\n")[0].endswith(" 7")
+            assert "interval must be at least 0.1 s" in out.getvalue()
+            await watches[2].aclose()
+        finally:
+            for client in clients:
+                await client.close()
+        await asyncio.sleep(0.05)
+        assert server.polls == {}  # the last watchers left